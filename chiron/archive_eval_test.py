@@ -0,0 +1,61 @@
+# Copyright 2017 The Chiron Authors. All Rights Reserved.
+#
+#This Source Code Form is subject to the terms of the Mozilla Public
+#License, v. 2.0. If a copy of the MPL was not distributed with this
+#file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#Basecalling input from a read archive test
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from chiron import chiron_input
+from chiron.utils import archive
+
+
+def _write_archive(folder, compressor):
+    rng = np.random.RandomState(0)
+    signals = {}
+    archive_path = os.path.join(folder, 'raw' + archive.ARCHIVE_SUFFIX)
+    with archive.ReadArchive(archive_path, mode='w', compressor=compressor) as read_archive:
+        for i in range(3):
+            signals['read_%d' % i] = rng.randint(300, 700, 50 + i * 7).astype(np.float32)
+            read_archive.add('read_%d' % i, signals['read_%d' % i])
+    return archive_path, signals
+
+
+def test_read_data_for_eval_archive():
+    folder = tempfile.mkdtemp()
+    try:
+        for compressor in [None, 'zlib']:
+            archive_path, signals = _write_archive(folder, compressor)
+            for read_id, signal in signals.items():
+                eval_data = chiron_input.read_data_for_eval(archive.entry_path(archive_path, read_id),
+                                                            start_index=0, step=20, seg_length=30)
+                expect = chiron_input.normalize_signal(signal, chiron_input.FLAGS.sig_norm)
+                starts = list(range(0, len(signal), 20))
+                assert eval_data.reads_n == len(starts)
+                for i, start in enumerate(starts):
+                    segment = expect[start:start + 30]
+                    assert eval_data.event_length[i] == len(segment)
+                    assert np.allclose(eval_data.event[i][:len(segment)], segment)
+            chiron_input.close_archives()
+            os.remove(archive_path)
+    finally:
+        chiron_input.close_archives()
+        shutil.rmtree(folder)
+
+
+def test_expand_archives():
+    from chiron import chiron_eval
+    folder = tempfile.mkdtemp()
+    try:
+        archive_path, signals = _write_archive(folder, 'zlib')
+        name = os.path.basename(archive_path)
+        file_list = chiron_eval.expand_archives([name, 'a.fast5'], folder)
+        assert file_list == [archive.entry_path(name, read_id) for read_id in sorted(signals)] + ['a.fast5']
+        assert all(chiron_eval.is_eval_input(x) for x in file_list)
+    finally:
+        shutil.rmtree(folder)
@@ -10,6 +10,7 @@ from __future__ import print_function
 import tensorflow as tf
 
 from chiron.chiron_input import read_raw_data_sets
+from chiron.chiron_input import close_archives
 from chiron.cnn import getcnnlogit
 from six.moves import range
 
@@ -57,6 +58,7 @@ def train():
     train_ds, valid_ds = read_raw_data_sets(FLAGS.data_dir,
                                             seq_length=FLAGS.sequence_len,
                                             max_reads_num=10000)
+    close_archives()
     x = tf.placeholder(tf.float32, shape=[FLAGS.batch_size, FLAGS.sequence_len])
     seq_length = tf.placeholder(tf.int32, shape=[FLAGS.batch_size])
     y_indexs = tf.placeholder(tf.int64)
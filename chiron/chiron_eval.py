@@ -18,15 +18,19 @@ import tensorflow as tf
 
 from chiron import chiron_model
 from chiron.chiron_input import read_data_for_eval
+from chiron.chiron_input import close_archives
 from chiron.cnn import getcnnfeature
 from chiron.cnn import getcnnlogit
 from chiron.rnn import rnn_layers
+from chiron.utils import archive
 from chiron.utils.easy_assembler import simple_assembly
 from chiron.utils.easy_assembler import simple_assembly_qs
 from chiron.utils.easy_assembler import global_alignment_assembly
 from chiron.utils.unix_time import unix_time
 from chiron.utils.progress import multi_pbars
 from six.moves import range
+from six.moves import queue
+from tensorflow.tools.graph_transforms import TransformGraph
 import threading
 from collections import defaultdict
 from collections import namedtuple
@@ -241,14 +245,173 @@ def write_output(segments,
             out_meta.write("# input_name model_name\n")
             out_meta.write("%s %s\n" % (global_setting.input, global_setting.model))
             
-def build_eval_graph(model_configure):
+FROZEN_SUFFIX = '.pb'
+FROZEN_GRAPH = 'frozen_graph.pb'
+FROZEN_INPUTS = ['x','seq_length']
+FROZEN_OUTPUTS = ['logits','ratio']
+FROZEN_TRANSFORMS = ['fold_constants(ignore_errors=true)',
+                     'fold_batch_norms',
+                     'fold_old_batch_norms',
+                     'sort_by_execution_order']
+
+def is_frozen(model_path):
+    """If the model path is a frozen graph given by freeze_graph."""
+    return os.path.isfile(model_path) and model_path.endswith(FROZEN_SUFFIX)
+
+def freeze_graph(model_folder,output_f,segment_len,batch_size = None):
+    """
+    Freeze the latest checkpoint into an inference graph of constants.
+    The graph is built with training fixed to False so only the population
+    statistics branch of the batch normalization is kept, the batch norms
+    after a convolution or a matmul are then folded into its weights.
+    Args:
+        model_folder: The model folder contains model.json and the checkpoint.
+        output_f: The output graph file.
+        segment_len: The segment length the ratio of the model is computed on,
+            the graph takes segments of any length.
+        batch_size: The batch size of the graph, None for any batch size.
+    Return:
+        The number of nodes in the frozen graph.
+    """
+    model_configure = chiron_model.read_config(os.path.join(model_folder,'model.json'))
+    graph = tf.Graph()
+    with graph.as_default():
+        x = tf.placeholder(tf.float32, shape=[batch_size, None], name='x')
+        seq_length = tf.placeholder(tf.int32, shape=[batch_size], name='seq_length')
+        logits, ratio = chiron_model.inference(x,
+                                               seq_length,
+                                               training=tf.constant(False),
+                                               full_sequence_len = segment_len,
+                                               configure = model_configure)
+        tf.identity(logits, name='logits')
+        tf.constant(ratio, dtype=tf.float64, name='ratio')
+        saver = tf.train.Saver(var_list=tf.trainable_variables()+tf.moving_average_variables())
+        with tf.Session() as sess:
+            saver.restore(sess, tf.train.latest_checkpoint(model_folder))
+            graph_def = tf.graph_util.convert_variables_to_constants(sess,
+                                                                     graph.as_graph_def(),
+                                                                     FROZEN_OUTPUTS)
+    graph_def = TransformGraph(graph_def,FROZEN_INPUTS,FROZEN_OUTPUTS,FROZEN_TRANSFORMS)
+    with tf.gfile.GFile(output_f,'wb') as f:
+        f.write(graph_def.SerializeToString())
+    return len(graph_def.node)
+
+def import_frozen_graph(graph_f,x,seq_length):
+    """
+    Import a frozen graph given by freeze_graph.
+    Args:
+        graph_f: The frozen graph file.
+        x, seq_length: The input tensors mapped to the inputs of the graph.
+    Return:
+        (logits, ratio), same as chiron_model.inference.
+    """
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(graph_f,'rb') as f:
+        graph_def.ParseFromString(f.read())
+    nodes = dict((node.name,node) for node in graph_def.node)
+    frozen_shape = [dim.size for dim in nodes['x'].attr['shape'].shape.dim]
+    input_shape = x.get_shape().as_list()
+    for frozen_dim,input_dim in zip(frozen_shape,input_shape):
+        if frozen_dim >= 0 and frozen_dim != input_dim:
+            raise ValueError("The frozen graph %s takes segments of shape %s but got %s, freeze it again without a fixed batch size."%(graph_f,frozen_shape,input_shape))
+    ratio = float(tf.make_ndarray(nodes['ratio'].attr['value'].tensor))
+    logits, = tf.import_graph_def(graph_def,
+                                  input_map = {'x:0':x,'seq_length:0':seq_length},
+                                  return_elements = ['logits:0'],
+                                  name = 'frozen')
+    return logits,ratio
+
+def freeze(args):
+    output_f = args.output
+    if output_f is None:
+        output_f = os.path.join(args.model,FROZEN_GRAPH)
+    node_n = freeze_graph(args.model,output_f,args.segment_len,batch_size = args.batch_size)
+    print("Frozen graph with %d nodes written to %s"%(node_n,output_f))
+
+def is_eval_input(name):
+    """If the file can be basecalled, a signal file, a fast5 file or a read
+    in a read archive."""
+    return name.endswith('.signal') or name.endswith('.fast5') or archive.ARCHIVE_SEP in name
+
+def expand_archives(file_list,file_dir):
+    """Replace the read archives in the file list with the entry paths of
+    their reads, given by archive.entry_path."""
+    expanded = []
+    for name in file_list:
+        if name.endswith(archive.ARCHIVE_SUFFIX) and archive.is_archive(os.path.join(file_dir,name)):
+            with archive.ReadArchive(os.path.join(file_dir,name),mode = 'r') as read_archive:
+                expanded += [archive.entry_path(name,read_id) for read_id in read_archive.read_ids]
+        else:
+            expanded.append(name)
+    return expanded
+
+def list_input_files():
+    """List the input files, the read archives are expanded into their
+    reads, return (file_list, file_dir)."""
+    if os.path.isdir(FLAGS.input):
+        if FLAGS.recursive:
+            file_list =[]
+            dir_len = len(FLAGS.input)+1
+            for (dirpath, dirnames, filenames) in os.walk(FLAGS.input+'/'):
+                for filename in filenames:
+                    file_list.append(dirpath[dir_len:]+filename)
+        else:
+            file_list = os.listdir(FLAGS.input)
+        file_dir = FLAGS.input
+    else:
+        file_list = [os.path.basename(FLAGS.input)]
+        file_dir = os.path.abspath(
+            os.path.join(FLAGS.input, os.path.pardir))
+    return expand_archives(file_list,file_dir),file_dir
+
+class EvalPipeline(object):
+    """
+    A feeding and decoding pipeline of the evaluation graph. The logits of the
+    inference graph are enqueued into the logits queue of the pipeline and
+    decoded by its own decoding queue, so several pipelines can run against
+    one graph and one session.
+    Args:
+        logits, logits_fname, logits_index, seq_length: The tensors enqueued
+            into the logits queue.
+    """
+    def __init__(self,logits,logits_fname,logits_index,seq_length):
+        self.logits_queue = tf.PaddingFIFOQueue(
+            capacity=1000,
+            dtypes=[tf.float32, tf.string, tf.int32, tf.int32],
+            shapes=[logits.shape,logits_fname.shape,logits_index.shape, seq_length.shape]
+        )
+        self.logits_queue_size = self.logits_queue.size()
+        self.logits_enqueue = self.logits_queue.enqueue((logits, logits_fname, logits_index, seq_length))
+        self.logits_queue_close = self.logits_queue.close()
+        ### Decoding logits into bases
+        self.decode_predict_op, self.decode_prob_op, self.decoded_fname_op, self.decode_idx_op, self.decode_queue_size = decoding_queue(self.logits_queue)
+        self.file_list = None
+
+def build_eval_graph(model_configure,workers = 1):
+    """
+    Build the evaluation graph and start feeding the files.
+    Args:
+        model_configure: The model configuration, None to import the frozen
+            graph given by FLAGS.model.
+        workers: Number of the pipelines, every pipeline is fed by its own
+            thread and the files are pulled from a queue shared by the
+            pipelines. All the pipelines run the same inference graph in one
+            session, so the weights are held in memory once.
+    """
     class net:
         def __init__(self,configure):
-            self.pbars = multi_pbars(["Logits(batches)","ctc(batches)","logits(files)","ctc(files)"])
-            self.x = tf.placeholder(tf.float32, shape=[FLAGS.batch_size, FLAGS.segment_len])
-            self.seq_length = tf.placeholder(tf.int32, shape=[FLAGS.batch_size])
+            self.pbars = multi_pbars(["Logits(batches)","ctc(batches)","logits(files)","ctc(files)"],quiet = workers > 1)
+            # Batch size and segment length are left unknown, so the tail batch
+            # is fed as it is and the graph serves any segment length.
+            self.x = tf.placeholder(tf.float32, shape=[None, None])
+            self.seq_length = tf.placeholder(tf.int32, shape=[None])
             self.training = tf.placeholder(tf.bool)
-            self.logits, self.ratio = chiron_model.inference(
+            if configure is None:
+                self.logits, self.ratio = import_frozen_graph(FLAGS.model,
+                                                              self.x,
+                                                              self.seq_length)
+            else:
+                self.logits, self.ratio = chiron_model.inference(
                                             self.x, 
                                             self.seq_length, 
                                             training=self.training,
@@ -257,39 +420,30 @@ def build_eval_graph(model_configure):
             self.config = tf.ConfigProto(allow_soft_placement=True, intra_op_parallelism_threads=FLAGS.threads,
                                     inter_op_parallelism_threads=FLAGS.threads)
             self.config.gpu_options.allow_growth = True
-            self.logits_index = tf.placeholder(tf.int32, shape=[FLAGS.batch_size])
-            self.logits_fname = tf.placeholder(tf.string, shape=[FLAGS.batch_size])
-            self.logits_queue = tf.FIFOQueue(
-                capacity=1000,
-                dtypes=[tf.float32, tf.string, tf.int32, tf.int32],
-                shapes=[self.logits.shape,self.logits_fname.shape,self.logits_index.shape, self.seq_length.shape]
-            )
-            self.logits_queue_size = self.logits_queue.size()
-            self.logits_enqueue = self.logits_queue.enqueue((self.logits, self.logits_fname, self.logits_index, self.seq_length))
-            self.logits_queue_close = self.logits_queue.close()
-            ### Decoding logits into bases
-            self.decode_predict_op, self.decode_prob_op, self.decoded_fname_op, self.decode_idx_op, self.decode_queue_size = decoding_queue(self.logits_queue)
-            self.saver = tf.train.Saver(var_list=tf.trainable_variables()+tf.moving_average_variables())
+            self.logits_index = tf.placeholder(tf.int32, shape=[None])
+            self.logits_fname = tf.placeholder(tf.string, shape=[None])
+            self.pipelines = [EvalPipeline(self.logits,self.logits_fname,self.logits_index,self.seq_length)
+                              for _ in range(workers)]
+            var_list = tf.trainable_variables()+tf.moving_average_variables()
+            # A frozen graph has no variable to restore.
+            self.saver = tf.train.Saver(var_list=var_list) if var_list else None
         
         def init_session(self):
             self.sess = tf.train.MonitoredSession(session_creator=tf.train.ChiefSessionCreator(config=self.config))
-            self.saver.restore(self.sess, tf.train.latest_checkpoint(FLAGS.model))
-            if os.path.isdir(FLAGS.input):
-                if FLAGS.recursive:
-                    self.file_list =[]
-                    dir_len = len(FLAGS.input)+1
-                    for (dirpath, dirnames, filenames) in os.walk(FLAGS.input+'/'):
-                        for filename in filenames:
-                            self.file_list.append(dirpath[dir_len:]+filename)
-                else:
-                    self.file_list = os.listdir(FLAGS.input)
-                self.file_dir = FLAGS.input
+            if self.saver is not None:
+                self.saver.restore(self.sess, tf.train.latest_checkpoint(FLAGS.model))
+            self.file_list,self.file_dir = list_input_files()
+            if workers > 1:
+                file_queue = queue.Queue()
+                for name in self.file_list:
+                    file_queue.put(name)
+                for pipe in self.pipelines:
+                    file_queue.put(None)
+                    pipe.file_list = QueueFileList(file_queue)
             else:
-                self.file_list = [os.path.basename(FLAGS.input)]
-                self.file_dir = os.path.abspath(
-                    os.path.join(FLAGS.input, os.path.pardir))
+                self.pipelines[0].file_list = self.file_list
             file_n = len(self.file_list)
-            print("Found %d files."%(file_n))
+            print("Found %d files, basecalling with %d workers."%(file_n,workers))
             self.pbars.update(2,total = file_n)
             self.pbars.update(3,total = file_n)
             if not os.path.exists(FLAGS.output):
@@ -301,13 +455,13 @@ def build_eval_graph(model_configure):
             if not os.path.exists(os.path.join(FLAGS.output, 'meta')):
                 os.makedirs(os.path.join(FLAGS.output, 'meta'))
 
-        def _worker_fn(self):
+        def _worker_fn(self,pipe):
             batch_x = np.asarray([[]]).reshape(0,FLAGS.segment_len)
             seq_len = np.asarray([])
             logits_idx = np.asarray([])
             logits_fn = np.asarray([])
-            for f_i, name in enumerate(self.file_list):
-                if (not name.endswith('.signal')) and (not name.endswith('.fast5')):
+            for f_i, name in enumerate(pipe.file_list):
+                if not is_eval_input(name):
                     continue
                 input_path = os.path.join(self.file_dir, name)
                 eval_data = read_data_for_eval(input_path, FLAGS.start,
@@ -339,7 +493,7 @@ def build_eval_graph(model_configure):
                         self.logits_index.name:logits_idx,
                         self.logits_fname.name:logits_fn,
                     }
-                    self.sess.run(self.logits_enqueue,feed_dict=feed_dict)
+                    self.sess.run(pipe.logits_enqueue,feed_dict=feed_dict)
                     batch_x = np.asarray([[]]).reshape(0,FLAGS.segment_len)
                     seq_len = np.asarray([])
                     logits_idx = np.asarray([])
@@ -349,42 +503,66 @@ def build_eval_graph(model_configure):
                 self.pbars.update(2,progress = f_i+1)
                 self.pbars.update_bar()
             ### All files has been processed.
-            batch_n = len(batch_x)
-            if batch_n >0:
-                pad_width = FLAGS.batch_size - batch_n
-                batch_x = np.pad(
-                        batch_x, ((0, pad_width), (0, 0)), mode='wrap')
-                seq_len = np.pad(
-                        seq_len, ((0, pad_width)), mode='wrap')
-                logits_idx = np.pad(logits_idx,(0,pad_width),mode = 'constant',constant_values=-1)
-                logits_fn = np.pad(logits_fn,(0,pad_width),mode = 'constant',constant_values='')
-                self.sess.run(self.logits_enqueue,feed_dict = {
+            if len(batch_x) >0:
+                self.sess.run(pipe.logits_enqueue,feed_dict = {
                         self.x.name: batch_x,
                         self.seq_length.name: np.round(seq_len/self.ratio).astype(np.int32),
                         self.training.name: False,
                         self.logits_index.name:logits_idx,
                         self.logits_fname.name:logits_fn,
                     })
-            self.sess.run(self.logits_queue_close)
+            self.sess.run(pipe.logits_queue_close)
         def run_worker(self):
-            worker = threading.Thread(target=self._worker_fn)
-            worker.setDaemon(True)
-            worker.start()
+            for pipe in self.pipelines:
+                worker = threading.Thread(target=self._worker_fn,args=(pipe,))
+                worker.setDaemon(True)
+                worker.start()
     eval_net = net(model_configure)
     eval_net.init_session()
     eval_net.run_worker()
     return eval_net
 
 def evaluation():
-    config_path = os.path.join(FLAGS.model,'model.json')
-    model_configure = chiron_model.read_config(config_path)
-    net = build_eval_graph(model_configure)
+    if is_frozen(FLAGS.model):
+        model_configure = None
+    else:
+        config_path = os.path.join(FLAGS.model,'model.json')
+        model_configure = chiron_model.read_config(config_path)
+    workers = max(1,getattr(FLAGS,'workers',1))
+    net = build_eval_graph(model_configure,workers = workers)
+    if workers == 1:
+        decode_files(net,net.pipelines[0])
+    else:
+        errors = []
+        def decode_worker(pipe):
+            try:
+                decode_files(net,pipe)
+            except Exception as e:
+                errors.append(e)
+                raise
+        decoders = [threading.Thread(target=decode_worker,args=(pipe,)) for pipe in net.pipelines]
+        for decoder in decoders:
+            decoder.start()
+        for decoder in decoders:
+            decoder.join()
+        if errors:
+            raise RuntimeError("%d of the workers failed: %s"%(len(errors),errors[0]))
+    close_archives()
+    net.pbars.end()
+
+def decode_files(net,pipe):
+    """Decode the logits of the files fed into the pipeline, then assemble
+    and write the reads of every file."""
     val = defaultdict(dict)  # We could read vals out of order, that's why it's a dict
-    for f_i, name in enumerate(net.file_list):
+    for f_i, name in enumerate(pipe.file_list):
         start_time = time.time()
-        if (not name.endswith('.signal')) and (not name.endswith('.fast5')):
+        if not is_eval_input(name):
             continue
-        file_pre = os.path.splitext(name)[0]
+        archive_name, read_id = archive.split_entry_path(name)
+        if read_id is None:
+            file_pre = os.path.splitext(name)[0]
+        else:
+            file_pre = os.path.join(os.path.dirname(archive_name),read_id)
         input_path = os.path.join(net.file_dir, name)
             ###Other mode (like methylation) may use different read method.
         eval_data = read_data_for_eval(input_path, FLAGS.start,
@@ -401,11 +579,11 @@ def evaluation():
         if 'index_list' not in val[name].keys():
             val[name]['index_list'] = []
         while True:
-            l_sz, d_sz = net.sess.run([net.logits_queue_size, net.decode_queue_size])   
+            l_sz, d_sz = net.sess.run([pipe.logits_queue_size, pipe.decode_queue_size])   
             if val[name]['total_count'] == reads_n:
                 net.pbars.update(1,progress = val[name]['total_count'])
                 break
-            decode_ops = [net.decoded_fname_op, net.decode_idx_op, net.decode_predict_op, net.decode_prob_op]
+            decode_ops = [pipe.decoded_fname_op, pipe.decode_idx_op, pipe.decode_predict_op, pipe.decode_prob_op]
             decoded_fname, i, predict_val, logits_prob = net.sess.run(decode_ops, feed_dict={net.training: False})
             decoded_fname = np.asarray([x.decode("UTF-8") for x in decoded_fname])
             ##Have difficulties integrate it into the tensorflow graph, as the number of file names in a batch is uncertain.
@@ -460,7 +638,6 @@ def evaluation():
                         basecall_time, assembly_time]
         write_output(bpreads, c_bpread, list_of_time, file_pre, concise=FLAGS.concise, suffix=FLAGS.extension,
                      q_score=qs_string,global_setting=FLAGS)
-    net.pbars.end()
 
 def decoding_queue(logits_queue, num_threads=6):
     """
@@ -477,11 +654,11 @@ def decoding_queue(logits_queue, num_threads=6):
         decodeedQueue.size(): The number of instances in the queue.
     """
     q_logits, q_name, q_index, seq_length = logits_queue.dequeue()
-    batch_n = q_logits.get_shape().as_list()[0]
+    batch_n = tf.shape(q_logits)[0]
     if FLAGS.extension == 'fastq':
         prob = path_prob(q_logits)
     else:
-        prob = tf.constant([0.0]*batch_n)  # We just need to have the right type, because of the queues
+        prob = tf.zeros([batch_n])  # We just need to have the right type, because of the queues
     if FLAGS.beam == 0:
         decode_decoded, decode_log_prob = tf.nn.ctc_greedy_decoder(tf.transpose(
             q_logits, perm=[1, 0, 2]), seq_length, merge_repeated=True)
@@ -522,6 +699,43 @@ def decoding_queue(logits_queue, num_threads=6):
     return decode_predict, decode_prob, decode_fname, decode_idx, decodeedQueue.size()
 
 
+class QueueFileList(object):
+    """
+    The file list of a pipeline, the files are pulled lazily from a queue
+    shared by all the pipelines until a None is got. The list is iterated
+    by both the feeding thread and the decoding loop, so the pulled files are
+    kept and every iterator gets the same files in the same order.
+    Args:
+        file_queue: A queue of the file names.
+    """
+    def __init__(self,file_queue):
+        self.file_queue = file_queue
+        self.files = []
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def _get(self,i):
+        with self.lock:
+            while len(self.files) <= i and not self.finished:
+                name = self.file_queue.get()
+                if name is None:
+                    self.finished = True
+                else:
+                    self.files.append(name)
+            return self.files[i] if i < len(self.files) else None
+
+    def __iter__(self):
+        i = 0
+        while True:
+            name = self._get(i)
+            if name is None:
+                return
+            yield name
+            i += 1
+
+    def __len__(self):
+        return len(self.files)
+
 def run(args):
     global FLAGS
     FLAGS = args
@@ -551,7 +765,7 @@ if __name__ == "__main__":
     parser.add_argument('-o', '--output', required = True,
                         help="Output Folder name")
     parser.add_argument('-m', '--model', required = True,
-                        help="model folder path")
+                        help="model folder path, or a frozen graph .pb file given by chiron freeze")
     parser.add_argument('-s', '--start', type=int, default=None,
                         help="Start index of the signal file.")
     parser.add_argument('-b', '--batch_size', type=int, default=None,
@@ -562,6 +776,8 @@ if __name__ == "__main__":
                         help="Step size for segment")
     parser.add_argument('-t', '--threads', type=int, default=None,
                         help="Threads number")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of basecalling pipelines, the pipelines run as threads sharing one model session, so the weights are loaded once.")
     parser.add_argument('--beam', type=int, default=None,
                         help="Beam width used in beam search decoder, default is 0, in which a greedy decoder is used. Recommend width:100, Large beam width give better decoding result but require longer decoding time.")
     parser.add_argument('-e', '--extension', default='fastq',
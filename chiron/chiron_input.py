@@ -10,17 +10,24 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 import collections
+import hashlib
 import os
 import sys
 import tempfile
+import threading
+import time
 
 import h5py
 import numpy as np
-from statsmodels import robust
 from six.moves import range
 from six.moves import zip
+from six.moves import queue
 import tensorflow as tf
 from chiron.utils import progress
+from chiron.utils import archive
+from chiron.utils import codec
+from chiron.utils.norm import mean_std
+from chiron.utils.norm import median_mad
 from chiron import __version__
 from packaging import version
 SIGNAL_DTYPE=np.int16
@@ -29,6 +36,7 @@ MIN_LABEL_LENGTH = 2
 MIN_SIGNAL_PRO = 0.3
 MEDIAN=0
 MEAN=1
+CACHE_VERSION=1
 class Flags(object):
     def __init__(self):
         self.max_segments_number = None
@@ -127,8 +135,10 @@ class DataSet(object):
                  label,
                  label_length,
                  for_eval=False,
+                 handle=None,
                  ):
-        """Custruct a DataSet."""
+        """Custruct a DataSet, handle is the h5py file the data is read
+        from, which is closed by close."""
         if for_eval == False:
             assert len(event) == len(label) and len(event_length) == len(
                 label_length) and len(event) == len(
@@ -144,6 +154,7 @@ class DataSet(object):
         self._index_in_epoch = 0
         self._for_eval = for_eval
         self._perm = np.arange(self._reads_n)
+        self._handle = handle
 
     @property
     def event(self):
@@ -181,6 +192,12 @@ class DataSet(object):
     def perm(self):
         return self._perm
 
+    def close(self):
+        """Close the h5py file the dataset is read from."""
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
     def read_into_memory(self, index):
         event = np.asarray(list(zip([self._event[i] for i in index],
                                     [self._event_length[i] for i in index])))
@@ -250,6 +267,210 @@ class DataSet(object):
             np.float32), seq_length, label_batch
 
 
+class BucketDataSet(object):
+    """
+    Length bucketed batches over a DataSet.
+    The samples are grouped by their signal length (and label length if
+    label_buckets > 1), every batch is drawn from a single bucket and the
+    signal is trimmed to the bucket boundary, so less padding is processed by
+    the network and the ctc loss.
+    """
+
+    def __init__(self, dataset, boundaries, batch_size, label_buckets=1):
+        """
+        Args:
+            dataset: A DataSet instance.
+            boundaries: A increasing list of the maximum signal length of each
+                bucket, the last boundary should be the full segment length.
+            batch_size: The size of the batches, every batch is full, a bucket
+                that has less than batch_size samples is merged into the next
+                longer bucket.
+            label_buckets: Number of label length buckets inside each signal
+                length bucket, split by the quantiles of the label length.
+        """
+        self._dataset = dataset
+        self._boundaries = sorted(boundaries)
+        self._batch_size = batch_size
+        self._reads_n = dataset.reads_n
+        self._epochs_completed = 0
+        self._index_in_epoch = 0
+        self._batches = list()
+        event_length = np.asarray(dataset.event_length[:])
+        label_length = np.asarray(dataset.label_length[:])
+        if len(event_length) and event_length.max() > self._boundaries[-1]:
+            raise ValueError("The longest signal %d exceed the last bucket boundary %d."
+                             % (event_length.max(), self._boundaries[-1]))
+        sig_bucket = np.searchsorted(self._boundaries, event_length)
+        if label_buckets > 1:
+            label_bound = np.percentile(label_length,
+                                        np.linspace(0, 100, label_buckets + 1)[1:-1])
+            label_bucket = np.searchsorted(label_bound, label_length)
+        else:
+            label_bucket = np.zeros(len(label_length), dtype=int)
+        self._buckets = dict()
+        for l_idx in np.unique(label_bucket):
+            carry = np.asarray([], dtype=int)
+            for s_idx in range(len(self._boundaries)):
+                members = np.where((sig_bucket == s_idx) & (label_bucket == l_idx))[0]
+                members = np.concatenate((carry, members))
+                if len(members) < batch_size and s_idx < len(self._boundaries) - 1:
+                    carry = members
+                    continue
+                carry = np.asarray([], dtype=int)
+                if len(members):
+                    self._buckets[(s_idx, l_idx)] = members
+
+    @property
+    def boundaries(self):
+        return self._boundaries
+
+    @property
+    def reads_n(self):
+        return self._reads_n
+
+    @property
+    def epochs_completed(self):
+        return self._epochs_completed
+
+    @property
+    def index_in_epoch(self):
+        return self._index_in_epoch
+
+    @property
+    def bucket_sizes(self):
+        """A dict of (signal bucket boundary, label bucket index) -> number of samples."""
+        return dict(((self._boundaries[s_idx], l_idx), len(members))
+                    for (s_idx, l_idx), members in self._buckets.items())
+
+    def _schedule(self, shuffle):
+        """Split every bucket into full batches, the last batch of a bucket is
+        completed with other samples from the same bucket."""
+        batches = list()
+        for (s_idx, _), members in self._buckets.items():
+            members = np.copy(members)
+            if shuffle:
+                np.random.shuffle(members)
+            tail = len(members) % self._batch_size
+            if tail:
+                fill = np.random.choice(members, self._batch_size - tail)
+                members = np.concatenate((members, fill))
+            for start in range(0, len(members), self._batch_size):
+                batches.append((s_idx, members[start:start + self._batch_size]))
+        if shuffle:
+            np.random.shuffle(batches)
+        return batches
+
+    def next_batch(self, batch_size=None, shuffle=True):
+        """Return next batch from a single bucket.
+        Output Args:
+            inputX: [batch_size,bucket_boundary] float32 signal, the second dimension
+                give the bucket the batch come from.
+            sequence_length: [batch_size] int32 signal length.
+            label_batch: sparse label tuple (indx,vals,shape).
+        """
+        if batch_size is not None and batch_size != self._batch_size:
+            raise ValueError("The batch size of a BucketDataSet is fixed to %d." % (self._batch_size))
+        if len(self._batches) == 0:
+            if self._index_in_epoch > 0:
+                self._epochs_completed += 1
+                self._index_in_epoch = 0
+            self._batches = self._schedule(shuffle)
+        s_idx, index = self._batches.pop()
+        self._index_in_epoch += len(index)
+        event_batch, label_batch = self._dataset.read_into_memory(index)
+        label_batch = batch2sparse(label_batch)
+        seq_length = event_batch[:, 1].astype(np.int32)
+        event_batch = np.vstack(event_batch[:, 0]).astype(np.float32)
+        return event_batch[:, :self._boundaries[s_idx]], seq_length, label_batch
+
+
+class BatchPrefetcher(object):
+    """
+    Prepare the batches of a DataSet ahead of the training loop.
+    A background thread keeps calling DataSet.next_batch (which also build the
+    sparse label) and put the result into a bounded queue, so the next batch is
+    ready when the session finish the current step. The DataSet is not thread
+    safe, so only one producer thread is created for each DataSet.
+    """
+
+    def __init__(self, dataset, batch_size, capacity=5, shuffle=True):
+        """
+        Args:
+            dataset: A DataSet instance.
+            batch_size: The size of the batches.
+            capacity: Maximum number of batches prepared ahead.
+            shuffle: boolean, indicate if the data should be shuffled after each epoch.
+        """
+        self._dataset = dataset
+        self._batch_size = batch_size
+        self._shuffle = shuffle
+        self._queue = queue.Queue(maxsize=capacity)
+        self._stop_event = threading.Event()
+        self._epochs_completed = dataset.epochs_completed
+        self._index_in_epoch = dataset.index_in_epoch
+        self.stall_time = 0.0
+        self.stall_n = 0
+        self._thread = threading.Thread(target=self._produce)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def dataset(self):
+        return self._dataset
+
+    @property
+    def reads_n(self):
+        return self._dataset.reads_n
+
+    @property
+    def epochs_completed(self):
+        """Epochs completed by the batches that have been consumed."""
+        return self._epochs_completed
+
+    @property
+    def index_in_epoch(self):
+        return self._index_in_epoch
+
+    def _produce(self):
+        while not self._stop_event.is_set():
+            try:
+                batch = self._dataset.next_batch(self._batch_size,
+                                                 shuffle=self._shuffle)
+                item = (batch,
+                        self._dataset.epochs_completed,
+                        self._dataset.index_in_epoch)
+            except Exception as e:
+                item = e
+            while not self._stop_event.is_set():
+                try:
+                    self._queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if isinstance(item, Exception):
+                return
+
+    def next_batch(self):
+        """Return the next prepared batch, same output as DataSet.next_batch.
+        The time spent on waiting for the producer is accumulated in stall_time.
+        """
+        start = time.time()
+        stalled = self._queue.empty()
+        item = self._queue.get()
+        if stalled:
+            self.stall_time += time.time() - start
+            self.stall_n += 1
+        if isinstance(item, Exception):
+            raise item
+        batch, self._epochs_completed, self._index_in_epoch = item
+        return batch
+
+    def close(self):
+        """Stop the producer thread."""
+        self._stop_event.set()
+        self._thread.join()
+
+
 def read_data_for_eval(file_path, 
 					   start_index=0,
                        step=20, 
@@ -257,14 +478,14 @@ def read_data_for_eval(file_path,
                        reverse_fast5 = False):
     """
     Input Args:
-        file_path: file path to a signal/fast5 file.
+        file_path: file path to a signal/fast5 file, or a read in a read archive given by archive.entry_path.
         start_index: the index of the signal start to read.
         step: sliding step size.
         seg_length: length of segments.
         sig_norm: The way signal being normalized, keep it the same as it during training.
         reverse_fast5: if the signal need to be reversed from a fast5 file.
     """
-    if file_path.endswith('.signal'):
+    if file_path.endswith('.signal') or archive.ARCHIVE_SEP in file_path:
         f_signal = read_signal(file_path, normalize=FLAGS.sig_norm)
     elif file_path.endswith('.fast5'):
         f_signal = read_signal_fast5(file_path, normalize=FLAGS.sig_norm)
@@ -297,7 +518,7 @@ def read_cache_dataset(h5py_file_path):
     time for parallel reading, this will give you N dependent dataset reader,
     each reader read independently from the h5py file."""
     hdf5_record = h5py.File(h5py_file_path, "r")
-    event_h = hdf5_record['event/record']
+    event_h = codec.records(hdf5_record['event/record'])
     event_length_h = hdf5_record['event/length']
     label_h = hdf5_record['label/record']
     label_length_h = hdf5_record['label/length']
@@ -312,7 +533,286 @@ def read_cache_dataset(h5py_file_path):
     label_length = biglist(data_handle=label_length_h, length=label_len,
                            cache=True)
     return DataSet(event=event, event_length=event_length, label=label,
-                   label_length=label_length)
+                   label_length=label_length, handle=hdf5_record)
+
+
+def cache_dataset_pipeline(h5py_file_path,
+                           batch_size,
+                           shuffle=True,
+                           chunk_size=4096,
+                           parallel_reads=4,
+                           shuffle_buffer_bytes=2**28,
+                           prefetch=4,
+                           sparse_label=True):
+    """Build a tf.data pipeline over the hdf5 cache file generated by read_raw_data_sets.
+    The cache is read in chunks of chunk_size records, the chunks are read by
+    parallel_reads interleaved readers, so no feed_dict copy or queue runner
+    warm-up is needed.
+    Args:
+        h5py_file_path: The hdf5 cache file.
+        batch_size: The size of the batches.
+        shuffle: If shuffle the chunks and the records.
+        chunk_size: Number of records read in one hdf5 slicing.
+        parallel_reads: Number of chunks being read in parallel.
+        shuffle_buffer_bytes: Size of the shuffle buffer in bytes.
+        prefetch: Number of batches prepared ahead.
+        sparse_label: If True the label is converted to a SparseTensor in the
+            graph, otherwise a dense Tensor padded with -1 is given.
+    Return:
+        A tf.data.Dataset give batches of (signal,signal_length,label),
+        signal: [batch_size,seq_length] float32 Tensor.
+        signal_length: [batch_size] int32 Tensor.
+        label: SparseTensor or [batch_size,max_label_length] int32 Tensor.
+    """
+    with h5py.File(h5py_file_path, 'r') as hdf5_record:
+        reads_n = len(hdf5_record['event/length'])
+        seq_length = codec.records(hdf5_record['event/record']).shape[1]
+        label_width = hdf5_record['label/record'].shape[1]
+    if reads_n == 0:
+        raise ValueError("No record found in the cache file %s." % (h5py_file_path))
+    record_bytes = 4 * (seq_length + label_width + 2)
+
+    def read_chunk(chunk_start):
+        chunk_start = int(chunk_start)
+        chunk_end = min(chunk_start + chunk_size, reads_n)
+        with h5py.File(h5py_file_path, 'r') as hdf5_record:
+            event = codec.records(hdf5_record['event/record'])[chunk_start:chunk_end]
+            event_length = hdf5_record['event/length'][chunk_start:chunk_end]
+            label = hdf5_record['label/record'][chunk_start:chunk_end]
+            label_length = hdf5_record['label/length'][chunk_start:chunk_end]
+        for i in range(chunk_end - chunk_start):
+            yield (event[i].astype(np.float32),
+                   np.int32(event_length[i]),
+                   label[i][:label_length[i]].astype(np.int32))
+
+    def chunk_dataset(chunk_start):
+        return tf.data.Dataset.from_generator(
+            read_chunk,
+            output_types=(tf.float32, tf.int32, tf.int32),
+            output_shapes=([seq_length], [], [None]),
+            args=(chunk_start,))
+
+    dataset = tf.data.Dataset.range(0, reads_n, chunk_size)
+    if shuffle:
+        dataset = dataset.shuffle(reads_n // chunk_size + 1)
+    dataset = dataset.repeat()
+    dataset = dataset.interleave(chunk_dataset,
+                                 cycle_length=parallel_reads,
+                                 block_length=1,
+                                 num_parallel_calls=parallel_reads)
+    if shuffle:
+        dataset = dataset.shuffle(max(1, shuffle_buffer_bytes // record_bytes))
+    dataset = dataset.padded_batch(batch_size,
+                                   padded_shapes=([seq_length], [], [None]),
+                                   padding_values=(0.0, 0, -1),
+                                   drop_remainder=True)
+    if sparse_label:
+        dataset = dataset.map(
+            lambda signal, signal_len, label: (signal, signal_len, dense2sparse(label)),
+            num_parallel_calls=parallel_reads)
+    return dataset.prefetch(prefetch)
+
+
+def dense2sparse(label):
+    """Transfer a dense label Tensor padded with -1 to a SparseTensor in the graph.
+    Args:
+        label: Tensor of shape [batch_size, LABEL_LEN], padded with -1.
+    Returns:
+        SparseTensor, the sparse format of the label.
+    """
+    idx = tf.where(tf.not_equal(label, -1))
+    return tf.SparseTensor(idx,
+                           tf.gather_nd(label, idx),
+                           tf.shape(label, out_type=tf.int64))
+
+
+def cache_fingerprint(seq_length,
+                      k_mer=1,
+                      skip_start=10,
+                      max_segments_num=None):
+    """Fingerprint of the parameters that decide the content of a training cache.
+    Args:
+        seq_length: The segment length.
+        k_mer: The k-mer size of the label.
+        skip_start: Number of labels skipped at the start and end of a read.
+        max_segments_num: Maximum number of segments in the cache.
+    Return:
+        A hex digest string.
+    """
+    # Labels are read with skip_start no less than the k-mer window (see
+    # read_label), so the caches of the two skip_start are the same.
+    skip_start = max(skip_start, int((k_mer - 1) / 2))
+    params = "version=%s;seq_length=%d;k_mer=%d;skip_start=%d;sig_norm=%s;max_segments=%s;min_signal_pro=%s;min_label_length=%d" % (
+        CACHE_VERSION, seq_length, int(k_mer), skip_start, FLAGS.sig_norm,
+        max_segments_num, MIN_SIGNAL_PRO, MIN_LABEL_LENGTH)
+    return hashlib.sha1(params.encode('utf-8')).hexdigest()
+
+
+def file_fingerprint(*file_paths):
+    """Fingerprint a group of input files by their path, size and modification time."""
+    entries = list()
+    for file_path in file_paths:
+        if os.path.isfile(file_path):
+            stat = os.stat(file_path)
+            entries.append("%s:%d:%d" % (os.path.abspath(file_path),
+                                         stat.st_size,
+                                         int(stat.st_mtime * 1e6)))
+        else:
+            entries.append("%s:missing" % (os.path.abspath(file_path)))
+    return "|".join(entries)
+
+
+def signal_label_pairs(data_dir):
+    """
+    Find the signal and label files under data_dir, both the text format
+    (.signal, .label) and the binary format (.signal.npy, .label.npy) written
+    by chiron export are recognized. The reads in a read archive are given
+    as archive entry paths (see archive.entry_path), data_dir can also be a
+    read archive file.
+    Return:
+        A dict map the file_fingerprint of a pair to the (signal, label) paths.
+    """
+    file_pairs = dict()
+    if os.path.isfile(data_dir):
+        archive_files = [data_dir]
+    else:
+        archive_files = []
+    for root, dirs, files in os.walk(data_dir, topdown=False):
+        for name in files:
+            if name.endswith(archive.ARCHIVE_SUFFIX):
+                archive_files.append(os.path.join(root,name))
+                continue
+            elif name.endswith(".signal"):
+                label_name = name[:-len(".signal")] + '.label'
+            elif name.endswith(".signal.npy"):
+                label_name = name[:-len(".signal.npy")] + '.label.npy'
+            else:
+                continue
+            signal_f = os.path.join(root,name)
+            label_f = os.path.join(root,label_name)
+            file_pairs[file_fingerprint(signal_f,label_f)] = (signal_f,label_f)
+    for archive_f in archive_files:
+        if not archive.is_archive(archive_f):
+            continue
+        archive_fingerprint = file_fingerprint(archive_f)
+        for read_id in open_archive(archive_f).read_ids:
+            entry = archive.entry_path(archive_f,read_id)
+            file_pairs[archive_fingerprint + archive.ARCHIVE_SEP + read_id] = (entry,entry)
+    return file_pairs
+
+
+_ARCHIVES = dict()
+_ARCHIVES_LOCK = threading.Lock()
+def open_archive(archive_path):
+    """Open a read archive for reading, the handle is kept for later reads."""
+    archive_path = os.path.abspath(archive_path)
+    with _ARCHIVES_LOCK:
+        if archive_path not in _ARCHIVES:
+            _ARCHIVES[archive_path] = archive.ReadArchive(archive_path,mode='r')
+        return _ARCHIVES[archive_path]
+
+
+def close_archives():
+    """Close the read archives opened by open_archive."""
+    with _ARCHIVES_LOCK:
+        for read_archive in _ARCHIVES.values():
+            read_archive.close()
+        _ARCHIVES.clear()
+
+
+def cache_info(h5py_file_path):
+    """Read the fingerprint of a cache file.
+    Return:
+        (fingerprint, complete, file_fingerprints), fingerprint is None if the
+        file is not a cache file generated with a fingerprint.
+    """
+    try:
+        with h5py.File(h5py_file_path, 'r') as hdf5_record:
+            if 'fingerprint' not in hdf5_record.attrs:
+                return None, False, set()
+            fingerprint = codec.to_str(hdf5_record.attrs['fingerprint'])
+            complete = bool(hdf5_record.attrs['complete'])
+            files = set([codec.to_str(x) for x in hdf5_record['files/fingerprint'][:]])
+    except (IOError, OSError, KeyError):
+        return None, False, set()
+    return fingerprint, complete, files
+
+
+def _open_cache(h5py_file_path, fingerprint, seq_length, input_files, compressor=None):
+    """
+    Open the cache file for writing. The existing cache is kept if it was
+    completely written with the same fingerprint and none of its input files
+    has been changed or removed, otherwise it is rebuilt from scratch.
+    Args:
+        h5py_file_path: The cache file path.
+        fingerprint: Parameter fingerprint given by cache_fingerprint.
+        seq_length: The segment length.
+        input_files: Current set of input file fingerprints.
+        compressor: If not None, the signal segments of a new cache are stored
+            encoded by the signal codec with this compressor (zlib or lzma).
+    Return:
+        (hdf5_record, done_files), the opened hdf5 file and the set of file
+        fingerprints that already in the cache.
+    """
+    done_files = set()
+    if os.path.isfile(h5py_file_path):
+        cached_fingerprint, complete, cached_files = cache_info(h5py_file_path)
+        if cached_fingerprint == fingerprint and complete and cached_files.issubset(input_files):
+            done_files = cached_files
+        else:
+            os.remove(h5py_file_path)
+    hdf5_record = h5py.File(h5py_file_path, "a")
+    if len(done_files) == 0 and 'event/record' not in hdf5_record:
+        if compressor is None:
+            hdf5_record.create_dataset('event/record', dtype='float32', shape=(0, seq_length),
+                                       maxshape=(None, seq_length))
+        else:
+            codec.create_encoded_records(hdf5_record, 'event/record', seq_length,
+                                         compressor=compressor)
+        hdf5_record.create_dataset('event/length', dtype='int32', shape=(0,), maxshape=(None,),
+                                   chunks=True)
+        hdf5_record.create_dataset('label/record', dtype='int32',
+                                   shape=(0, 0),
+                                   maxshape=(None, seq_length))
+        hdf5_record.create_dataset('label/length',
+                                   dtype='int32', shape=(0,),
+                                   maxshape=(None,))
+        hdf5_record.create_dataset('files/fingerprint',
+                                   dtype=h5py.special_dtype(vlen=str),
+                                   shape=(0,),
+                                   maxshape=(None,))
+        hdf5_record.attrs['fingerprint'] = fingerprint
+    hdf5_record.attrs['complete'] = False
+    return hdf5_record, done_files
+
+
+def _close_cache(hdf5_record, new_files):
+    """Record the newly added input files and mark the cache as complete."""
+    files_h = hdf5_record['files/fingerprint']
+    new_files = sorted(new_files)
+    files_h.resize(len(files_h) + len(new_files), axis=0)
+    if len(new_files):
+        files_h[-len(new_files):] = new_files
+    hdf5_record.attrs['complete'] = True
+    hdf5_record.close()
+
+
+def _cache_lists(hdf5_record):
+    lists = list()
+    for entry in ['event/record', 'event/length', 'label/record', 'label/length']:
+        handle = codec.records(hdf5_record[entry])
+        lists.append(biglist(data_handle=handle,
+                             length=len(handle),
+                             cache=len(handle) > 0,
+                             max_len=FLAGS.MAXLEN))
+    return lists
+
+
+def _flush_cache_lists(lists):
+    for holder in lists:
+        holder.save_rest()
+        if not holder.cache and len(holder.holder) != 0:
+            holder.save()
 
 
 def read_tfrecord(data_dir, 
@@ -321,7 +821,8 @@ def read_tfrecord(data_dir,
                   seq_length=300, 
                   k_mer=1, 
                   max_segments_num=None,
-                  skip_start = 10):
+                  skip_start = 10,
+                  compressor = None):
     ###This method deprecated please use read_raw_data_sets instead
     ###Read from raw data
     count_bar = progress.multi_pbars("Extract tfrecords")
@@ -331,99 +832,85 @@ def read_tfrecord(data_dir,
     if h5py_file_path is None:
         h5py_file_path = tempfile.mkdtemp() + '/temp_record.hdf5'
     else:
+        h5py_file_path = os.path.abspath(h5py_file_path)
+        if not os.path.isdir(os.path.dirname(h5py_file_path)):
+            os.mkdir(os.path.dirname(h5py_file_path))
+    tfrecords_filename = data_dir + tfrecord
+    fingerprint = cache_fingerprint(seq_length, k_mer, skip_start, max_segments_num)
+    input_files = set([file_fingerprint(tfrecords_filename)])
+    hdf5_record, done_files = _open_cache(h5py_file_path, fingerprint, seq_length, input_files, compressor)
+    if done_files == input_files:
+        sys.stdout.write("Reuse the cached dataset %s.\n" % (h5py_file_path))
+        _close_cache(hdf5_record, [])
+        count_bar.end()
+        return read_cache_dataset(h5py_file_path)
+    event, event_length, label, label_length = _cache_lists(hdf5_record)
+    count = 0
+    file_count = 0
+
+    record_iterator = tf.python_io.tf_record_iterator(path=tfrecords_filename)
+
+    for string_record in record_iterator:
+        
+        example = tf.train.Example()
+        example.ParseFromString(string_record)
+        
+        raw_data_string = (example.features.feature['raw_data']
+                                      .bytes_list
+                                      .value[0])
+        features_string = (example.features.feature['features']
+                                    .bytes_list
+                                    .value[0])
+        fn_string = (example.features.feature['fname'].bytes_list.value[0])
+
+        raw_data = np.frombuffer(raw_data_string, dtype=SIGNAL_DTYPE)
+        
+        features_data = np.frombuffer(features_string, dtype='S8')
+        # grouping the whole array into sub-array with size = 3
+        group_size = 3
+        features_data = [features_data[n:n+group_size] for n in range(0, len(features_data), group_size)]
+        f_signal = read_signal_tfrecord(raw_data,normalize = FLAGS.sig_norm)
+
+        if len(f_signal) == 0:
+            continue
+        #try:
+        f_label = read_label_tfrecord(features_data, skip_start=skip_start, window_n=(k_mer - 1) / 2)
+        #except:
+        #    sys.stdout.write("Read the label fail.Skipped.")
+        #    continue
         try:
-            os.remove(os.path.abspath(h5py_file_path))
-        except:
-            pass
-        if not os.path.isdir(os.path.dirname(os.path.abspath(h5py_file_path))):
-            os.mkdir(os.path.dirname(os.path.abspath(h5py_file_path)))
-    with h5py.File(h5py_file_path, "a") as hdf5_record:
-        event_h = hdf5_record.create_dataset('event/record', dtype='float32', shape=(0, seq_length),
-                                             maxshape=(None, seq_length))
-        event_length_h = hdf5_record.create_dataset('event/length', dtype='int32', shape=(0,), maxshape=(None,),
-                                                    chunks=True)
-        label_h = hdf5_record.create_dataset('label/record', dtype='int32', shape=(0, 0), maxshape=(None, seq_length))
-        label_length_h = hdf5_record.create_dataset('label/length', dtype='int32', shape=(0,), maxshape=(None,))
-        event = biglist(data_handle=event_h, max_len=FLAGS.MAXLEN)
-        event_length = biglist(data_handle=event_length_h, max_len=FLAGS.MAXLEN)
-        label = biglist(data_handle=label_h, max_len=FLAGS.MAXLEN)
-        label_length = biglist(data_handle=label_length_h, max_len=FLAGS.MAXLEN)
-        count = 0
-        file_count = 0
-
-        tfrecords_filename = data_dir + tfrecord
-        record_iterator = tf.python_io.tf_record_iterator(path=tfrecords_filename)
-
-        for string_record in record_iterator:
-            
-            example = tf.train.Example()
-            example.ParseFromString(string_record)
-            
-            raw_data_string = (example.features.feature['raw_data']
-                                          .bytes_list
-                                          .value[0])
-            features_string = (example.features.feature['features']
-                                        .bytes_list
-                                        .value[0])
-            fn_string = (example.features.feature['fname'].bytes_list.value[0])
-
-            raw_data = np.frombuffer(raw_data_string, dtype=SIGNAL_DTYPE)
-            
-            features_data = np.frombuffer(features_string, dtype='S8')
-            # grouping the whole array into sub-array with size = 3
-            group_size = 3
-            features_data = [features_data[n:n+group_size] for n in range(0, len(features_data), group_size)]
-            f_signal = read_signal_tfrecord(raw_data,normalize = FLAGS.sig_norm)
+            tmp_event, tmp_event_length, tmp_label, tmp_label_length = read_raw(f_signal, f_label, seq_length)
+        except Exception as e:
+            print("Extract label from %s fail, label position exceed max signal length."%(fn_string))
+            raise e
+        event += tmp_event
+        event_length += tmp_event_length
+        label += tmp_label
+        label_length += tmp_label_length
+        del tmp_event
+        del tmp_event_length
+        del tmp_label
+        del tmp_label_length
+        count = len(event)
+        if file_count % 10 == 0:
+            if max_segments_num is not None:
+                count_bar.update(0,progress = count,total = max_segments_num)
+                count_bar.update_bar()
+                if len(event) > max_segments_num:
+                    event.resize(max_segments_num)
+                    label.resize(max_segments_num)
+                    event_length.resize(max_segments_num)
 
-            if len(f_signal) == 0:
-                continue
-            #try:
-            f_label = read_label_tfrecord(features_data, skip_start=skip_start, window_n=(k_mer - 1) / 2)
-            #except:
-            #    sys.stdout.write("Read the label fail.Skipped.")
-            #    continue
-            try:
-                tmp_event, tmp_event_length, tmp_label, tmp_label_length = read_raw(f_signal, f_label, seq_length)
-            except Exception as e:
-                print("Extract label from %s fail, label position exceed max signal length."%(fn_string))
-                raise e
-            event += tmp_event
-            event_length += tmp_event_length
-            label += tmp_label
-            label_length += tmp_label_length
-            del tmp_event
-            del tmp_event_length
-            del tmp_label
-            del tmp_label_length
-            count = len(event)
-            if file_count % 10 == 0:
-                if max_segments_num is not None:
-                    count_bar.update(0,progress = count,total = max_segments_num)
-                    count_bar.update_bar()
-                    if len(event) > max_segments_num:
-                        event.resize(max_segments_num)
-                        label.resize(max_segments_num)
-                        event_length.resize(max_segments_num)
-
-                        label_length.resize(max_segments_num)
-                        break
-                else:
-                    count_bar.update(0,progress = count,total = count)
-                    count_bar.update_bar()
-            file_count += 1
-        if event.cache:
-            event.save_rest()
-            event_length.save_rest()
-            label.save_rest()
-            label_length.save_rest()
-            train = read_cache_dataset(h5py_file_path)
-        else:
-            event.save()
-            event_length.save()
-            label.save()
-            label_length.save()
-            train = read_cache_dataset(h5py_file_path)
-        count_bar.end()
+                    label_length.resize(max_segments_num)
+                    break
+            else:
+                count_bar.update(0,progress = count,total = count)
+                count_bar.update_bar()
+        file_count += 1
+    _flush_cache_lists([event, event_length, label, label_length])
+    _close_cache(hdf5_record, input_files)
+    train = read_cache_dataset(h5py_file_path)
+    count_bar.end()
     return train
             
 def read_raw_data_sets(data_dir, 
@@ -431,7 +918,16 @@ def read_raw_data_sets(data_dir,
                        seq_length=300, 
                        k_mer=1, 
                        max_segments_num=FLAGS.max_segments_number,
-                       skip_start = 10):
+                       skip_start = 10,
+                       compressor = None):
+    """
+    Read the signal and label files under data_dir into a hdf5 cache file.
+    If h5py_file_path already hold a cache built with the same parameters
+    (see cache_fingerprint), the cache is reused and only the new signal files
+    are appended to it, a cache whose input files have been changed or removed
+    is rebuilt. If compressor is given (zlib or lzma), the signal segments of a
+    new cache are stored encoded by the signal codec (see utils/codec.py).
+    """
     ###Read from raw data
     count_bar = progress.multi_pbars("Extract tfrecords")
     if max_segments_num is None:
@@ -440,103 +936,265 @@ def read_raw_data_sets(data_dir,
     if h5py_file_path is None:
         h5py_file_path = tempfile.mkdtemp() + '/temp_record.hdf5'
     else:
+        h5py_file_path = os.path.abspath(h5py_file_path)
+        if not os.path.isdir(os.path.dirname(h5py_file_path)):
+            os.mkdir(os.path.dirname(h5py_file_path))
+    file_pairs = signal_label_pairs(data_dir)
+    fingerprint = cache_fingerprint(seq_length, k_mer, skip_start, max_segments_num)
+    hdf5_record, done_files = _open_cache(h5py_file_path, fingerprint, seq_length, set(file_pairs.keys()), compressor)
+    event, event_length, label, label_length = _cache_lists(hdf5_record)
+    new_files = [x for x in file_pairs.keys() if x not in done_files]
+    if len(done_files):
+        sys.stdout.write("Reuse the cached dataset %s with %d files, %d new files found.\n" % (h5py_file_path, len(done_files), len(new_files)))
+    if max_segments_num is not None and len(event) >= max_segments_num:
+        new_files = []
+    count = len(event)
+    file_count = 0
+    added_files = list()
+    for fingerprint in new_files:
+        added_files.append(fingerprint)
+        signal_f,label_f = file_pairs[fingerprint]
+        name = os.path.basename(signal_f)
+        f_signal = read_signal(signal_f,normalize = FLAGS.sig_norm)
+        if len(f_signal) == 0:
+            continue
         try:
-            os.remove(os.path.abspath(h5py_file_path))
+            f_label = read_label(label_f,
+                                 skip_start=skip_start,
+                                 window_n=int((k_mer - 1) / 2))
         except:
-            pass
-        if not os.path.isdir(os.path.dirname(os.path.abspath(h5py_file_path))):
-            os.mkdir(os.path.dirname(os.path.abspath(h5py_file_path)))
-    with h5py.File(h5py_file_path, "a") as hdf5_record:
-        event_h = hdf5_record.create_dataset('event/record', dtype='float32', shape=(0, seq_length),
-                                             maxshape=(None, seq_length))
-        event_length_h = hdf5_record.create_dataset('event/length', dtype='int32', shape=(0,), maxshape=(None,),
-                                                    chunks=True)
-        label_h = hdf5_record.create_dataset('label/record', dtype='int32',
-                                             shape=(0, 0),
-                                             maxshape=(None, seq_length))
-        label_length_h = hdf5_record.create_dataset('label/length',
-                                                    dtype='int32', shape=(0,),
-                                                    maxshape=(None,))
-        event = biglist(data_handle=event_h, max_len=FLAGS.MAXLEN)
-        event_length = biglist(data_handle=event_length_h, max_len=FLAGS.MAXLEN)
-        label = biglist(data_handle=label_h, max_len=FLAGS.MAXLEN)
-        label_length = biglist(data_handle=label_length_h, max_len=FLAGS.MAXLEN)
-        count = 0
-        file_count = 0
-        for root, dirs, files in os.walk(data_dir, topdown=False):
-           for name in files:
-            if name.endswith(".signal"):
-                file_pre = os.path.splitext(name)[0]
-                signal_f = os.path.join(root,name)
-                f_signal = read_signal(signal_f,normalize = FLAGS.sig_norm)
-                label_f = os.path.join(root,file_pre+'.label')
-                if len(f_signal) == 0:
-                    continue
-                try:
-                    f_label = read_label(label_f,
-                                         skip_start=skip_start,
-                                         window_n=int((k_mer - 1) / 2))
-                except:
-                    sys.stdout.write("Read the label %s fail.Skipped." % (name))
-                    continue
-                try:
-                    tmp_event, tmp_event_length, tmp_label, tmp_label_length = read_raw(f_signal, f_label, seq_length)
-                except Exception as e:
-                    print("Extract label from %s fail, label position exceed max signal length."%(label_f))
-                    raise e
-                event += tmp_event
-                event_length += tmp_event_length
-                label += tmp_label
-                label_length += tmp_label_length
-                del tmp_event
-                del tmp_event_length
-                del tmp_label
-                del tmp_label_length
-                count = len(event)
-                if file_count % 10 == 0:
-                    if max_segments_num is not None:
-                        count_bar.update(0,progress = count,total = max_segments_num)
-                        count_bar.update_bar()
-                        if len(event) > max_segments_num:
-                            event.resize(max_segments_num)
-                            label.resize(max_segments_num)
-                            event_length.resize(max_segments_num)
-    
-                            label_length.resize(max_segments_num)
-                            break
-                    else:
-                        count_bar.update(0,progress = count,total = count)
-                        count_bar.update_bar()
-                file_count += 1
-        if event.cache:
-            event.save_rest()
-            event_length.save_rest()
-            label.save_rest()
-            label_length.save_rest()
-            train = read_cache_dataset(h5py_file_path)
-        else:
-            event.save()
-            event_length.save()
-            label.save()
-            label_length.save()
-            train = read_cache_dataset(h5py_file_path)
-        count_bar.end()
+            sys.stdout.write("Read the label %s fail.Skipped." % (name))
+            continue
+        try:
+            tmp_event, tmp_event_length, tmp_label, tmp_label_length = read_raw(f_signal, f_label, seq_length)
+        except Exception as e:
+            print("Extract label from %s fail, label position exceed max signal length."%(label_f))
+            raise e
+        event += tmp_event
+        event_length += tmp_event_length
+        label += tmp_label
+        label_length += tmp_label_length
+        del tmp_event
+        del tmp_event_length
+        del tmp_label
+        del tmp_label_length
+        count = len(event)
+        if file_count % 10 == 0:
+            if max_segments_num is not None:
+                count_bar.update(0,progress = count,total = max_segments_num)
+                count_bar.update_bar()
+                if len(event) > max_segments_num:
+                    event.resize(max_segments_num)
+                    label.resize(max_segments_num)
+                    event_length.resize(max_segments_num)
+
+                    label_length.resize(max_segments_num)
+                    break
+            else:
+                count_bar.update(0,progress = count,total = count)
+                count_bar.update_bar()
+        file_count += 1
+    _flush_cache_lists([event, event_length, label, label_length])
+    _close_cache(hdf5_record, added_files)
+    train = read_cache_dataset(h5py_file_path)
+    count_bar.end()
     return train
 
 
+def _append_h5(handle, values):
+    """Append a 1d array to the end of a resizable hdf5 dataset."""
+    values = np.asarray(values, dtype=handle.dtype)
+    if len(values) == 0:
+        return
+    length = len(handle)
+    handle.resize(length + len(values), axis=0)
+    handle[length:] = values
+
+
+def build_read_store(data_dir, store_path, flush_reads=100):
+    """
+    Store the normalized signal and the full label of every read under data_dir
+    into an indexed hdf5 file, so the dataset can be re-segmented with a
+    different skip_start (see read_store_data_sets) without parsing the signal
+    and label files again. The store is reused if it is complete and the input
+    files are unchanged.
+    Args:
+        data_dir: The folder contains the .signal and .label files.
+        store_path: The hdf5 file path of the read store.
+        flush_reads: Number of reads buffered before writing into the store.
+    Return:
+        The store_path.
+    """
+    store_path = os.path.abspath(store_path)
+    if not os.path.isdir(os.path.dirname(store_path)):
+        os.mkdir(os.path.dirname(store_path))
+    file_pairs = signal_label_pairs(data_dir)
+    fingerprint = hashlib.sha1(("version=%s;sig_norm=%s" % (CACHE_VERSION, FLAGS.sig_norm)).encode('utf-8')).hexdigest()
+    cached_fingerprint, complete, cached_files = cache_info(store_path)
+    if cached_fingerprint == fingerprint and complete and cached_files == set(file_pairs.keys()):
+        sys.stdout.write("Reuse the read store %s.\n" % (store_path))
+        return store_path
+    if os.path.isfile(store_path):
+        os.remove(store_path)
+    count_bar = progress.multi_pbars("Build read store")
+    with h5py.File(store_path, "a") as store:
+        signal_h = store.create_dataset('signal', dtype='float32', shape=(0,), maxshape=(None,), chunks=True)
+        start_h = store.create_dataset('label/start', dtype='int32', shape=(0,), maxshape=(None,), chunks=True)
+        length_h = store.create_dataset('label/length', dtype='int32', shape=(0,), maxshape=(None,), chunks=True)
+        base_h = store.create_dataset('label/base', dtype='int8', shape=(0,), maxshape=(None,), chunks=True)
+        signal_offset_h = store.create_dataset('index/signal_offset', dtype='int64', data=[0], maxshape=(None,), chunks=True)
+        label_offset_h = store.create_dataset('index/label_offset', dtype='int64', data=[0], maxshape=(None,), chunks=True)
+        files_h = store.create_dataset('files/fingerprint', dtype=h5py.special_dtype(vlen=str), shape=(0,), maxshape=(None,))
+        store.attrs['fingerprint'] = fingerprint
+        store.attrs['complete'] = False
+        buffers = [list(), list(), list(), list()]
+        signal_offset = [int(signal_offset_h[-1])]
+        label_offset = [int(label_offset_h[-1])]
+        def flush():
+            for handle, buffer in zip([signal_h, start_h, length_h, base_h], buffers):
+                if len(buffer):
+                    _append_h5(handle, np.concatenate(buffer))
+                del buffer[:]
+            _append_h5(signal_offset_h, signal_offset[1:])
+            _append_h5(label_offset_h, label_offset[1:])
+            del signal_offset[:-1]
+            del label_offset[:-1]
+        for file_count, (signal_f, label_f) in enumerate(file_pairs.values()):
+            f_signal = read_signal(signal_f, normalize = FLAGS.sig_norm)
+            if len(f_signal) == 0:
+                continue
+            try:
+                f_label = read_label(label_f, skip_start=0, window_n=0)
+            except:
+                sys.stdout.write("Read the label %s fail.Skipped." % (os.path.basename(label_f)))
+                continue
+            buffers[0].append(np.asarray(f_signal, dtype=np.float32))
+            buffers[1].append(np.asarray(f_label.start, dtype=np.int32))
+            buffers[2].append(np.asarray(f_label.length, dtype=np.int32))
+            buffers[3].append(np.asarray(f_label.base, dtype=np.int8))
+            signal_offset.append(signal_offset[-1] + len(f_signal))
+            label_offset.append(label_offset[-1] + len(f_label.start))
+            if len(signal_offset) > flush_reads:
+                flush()
+                count_bar.update(0, progress = file_count + 1, total = len(file_pairs))
+                count_bar.update_bar()
+        flush()
+        _append_h5(files_h, sorted(file_pairs.keys()))
+        store.attrs['complete'] = True
+    count_bar.end()
+    return store_path
+
+
+def read_store_data_sets(store_path,
+                         h5py_file_path=None,
+                         seq_length=300,
+                         k_mer=1,
+                         max_segments_num=None,
+                         skip_start=10,
+                         compressor=None):
+    """
+    Segment the reads in a read store (see build_read_store) into a hdf5 cache
+    file, this does the same thing as read_raw_data_sets but never touch the
+    signal and label files, used to resample the dataset with a new skip_start.
+    Args:
+        store_path: The read store built by build_read_store.
+        h5py_file_path: The output cache file.
+        seq_length: The segment length.
+        k_mer: The k-mer size of the label.
+        max_segments_num: Maximum number of segments in the cache.
+        skip_start: Skip the first and last n labels of each read.
+        compressor: Store the signal segments encoded with this compressor.
+    Return:
+        A DataSet read from the cache file.
+    """
+    if h5py_file_path is None:
+        h5py_file_path = tempfile.mkdtemp() + '/temp_record.hdf5'
+    h5py_file_path = os.path.abspath(h5py_file_path)
+    window_n = int((k_mer - 1) / 2)
+    skip_start = max(skip_start, window_n)
+    fingerprint = cache_fingerprint(seq_length, k_mer, skip_start, max_segments_num)
+    input_files = set([file_fingerprint(store_path)])
+    hdf5_record, done_files = _open_cache(h5py_file_path, fingerprint, seq_length, input_files, compressor)
+    if done_files == input_files:
+        _close_cache(hdf5_record, [])
+        return read_cache_dataset(h5py_file_path)
+    event, event_length, label, label_length = _cache_lists(hdf5_record)
+    with h5py.File(store_path, 'r') as store:
+        signal_offset = store['index/signal_offset'][:]
+        label_offset = store['index/label_offset'][:]
+        for read_i in range(len(signal_offset) - 1):
+            f_signal = store['signal'][signal_offset[read_i]:signal_offset[read_i + 1]]
+            label_slice = slice(label_offset[read_i], label_offset[read_i + 1])
+            start = store['label/start'][label_slice]
+            length = store['label/length'][label_slice]
+            all_base = store['label/base'][label_slice].astype(np.int64)
+            keep = np.arange(skip_start, len(all_base) - skip_start)
+            base = np.zeros(len(keep), dtype=np.int64)
+            for i in range(window_n * 2 + 1):
+                base = base * 4 + all_base[keep + i - window_n]
+            f_label = raw_labels(start=start[keep].tolist(),
+                                 length=length[keep].tolist(),
+                                 base=base.tolist())
+            tmp_event, tmp_event_length, tmp_label, tmp_label_length = read_raw(f_signal.tolist(), f_label, seq_length)
+            event += tmp_event
+            event_length += tmp_event_length
+            label += tmp_label
+            label_length += tmp_label_length
+            if max_segments_num is not None and len(event) > max_segments_num:
+                event.resize(max_segments_num)
+                label.resize(max_segments_num)
+                event_length.resize(max_segments_num)
+                label_length.resize(max_segments_num)
+                break
+    _flush_cache_lists([event, event_length, label, label_length])
+    _close_cache(hdf5_record, input_files)
+    return read_cache_dataset(h5py_file_path)
+
+
+class BackgroundTask(object):
+    """
+    Run a function in a background thread, used to rebuild the dataset while
+    the training continues.
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run,
+                                        args=(func, args, kwargs))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, args, kwargs):
+        try:
+            self._result = func(*args, **kwargs)
+        except Exception as e:
+            self._error = e
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def result(self):
+        """Wait for the task and return its result, re-raise the exception of the task."""
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
 def read_signal(file_path, normalize=None):
-    f_h = open(file_path, 'r')
-    signal = list()
-    for line in f_h:
-        signal += [np.float32(x) for x in line.split()]
-    signal = np.asarray(signal)
-    if len(signal) == 0:
-        return signal.tolist()
-    if normalize == MEAN:
-        signal = (signal - np.mean(signal)) / np.float(np.std(signal))
-    elif normalize == MEDIAN:
-        signal = (signal - np.median(signal)) / np.float(robust.mad(signal))
-    return signal.tolist()
+    archive_path, read_id = archive.split_entry_path(file_path)
+    if read_id is not None:
+        signal = open_archive(archive_path).signal(read_id)
+    elif file_path.endswith('.npy'):
+        signal = np.load(file_path).astype(np.float32)
+    else:
+        f_h = open(file_path, 'r')
+        signal = list()
+        for line in f_h:
+            signal += [np.float32(x) for x in line.split()]
+        signal = np.asarray(signal)
+    return normalize_signal(signal, normalize).tolist()
 
 def read_signal_fast5(fast5_path, normalize=None):
     """
@@ -545,43 +1203,53 @@ def read_signal_fast5(fast5_path, normalize=None):
     """
     root = h5py.File(fast5_path, 'r')
     signal = np.asarray(list(root['/Raw/Reads'].values())[0][('Signal')])
-    uniq_arr=np.unique(signal)
-    if len(signal) == 0:
-        return signal.tolist()
-    if normalize == MEAN:
-        signal = (signal - np.mean(uniq_arr)) / np.float(np.std(uniq_arr))
-    elif normalize == MEDIAN:
-        signal = (signal - np.median(uniq_arr)) / np.float(robust.mad(uniq_arr))
-    return signal.tolist()
+    return normalize_signal(signal, normalize, unique=True).tolist()
     
 def read_signal_tfrecord(data_array, normalize=None):
 
-    signal = data_array
-    uniq_arr=np.unique(signal)
+    return normalize_signal(data_array, normalize, unique=True).tolist()
+
+
+def normalize_signal(signal, normalize=None, unique=False):
+    """
+    Normalize the signal.
+    Args:
+        signal: 1D signal array.
+        normalize: MEAN, MEDIAN or None for no normalization.
+        unique: Estimate the center and scale from the unique values of the
+            signal.
+    """
+    signal = np.asarray(signal)
     if len(signal) == 0:
-        return signal.tolist()
+        return signal
     if normalize == MEAN:
-        signal = (signal - np.mean(uniq_arr)) / np.float(np.std(uniq_arr))
+        center, scale = mean_std(signal, unique=unique)
     elif normalize == MEDIAN:
-        signal = (signal - np.median(uniq_arr)) / np.float(robust.mad(uniq_arr))
-    return signal.tolist()
+        center, scale = median_mad(signal, unique=unique)
+    else:
+        return signal
+    return (signal - center) / float(scale)
 
 
 def read_label(file_path, skip_start=10, window_n=0):
-    f_h = open(file_path, 'r')
+    archive_path, read_id = archive.split_entry_path(file_path)
+    if read_id is not None:
+        records = [(x['start'], x['end'], x['base'].decode()) for x in open_archive(archive_path).label(read_id)]
+    elif file_path.endswith('.npy'):
+        records = [(x['start'], x['end'], x['base'].decode()) for x in np.load(file_path)]
+    else:
+        with open(file_path, 'r') as f_h:
+            records = [line.split() for line in f_h]
     start = list()
     length = list()
     base = list()
     all_base = list()
     if skip_start < window_n:
         skip_start = window_n
-    for line in f_h:
-        record = line.split()
+    for record in records:
         all_base.append(base2ind(record[2]))
-    f_h.seek(0, 0)  # Back to the start
     file_len = len(all_base)
-    for count, line in enumerate(f_h):
-        record = line.split()   
+    for count, record in enumerate(records):
         if count < skip_start or count > (file_len - skip_start - 1):
             continue
         start.append(int(record[0]))
@@ -792,6 +1460,9 @@ def test_chiron_dummy_input():
             self.unit=True
             self.min_bps = 0
             self.n_errors = 5
+            self.threads = 0
+            self.format = 'text'
+            self.retry_failed = False
     from chiron.utils import raw
     args = Args()
     raw.run(args)
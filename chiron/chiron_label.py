@@ -7,9 +7,14 @@ import argparse
 import numpy as np
 import subprocess
 import shlex
+import itertools
 import sys
 from multiprocessing import Pool
+from multiprocessing import Process
+from multiprocessing import Queue
+from six.moves import queue
 import tqdm
+from chiron.utils import dtw
 DATA_FORMAT = np.dtype([('raw','<i2'),
                         ('norm_raw','<f8'),
                         ('norm_trans','<f8'),
@@ -17,78 +22,94 @@ DATA_FORMAT = np.dtype([('raw','<i2'),
                         ('length','<i4'),
                         ('base','S1')]) 
 BASECALL_ENTRY = '/Analyses/Basecall_1D_000'
-RESQUIGGLE_METHODS = {'raw','cwdtw'}
+RESQUIGGLE_METHODS = {'raw','cwdtw','dtw'}
+MAP_PRESET = 'map-ont'
+MAP_BEST_N = 5
+# Number of fast5 files sent to a worker at once.
+TASK_CHUNK = 16
+# Number of lines of the polya TSV and the readdb parsed at once.
+INGEST_CHUNK = 50000
+# Number of records buffered for a writer process, and the seconds to wait on
+# its full queue before checking the writer is alive.
+WRITER_QUEUE = 64
+WRITER_TIMEOUT = 10
+ALIGNER = None
+KMER_MODEL = None
+THREAD_BUFFER = None
 class RUN_RECORD():
     def __init__(self):
         self.fail_align = []
         self.poor_qc = []
         self.sucess = []
-def read_tsv(tsv_file):
-    """
-    Read a Nanopolish TSV file.
-    Args:
-        tsv_file: nanopolish polya segmentation tsv file.
-    """
-    POLYA_FORMAT = [('position','<u8'),
-                ('leader_start','<f4'),
-                ('adapter_start','<f4'),
-                ('polya_start','<f4'),
-                ('transcript_start','<f4'),
-                ('read_rate','<f4'),
-                ('polya_length','<f4'),
-                ('qc_tag','a16')]
-    polya_seg= dict()
-    with open(tsv_file) as f:
-        headline = f.readline().strip().split()
-        for entry in headline:
-            polya_seg[entry] = list()
-        for line in f:
-            split_line = line.strip().split()
-            for idx,item in enumerate(split_line):
-                polya_seg[headline[idx]].append(item)
-    readnames = np.array(polya_seg['readname'])
-    contigs = np.array(polya_seg['contig'])
-    POLYA_FORMAT = [('readname',readnames.dtype),('contig',contigs.dtype)] + POLYA_FORMAT
-    return np.array(list(zip(readnames,
-                             contigs,
-                             polya_seg['position'],
-                             polya_seg['leader_start'],
-                             polya_seg['adapter_start'],
-                             polya_seg['polya_start'],
-                             polya_seg['transcript_start'],
-                             polya_seg['read_rate'],
-                             polya_seg['polya_length'],
-                             polya_seg['qc_tag'])),dtype = POLYA_FORMAT)
-def read_link(readdb_f):
-    """
-    Read the link from the readdb_file
-    Args:
-        readdb_f:File path of the readdb file generated by nanopolish.
-    """
-    dest_link = dict()
-    with open(readdb_f) as f:
-        for line in f:
-            split_l = line.strip().split()
-            dest_link[split_l[0]] = split_l[1]
-    return dest_link
+def _read_chunks(f,chunk_size):
+    """Yield the lines of a file handle in lists of chunk_size lines."""
+    while True:
+        lines = list(itertools.islice(f,chunk_size))
+        if not lines:
+            return
+        yield lines
 
-def fast5s_iter(dest_link,tsv_table):
+def stream_polya(readdb_f,tsv_file,accept_tags,chunk_size = INGEST_CHUNK,stats = None):
     """
-    An iterator iterate over the fast5 files.
+    Stream the (fast5 path, transcript start) of the reads in the polya TSV
+    whose qc_tag is accepted. The readdb and the TSV are read alternately in
+    chunks and joined on the read name as soon as both sides of a read are
+    parsed, so the work items are yielded before the files are fully read.
+    The readdb links are kept until the TSV is exhausted, after that only
+    the reads still waiting for their link are resolved.
     Args:
-        dest_link: readname -> fast5 path
-        tsv_table: Polya segmentation information.
-    Return:
-        An interator of (start_position, transcript start position)
+        readdb_f: File path of the readdb file generated by nanopolish.
+        tsv_file: Nanopolish polya segmentation tsv file.
+        accept_tags: The accepted qc_tag.
+        chunk_size: Number of lines parsed at once.
+        stats: If given, a dict which the number of the reads missing in the
+            readdb is stored into under the key 'unlinked'.
     """
-    if args.eval:
-        accept_tags = [b'PASS',b'SUFFCLIP',b'ADAPTER']
-    else:
-        accept_tags = [b'PASS']
-    for idx,tag in enumerate(tsv_table['qc_tag']):
-        if tag in accept_tags:
-            yield dest_link[tsv_table['readname'][idx]],tsv_table['transcript_start'][idx]
-    
+    links = dict()
+    pending = dict()
+    accept_tags = np.asarray(accept_tags)
+    with open(readdb_f) as readdb_h, open(tsv_file) as tsv_h:
+        headline = tsv_h.readline().strip().split()
+        name_col = headline.index('readname')
+        start_col = headline.index('transcript_start')
+        tag_col = headline.index('qc_tag')
+        readdb_chunks = _read_chunks(readdb_h,chunk_size)
+        tsv_chunks = _read_chunks(tsv_h,chunk_size)
+        while readdb_chunks is not None or tsv_chunks is not None:
+            if readdb_chunks is not None:
+                lines = next(readdb_chunks,None)
+                if lines is None:
+                    readdb_chunks = None
+                else:
+                    for split_l in (line.split() for line in lines):
+                        if len(split_l) < 2:
+                            continue
+                        if tsv_chunks is not None:
+                            links[split_l[0]] = split_l[1]
+                        for trans_start in pending.pop(split_l[0],[]):
+                            yield split_l[1],trans_start
+            if tsv_chunks is not None:
+                lines = next(tsv_chunks,None)
+                if lines is None:
+                    tsv_chunks = None
+                    links.clear()
+                    if not pending:
+                        break
+                else:
+                    columns = list(zip(*[line.split() for line in lines if line.strip()]))
+                    if not columns:
+                        continue
+                    accepted = np.where(np.isin(np.asarray(columns[tag_col]),accept_tags))[0]
+                    names = np.asarray(columns[name_col])[accepted]
+                    starts = np.asarray(columns[start_col])[accepted].astype(np.float32)
+                    for name,trans_start in zip(names.tolist(),starts):
+                        if name in links:
+                            yield links[name],trans_start
+                        else:
+                            pending.setdefault(name,[]).append(trans_start)
+    if stats is not None:
+        stats['unlinked'] = sum([len(x) for x in pending.values()])
+
 def _decap(fast5_root, trans_start,raw_signal,raw_seq):
     """
     Get the raw signal(RNA),events and sequence with polya tail removed.
@@ -112,11 +133,36 @@ def _decap(fast5_root, trans_start,raw_signal,raw_seq):
         raw_seq[3] = raw_seq[3][:-skip_n]
     return raw_signal[int(trans_start):],b'\n'.join(raw_seq),event_entry
 
-def extract_fastq(input_f,ref_f,mode = 0,trans_start = None,alignment = True):
+def build_aligner(ref_f,index_f = None):
+    """
+    Build the minimap2 index of the reference, or load a prebuilt index if
+    ref_f is a .mmi file.
+    Args:
+        ref_f: file name of the reference or the prebuilt index.
+        index_f: If given, save the index into this .mmi file, so the workers
+            can load it instead of rebuilding it.
+    """
+    aligner = mappy.Aligner(ref_f,preset = MAP_PRESET,best_n = MAP_BEST_N,fn_idx_out = index_f)
+    if not aligner:
+        raise IOError("Failed to load or build the index of %s"%(ref_f))
+    return aligner
+
+def init_worker(index_f):
+    """
+    Initialize a worker process, the index built by the main process is
+    inherited by the forked workers, otherwise it's loaded once per worker
+    from index_f.
+    """
+    global ALIGNER,THREAD_BUFFER
+    if ALIGNER is None and index_f is not None:
+        ALIGNER = build_aligner(index_f)
+    THREAD_BUFFER = mappy.ThreadBuffer()
+
+def extract_fastq(input_f,aligner,mode = 0,trans_start = None,alignment = True):
     """
     Args:
         input_f: intput fast5 file handle
-        ref_f: file name of the reference
+        aligner: The mappy.Aligner of the reference.
         mode: 0-dna, 1-rna, -1-rna 180mV
         trans_start: Start position of the transcription(required in RNA mode).
         alignment: If requrie alignment.
@@ -133,8 +179,8 @@ def extract_fastq(input_f,ref_f,mode = 0,trans_start = None,alignment = True):
         align = None
         ref_seq = None
         if alignment:
-            ref = mappy.Aligner(ref_f,preset = "map-ont",best_n = 5)
-            aligns = ref.map(raw_seq.split(b'\n')[1])
+            ref = aligner
+            aligns = ref.map(raw_seq.split(b'\n')[1],buf = THREAD_BUFFER)
             maxmapq = -np.inf
             for aln in aligns:
                 if aln.mapq > maxmapq:
@@ -186,6 +232,24 @@ def parse_cwDTW(f_path):
         output.append(tuple(current))
     return np.array(output,dtype = DATA_FORMAT)
 
+def event_data(aln_matrix,resquiggle_method):
+    """The event matrix written into the fast5 file."""
+    if resquiggle_method in ('cwdtw','dtw'):
+        return np.asarray(aln_matrix,dtype = DATA_FORMAT)
+    return aln_matrix
+
+def _write_corrected(root_h,data,raw,ref):
+    """Write the resquiggle result under the root group of a read."""
+    if 'Analyses/Corrected_000' in root_h:
+        del root_h['Analyses/Corrected_000']
+    event_h = root_h.create_dataset('Analyses/Corrected_000/BaseCalled_template/Events', shape = (len(data),),maxshape=(None,),dtype = data.dtype)
+    fastq_h = root_h.create_dataset('Analyses/Corrected_000/BaseCalled_template/Fastq',shape = (),dtype = h5py.special_dtype(vlen=str))
+    ref_h = root_h.create_dataset('Analyses/Corrected_000/BaseCalled_template/Reference',shape = (),dtype = h5py.special_dtype(vlen=str))
+    event_h[...] = data
+    event_h.attrs['read_start_rel_to_raw'] = 0
+    fastq_h[...] = raw
+    ref_h[...] = ref
+
 def write_back(fast5_f,aln_matrix,raw,ref,resquiggle_method):
     """
     Args:
@@ -196,21 +260,7 @@ def write_back(fast5_f,aln_matrix,raw,ref,resquiggle_method):
         resquiggle_method: The resquiggle method.
     """
     with h5py.File(fast5_f,'a') as fast5_fh:
-        if resquiggle_method == 'cwdtw':
-            data = np.asarray(aln_matrix,dtype = DATA_FORMAT)
-            d_format = DATA_FORMAT
-        elif resquiggle_method == 'raw':
-            data = aln_matrix
-            d_format = data.dtype
-        if '/Analyses/Corrected_000' in fast5_fh:
-            del fast5_fh['/Analyses/Corrected_000']
-        event_h = fast5_fh.create_dataset('/Analyses/Corrected_000/BaseCalled_template/Events', shape = (len(data),),maxshape=(None,),dtype = d_format)
-        fastq_h = fast5_fh.create_dataset('/Analyses/Corrected_000/BaseCalled_template/Fastq',shape = (),dtype = h5py.special_dtype(vlen=str))
-        ref_h = fast5_fh.create_dataset('/Analyses/Corrected_000/BaseCalled_template/Reference',shape = (),dtype = h5py.special_dtype(vlen=str))
-        event_h[...] = data
-        event_h.attrs['read_start_rel_to_raw'] = 0
-        fastq_h[...] = raw
-        ref_h[...] = ref
+        _write_corrected(fast5_fh,event_data(aln_matrix,resquiggle_method),raw,ref)
         
 def copy_raw(src_fast5,dest_fast5,raw):
     """
@@ -242,6 +292,125 @@ def copy_raw(src_fast5,dest_fast5,raw):
         h5py.h5o.copy(root.id,b'UniqueGlobalKey',w_root.id,b'UniqueGlobalKey')
     return None
 
+def read_record(src_fast5,raw,aln_matrix,raw_seq,ref_seq,resquiggle_method):
+    """
+    Collect a labelled read for the multi-read fast5 writer.
+    Args:
+        src_fast5: original fast5 file.
+        raw: The decapped raw signal.
+        aln_matrix, raw_seq, ref_seq, resquiggle_method: Same as write_back.
+    Return:
+        A dict of the read, written by write_read.
+    """
+    if args.mode != 0:
+        raw = raw[::-1]
+    with h5py.File(src_fast5,'r') as root:
+        raw_attrs = list(root['/Raw/Reads'].values())[0].attrs
+        read_id = raw_attrs['read_id']
+        if isinstance(read_id,bytes):
+            read_id = read_id.decode('utf-8')
+        attrs = {'duration':np.uint32(len(raw)),
+                 'median_before':np.float64(raw_attrs['median_before']),
+                 'read_id':raw_attrs['read_id'],
+                 'read_number':np.uint32(raw_attrs['read_number']),
+                 'start_mux':raw_attrs['start_mux'],
+                 'start_time':raw_attrs['start_time']}
+        global_attrs = dict((name,dict(group.attrs)) for name,group in root['/UniqueGlobalKey'].items())
+    return {'read_id':read_id,
+            'signal':np.asarray(raw,dtype = np.int16),
+            'raw_attrs':attrs,
+            'global_attrs':global_attrs,
+            'events':event_data(aln_matrix,resquiggle_method),
+            'fastq':raw_seq,
+            'reference':ref_seq}
+
+def write_read(root,record):
+    """Write a record given by read_record as a read of a multi-read fast5."""
+    read_h = root.create_group('read_' + record['read_id'])
+    read_h.create_dataset('Raw/Signal',data = record['signal'])
+    for key,value in record['raw_attrs'].items():
+        read_h['Raw'].attrs[key] = value
+    for name,attrs in record['global_attrs'].items():
+        group = read_h.create_group(name)
+        for key,value in attrs.items():
+            group.attrs[key] = value
+    _write_corrected(read_h,record['events'],record['fastq'],record['reference'])
+
+def _multi_read_writer(file_path,queue):
+    """Writer process of a multi-read fast5 file, writes the records from the
+    queue until a None is received."""
+    with h5py.File(file_path,'w') as root:
+        root.attrs['file_version'] = np.bytes_('2.0')
+        for record in iter(queue.get,None):
+            write_read(root,record)
+
+class MultiReadWriter(object):
+    """
+    Batch the labelled reads into multi-read fast5 files of reads_per_file
+    reads, every output file is written by its own writer process, so the
+    labelling doesn't wait on the hdf5 writes of the current file. The
+    writer of a finished file is joined when the next file is started, and a
+    writer that died raises a RuntimeError instead of blocking the labelling.
+    A record is pickled twice, from the pool worker to the parent and from
+    the parent to the writer process. This is deliberate: the parent is the
+    only place that knows the order of the records and when a file is full,
+    so the file rotation stays in one process. The records are small next to
+    the labelling (an int16 signal and a few tables), the extra copy is cheap.
+    Args:
+        folder: The output folder.
+        reads_per_file: Number of reads in a multi-read fast5 file.
+        prefix: Prefix of the output file names.
+    """
+    def __init__(self,folder,reads_per_file,prefix = 'batch'):
+        self.folder = folder
+        self.reads_per_file = reads_per_file
+        self.prefix = prefix
+        self.file_n = 0
+        self.read_n = 0
+        self.queue = None
+        self.writer = None
+    def _next_file(self):
+        if self.queue is not None:
+            self._put(None)
+            self._join()
+        self.queue = Queue(maxsize = WRITER_QUEUE)
+        file_path = os.path.join(self.folder,'%s_%d.fast5'%(self.prefix,self.file_n))
+        writer = Process(target = _multi_read_writer,args = (file_path,self.queue))
+        writer.start()
+        self.writer = writer
+        self.file_n += 1
+        self.read_n = 0
+    def _put(self,item):
+        """Put into the queue of the current writer, raise if the writer died
+        instead of blocking on the full queue forever."""
+        writer = self.writer
+        while True:
+            try:
+                self.queue.put(item,timeout = WRITER_TIMEOUT)
+                return
+            except queue.Full:
+                if not writer.is_alive():
+                    # Nobody reads the queue anymore, don't flush it on exit.
+                    self.queue.cancel_join_thread()
+                    raise RuntimeError("The writer of %s_%d.fast5 exited with code %s."%(self.prefix,self.file_n-1,writer.exitcode))
+    def _join(self):
+        """Join the writer of the finished file and check its exit code."""
+        writer,self.writer = self.writer,None
+        writer.join()
+        if writer.exitcode != 0:
+            self.queue.cancel_join_thread()
+            raise RuntimeError("The writer process %s exited with code %s."%(writer.name,writer.exitcode))
+    def write(self,record):
+        if self.queue is None or self.read_n >= self.reads_per_file:
+            self._next_file()
+        self._put(record)
+        self.read_n += 1
+    def close(self):
+        if self.queue is not None:
+            self._put(None)
+            self._join()
+        self.queue = None
+
 def label(abs_fast5):
     trans_start = abs_fast5[1]
     abs_fast5 = abs_fast5[0]
@@ -250,13 +419,14 @@ def label(abs_fast5):
         align = True
         if args.resquiggle_method == 'raw':
             align = False
-        raw_signal,raw_seq,ref_seq,decap_event = extract_fastq(abs_fast5,args.ref,args.mode,trans_start,align)
+        raw_signal,raw_seq,ref_seq,decap_event = extract_fastq(abs_fast5,ALIGNER,args.mode,trans_start,align)
         prefix = os.path.join(args.saving,'resquiggle',os.path.splitext(filename)[0])
         fast5_save = os.path.join(args.saving,'fast5s',filename)
-        if args.copy_original:
-            shutil.copyfile(abs_fast5,fast5_save)
-        else:
-            copy_raw(abs_fast5,fast5_save,raw_signal)
+        if args.reads_per_file <= 0:
+            if args.copy_original:
+                shutil.copyfile(abs_fast5,fast5_save)
+            else:
+                copy_raw(abs_fast5,fast5_save,raw_signal)
         
         ######Begin cwDTW pipeline
         if args.resquiggle_method == 'cwdtw':
@@ -271,37 +441,76 @@ def label(abs_fast5):
             else:
                 pass
 #                return
+        elif args.resquiggle_method == 'dtw':
+            if ref_seq is None:
+                return
+            levels,k = KMER_MODEL
+            try:
+                align_matrix = dtw.resquiggle(raw_signal,ref_seq,levels,k,args.band)
+            except ValueError as e:
+                print("FAIL RESQUIGGLE %s, %s"%(abs_fast5,e))
+                return
         elif args.resquiggle_method == 'raw':
             align_matrix = decap_event
         ######End cwDTW pipeline
+        if args.reads_per_file > 0:
+            return read_record(abs_fast5,raw_signal,align_matrix,raw_seq,ref_seq,args.resquiggle_method)
         write_back(fast5_save,align_matrix,raw_seq,ref_seq,args.resquiggle_method)
 
+def create_pool():
+    """
+    Create the worker pool, the reference index is built or loaded once here
+    and shared with the workers instead of being rebuilt for every read.
+    """
+    global ALIGNER,KMER_MODEL
+    index_f = None
+    if args.resquiggle_method == 'dtw':
+        if args.kmer_model is None:
+            raise ValueError("--kmer_model is required by the dtw resquiggle method.")
+        KMER_MODEL = dtw.read_kmer_model(args.kmer_model)
+    if args.resquiggle_method != 'raw':
+        ALIGNER = build_aligner(args.ref,args.index)
+        index_f = args.index if args.index is not None else args.ref
+    return Pool(args.thread,initializer = init_worker,initargs = (index_f,))
+
+def write_records(records,total = None):
+    """Consume the results of label, the records are written into the
+    multi-read fast5 files if --reads_per_file is set."""
+    writer = None
+    if args.reads_per_file > 0:
+        writer = MultiReadWriter(os.path.join(args.saving,'fast5s'),args.reads_per_file)
+    for record in tqdm.tqdm(records,total = total):
+        if writer is not None and record is not None:
+            writer.write(record)
+    if writer is not None:
+        writer.close()
+
 def run():
-    pool = Pool(args.thread)
+    pool = create_pool()
     filelist = []
     for path , _ , files in os.walk(args.input):
         for file in files:
             if file.endswith('fast5'):
                 filelist.append((os.path.join(path,file),None))
-    for _ in tqdm.tqdm(pool.imap_unordered(label,filelist),total = len(filelist)):
-        pass
+    write_records(pool.imap_unordered(label,filelist,chunksize = TASK_CHUNK),len(filelist))
     pool.close()
     pool.join()        
     
 def run_rna():
-    pool = Pool(args.thread)
-    dest_link = read_link(args.readdb)
-    tsv_table = read_tsv(args.polya)
-    filelist = []
-    for file,trans_start in fast5s_iter(dest_link,tsv_table):
-        if file.endswith('fast5'):
-            filelist.append((file,trans_start))
-#    for file in filelist:
-#        label(file)
-    for _ in tqdm.tqdm(pool.imap_unordered(label,filelist),total = len(filelist)):
-        pass
+    pool = create_pool()
+    if args.eval:
+        accept_tags = ['PASS','SUFFCLIP','ADAPTER']
+    else:
+        accept_tags = ['PASS']
+    stats = {}
+    filelist = ((file,trans_start) for file,trans_start in stream_polya(args.readdb,args.polya,accept_tags,stats = stats) if file.endswith('fast5'))
+    # No total is given to the progress bar, the rejected TSV rows (qc_tag or
+    # readdb link) are only known as they are streamed.
+    write_records(pool.imap_unordered(label,filelist,chunksize = TASK_CHUNK))
     pool.close()
-    pool.join()        
+    pool.join()
+    if stats.get('unlinked'):
+        print("%d reads in the polya TSV are not found in the readdb."%(stats['unlinked']))
     
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='chiron',
@@ -309,7 +518,9 @@ if __name__ == "__main__":
     parser.add_argument('-i', '--input', required = True,
                         help="Directory of the fast5 files.")
     parser.add_argument('-r', '--ref', required = True,
-                        help="Reference file name")
+                        help="Reference file name, or a minimap2 index (.mmi) prebuilt from the reference.")
+    parser.add_argument('--index',default = None,
+                        help="If given, save the minimap2 index of the reference into this .mmi file, which can be given to --ref in the later runs.")
     parser.add_argument('--polya',default = None,
                         help="Polya segment TSV file generated by Nanopolish, required in RNA mode.")
     parser.add_argument('--readdb',default = None,
@@ -322,11 +533,19 @@ if __name__ == "__main__":
                         help="Thread number.")
     parser.add_argument('--copy',dest = 'copy_original',action = 'store_true', 
                         help="If set, copy the original file else create a new fast5 file with raw_signal and resquiggle only.")
+    parser.add_argument('--reads_per_file',default = 0,type = int,
+                        help="If set, write the labelled reads into multi-read fast5 files of reads_per_file reads instead of a fast5 file per read.")
     parser.add_argument('--resquiggle_method',default = 'raw',choices = RESQUIGGLE_METHODS, 
                         help="Resquiggle method, can be only chosen from %s"%(RESQUIGGLE_METHODS))
+    parser.add_argument('--kmer_model',default = None,
+                        help="K-mer pore model used by the dtw resquiggle method, a text file with the k-mer and its mean current level in the first two columns.")
+    parser.add_argument('--band',default = None,type = int,
+                        help="Half width in samples of the band of the dtw resquiggle method, default is 20 times the mean samples per base capped at 500. The alignment takes about 4*bases*(2*band+samples per base) bytes of memory.")
     parser.add_argument('--for_eval',dest = 'eval',action = 'store_true',
                         help="If set, the SUFFCLIP and ADAPTER reads will also beincluded.")
     args = parser.parse_args(sys.argv[1:])
+    if args.reads_per_file > 0 and args.copy_original:
+        raise ValueError("--copy can't be used with --reads_per_file.")
     
     if not os.path.isdir(args.saving):
         os.mkdir(args.saving)
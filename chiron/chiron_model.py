@@ -131,14 +131,23 @@ def prediction(logits, seq_length, label,beam_width = 30, top_paths=1):
     tf.summary.scalar('Error_rate', error)
     return error,d_min,predict
 
+def cnn_ratio(full_sequence_len,configure):
+    """The ratio between the input length and the CNN output length, read
+    from the static shape of the CNN built on a full_sequence_len input in a
+    scratch graph, used when the input length is unknown."""
+    with tf.Graph().as_default():
+        probe = tf.placeholder(tf.float32, shape=[1, full_sequence_len])
+        probe_feature = getcnnfeature(probe,training = tf.constant(False),cnn_config = configure['cnn'])
+    return full_sequence_len/probe_feature.get_shape().as_list()[1]
+
 def inference(x,sequence_len,training,full_sequence_len,configure, apply_ratio = False):
     """Infer a logits of the input signal batch.
 
     Args:
-        x: Tensor of shape [batch_size, max_time,channel], a batch of the input signal with a maximum length `max_time`.
+        x: Tensor of shape [batch_size, max_time,channel], a batch of the input signal with a maximum length `max_time`, both batch_size and max_time can be None.
         sequence_len: Tensor of shape [batch_size], given the real lenghs of the segments.
         training: Placeholder of Boolean, Ture if the inference is during training.
-        full_sequence_len: Scalar float, the maximum length of the sample in the batch.
+        full_sequence_len: Scalar float, the maximum length of the sample in the batch, the ratio is computed on this length if max_time is None.
         configure:Model configuration.
         apply_ratio: If apply the ration to the sequence_len or not.
     Returns:
@@ -149,7 +158,10 @@ def inference(x,sequence_len,training,full_sequence_len,configure, apply_ratio =
     print(x.shape)
     cnn_feature = getcnnfeature(x,training = training,cnn_config = configure['cnn'])
     feashape = cnn_feature.get_shape().as_list()
-    ratio = full_sequence_len/feashape[1]
+    if feashape[1] is None:
+        ratio = cnn_ratio(full_sequence_len,configure)
+    else:
+        ratio = full_sequence_len/feashape[1]
     if apply_ratio:
         sequence_len =  tf.cast(tf.ceil(tf.cast(sequence_len,tf.float32)/ratio),tf.int32)
     if configure['rnn']['layer_num'] == 0:
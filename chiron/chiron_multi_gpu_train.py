@@ -18,6 +18,8 @@ import chiron.chiron_model as model
 
 from six.moves import range
 from chiron.chiron_queue_input import inputs
+from chiron.chiron_input import cache_dataset_pipeline
+from chiron.chiron_input import dense2sparse
 from distutils.dir_util import copy_tree
 from tensorflow.contrib.training.python.training import hparam
 
@@ -71,23 +73,6 @@ def average_gradients(tower_grads):
         average_grads.append(grad_and_var)
     return average_grads
 
-def dense2sparse(label):
-    """Transfer the dense label tensor to sparse tensor, the padding value should be -1 for the input dense label.
-
-    Input:
-        label
-    Output:
-        A tf.SparseTensor of the input tensor.
-    Args:
-        label: Tensor of shape [batch_size, LABEL_LEN], padded with -1.
-
-    Returns:
-        SparseTensor, the sparse format of the label.
-    """
-    idx = tf.where(tf.not_equal(label, -1))
-    sparse = tf.SparseTensor(idx, tf.gather_nd(label, idx), label.get_shape())
-    return sparse
-
 def train(hparams):
     """Main training function.
     This will train a Neural Network with the given dataset.
@@ -95,6 +80,8 @@ def train(hparams):
     Args:
         hparams: hyper parameter for training the neural network
             data-dir: String, the path of the data(binary batch files) directory.
+            cache: String, the hdf5 cache file generated by chiron_input.read_raw_data_sets,
+                if given the data is read through a tf.data pipeline instead of data-dir.
             log-dir: String, the path to save the trained model.
             sequence-len: Int, length of input signal.
             batch-size: Int.
@@ -112,8 +99,15 @@ def train(hparams):
                                     initializer=tf.zeros_initializer())
         
         opt = model.train_opt(hparams.step_rate,hparams.max_steps,global_step = global_step)
-        x, seq_length, train_labels = inputs(hparams.data_dir, int(hparams.batch_size*hparams.ngpus),
-                                            for_valid=False)
+        if hparams.cache is None:
+            x, seq_length, train_labels = inputs(hparams.data_dir, int(hparams.batch_size*hparams.ngpus),
+                                                 hparams.sequence_len,
+                                                 for_valid=False)
+        else:
+            train_data = cache_dataset_pipeline(hparams.cache,
+                                                int(hparams.batch_size*hparams.ngpus),
+                                                sparse_label = False)
+            x, seq_length, train_labels = train_data.make_one_shot_iterator().get_next()
         split_y = tf.split(train_labels,hparams.ngpus,axis=0)
         split_seq_length = tf.split(seq_length,hparams.ngpus,axis=0)
         split_x = tf.split(x,hparams.ngpus,axis=0)
@@ -208,6 +202,10 @@ if __name__ == "__main__":
             default = '/media/Linux_ex/Nanopore_Data/20170322_c4_watermanag_S10/file_batch')
 #            required=True)
    
+    parser.add_argument(
+            '--cache',
+            help='The hdf5 cache file generated by chiron_input, if given it is read by a tf.data pipeline instead of the binary data.',
+            default = None)
     parser.add_argument(
             '-o',
             '--log-dir',
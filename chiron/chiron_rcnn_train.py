@@ -19,6 +19,15 @@ import tensorflow as tf
 import chiron.chiron_model as model
 from chiron.chiron_input import read_raw_data_sets
 from chiron.chiron_input import read_cache_dataset
+from chiron.chiron_input import BatchPrefetcher
+from chiron.chiron_input import BucketDataSet
+from chiron.chiron_input import cache_dataset_pipeline
+from chiron.chiron_input import cache_fingerprint
+from chiron.chiron_input import cache_info
+from chiron.chiron_input import build_read_store
+from chiron.chiron_input import read_store_data_sets
+from chiron.chiron_input import BackgroundTask
+from chiron.chiron_input import close_archives
 from tensorflow.python.ops import variables
 from six.moves import range
 DEFAULT_OFFSET = 10
@@ -27,28 +36,59 @@ def save_hyper_parameter():
     """
     TODO: Function to save the hyper parameter.
     """
-def compile_train_graph(config,hp):
+def compile_train_graph(config,hp,dataset = None,sequence_len = None,opt = None,scope = None):
+    """
+    Build the training graph.
+    Args:
+        config: Model configuration.
+        hp: Hyper parameters.
+        dataset: A optional tf.data.Dataset given batches of (signal,signal_length,sparse_label),
+            if None the input is fed through placeholders, otherwise a feedable
+            iterator is built and selected by feeding net.handle.
+        sequence_len: The segment length of the input, default is hp.sequence_len.
+        opt: A optional optimizer to share with other graphs, if None a new optimizer is created.
+        scope: If given, only the summaries under this name scope are merged.
+    """
     class net:
         pass
+    if sequence_len is None:
+        sequence_len = hp.sequence_len
     net.training = tf.placeholder(tf.bool)
     net.global_step = tf.get_variable('global_step', trainable=False, shape=(),
                                   dtype=tf.int32,
                                   initializer=tf.zeros_initializer())
-    net.x = tf.placeholder(tf.float32, shape=[hp.batch_size, hp.sequence_len])
-    net.seq_length = tf.placeholder(tf.int32, shape=[hp.batch_size])
-    net.y_indexs = tf.placeholder(tf.int64)
-    net.y_values = tf.placeholder(tf.int32)
-    net.y_shape = tf.placeholder(tf.int64)
-    net.y = tf.SparseTensor(net.y_indexs, net.y_values, net.y_shape)
-    net.logits, net.ratio = model.inference(net.x, net.seq_length, net.training,hp.sequence_len,configure = config)
+    if dataset is None:
+        net.x = tf.placeholder(tf.float32, shape=[hp.batch_size, sequence_len])
+        net.seq_length = tf.placeholder(tf.int32, shape=[hp.batch_size])
+        net.y_indexs = tf.placeholder(tf.int64)
+        net.y_values = tf.placeholder(tf.int32)
+        net.y_shape = tf.placeholder(tf.int64)
+        net.y = tf.SparseTensor(net.y_indexs, net.y_values, net.y_shape)
+        net.logits, net.ratio = model.inference(net.x, net.seq_length, net.training,sequence_len,configure = config)
+    else:
+        net.handle = tf.placeholder(tf.string, shape=[])
+        iterator = tf.data.Iterator.from_string_handle(
+            net.handle,
+            tf.compat.v1.data.get_output_types(dataset),
+            tf.compat.v1.data.get_output_shapes(dataset),
+            tf.compat.v1.data.get_output_classes(dataset))
+        net.x, signal_length, net.y = iterator.get_next()
+        # Floor the scaled length as the int32 placeholder does in the
+        # feed_dict path.
+        ratio = model.cnn_ratio(sequence_len,config)
+        net.seq_length = tf.cast(tf.floor(tf.cast(signal_length,tf.float32)/ratio),tf.int32)
+        net.logits, net.ratio = model.inference(net.x, net.seq_length, net.training,sequence_len,configure = config)
     if 'fl_gamma' in config.keys():
         net.ctc_loss = model.loss(net.logits, net.seq_length, net.y, fl_gamma = config['fl_gamma'])
     else:
         net.ctc_loss = model.loss(net.logits, net.seq_length, net.y)
-    net.opt = model.train_opt(hp.step_rate,
-                          hp.max_steps, 
-                          global_step=net.global_step,
-                          opt_name = config['opt_method'])
+    if opt is None:
+        net.opt = model.train_opt(hp.step_rate,
+                              hp.max_steps, 
+                              global_step=net.global_step,
+                              opt_name = config['opt_method'])
+    else:
+        net.opt = opt
     if hp.gradient_clip is None:
         net.step = net.opt.minimize(net.ctc_loss,global_step = net.global_step)
     else:
@@ -60,9 +100,42 @@ def compile_train_graph(config,hp):
     net.variable_to_restore=set(variables._all_saveable_objects()+tf.moving_average_variables())
     net.saver = tf.train.Saver(var_list=net.variable_to_restore, 
                                save_relative_paths=True)
-    net.summary = tf.summary.merge_all()
+    net.summary = tf.summary.merge_all(scope = scope)
     return net
 
+def compile_bucket_graphs(config,hp,boundaries):
+    """
+    Build one training graph for each bucket length, the graphs share the
+    variables and the optimizer.
+    Args:
+        config: Model configuration.
+        hp: Hyper parameters.
+        boundaries: List of the bucket lengths.
+    Return:
+        A dict of bucket length -> net.
+    """
+    nets = dict()
+    opt = None
+    for idx,length in enumerate(sorted(boundaries)):
+        # model.loss sum up the whole 'losses' collection, keep only the loss of this bucket.
+        tf.get_default_graph().clear_collection('losses')
+        with tf.variable_scope(tf.get_variable_scope(),reuse = idx>0):
+            with tf.name_scope('bucket_%d'%(length)) as scope:
+                net = compile_train_graph(config,
+                                          hp,
+                                          sequence_len = length,
+                                          opt = opt,
+                                          scope = scope)
+        opt = net.opt
+        nets[length] = net
+    init = tf.global_variables_initializer()
+    saver = tf.train.Saver(var_list=set(variables._all_saveable_objects()+tf.moving_average_variables()), 
+                           save_relative_paths=True)
+    for net in nets.values():
+        net.init = init
+        net.saver = saver
+    return nets
+
 def train():
     default_config = os.path.join(FLAGS.log_dir,FLAGS.model_name,'model.json')
     if FLAGS.retrain:
@@ -79,7 +152,20 @@ def train():
             if not pro.startswith('_'):
                 print("%s:%s"%(pro,getattr(FLAGS,pro)))
                 log_f.write("%s:%s\n"%(pro,getattr(FLAGS,pro)))
-    net = compile_train_graph(config,FLAGS)
+    if FLAGS.tf_data and FLAGS.resample_after_epoch != 0:
+        raise ValueError("Resampling is not supported with the tf.data input pipeline.")
+    if FLAGS.tf_data and FLAGS.bucket_boundaries is not None:
+        raise ValueError("Bucketing is not supported with the tf.data input pipeline.")
+    train_ds,valid_ds = generate_train_valid_datasets(initial_offset = DEFAULT_OFFSET)
+    if FLAGS.tf_data:
+        train_data,valid_data = cache_pipelines()
+        net = compile_train_graph(config,FLAGS,dataset = train_data)
+    elif FLAGS.bucket_boundaries is not None:
+        nets = compile_bucket_graphs(config,FLAGS,bucket_boundaries())
+        net = nets[FLAGS.sequence_len]
+    else:
+        net = compile_train_graph(config,FLAGS)
+        nets = {FLAGS.sequence_len:net}
     sess = tf.Session(config=tf.ConfigProto(inter_op_parallelism_threads=FLAGS.threads,
                                             intra_op_parallelism_threads=FLAGS.threads,
                                             allow_soft_placement=True))
@@ -93,24 +179,46 @@ def train():
     summary_writer = tf.summary.FileWriter(
         FLAGS.log_dir + FLAGS.model_name + '/summary/', sess.graph)
     model.save_model(default_config,config)
-    train_ds,valid_ds = generate_train_valid_datasets(initial_offset = DEFAULT_OFFSET)
+    if FLAGS.tf_data:
+        train_on_pipeline(sess,net,summary_writer,train_data,valid_data,train_ds.reads_n)
+        return
+    # The DataSet read from the cache file, closed when it's resampled.
+    cache_ds = train_ds
+    train_ds,valid_ds = bucket_datasets(train_ds,valid_ds)
+    train_feeder,valid_feeder = prefetch_datasets(train_ds,valid_ds)
     start = time.time()
     resample_n = 0
+    if FLAGS.resample_after_epoch != 0:
+        resample_task = resample_dataset(resample_n + 1)
     for i in range(FLAGS.max_steps):
         if FLAGS.resample_after_epoch == 0:
             pass
-        elif train_ds.epochs_completed >= FLAGS.resample_after_epoch:
-            train_ds,valid_ds = generate_train_valid_datasets(initial_offset = resample_n*FLAGS.offset_increment + DEFAULT_OFFSET)
-        batch_x, seq_len, batch_y = train_ds.next_batch(FLAGS.batch_size)
+        elif train_feeder.epochs_completed >= FLAGS.resample_after_epoch and resample_task.done():
+            # Swap in the dataset resampled in background, the training
+            # keeps going on the current dataset until it's ready.
+            resample_n += 1
+            shared_valid = valid_feeder is train_feeder
+            close_feeders(train_feeder)
+            # Close the retired cache before the next resampling rebuilds it.
+            cache_ds.close()
+            cache_ds = resample_task.result()
+            train_ds,_ = bucket_datasets(cache_ds,cache_ds)
+            train_feeder,_ = prefetch_datasets(train_ds,train_ds)
+            if shared_valid:
+                valid_feeder = train_feeder
+            resample_task = resample_dataset(resample_n + 1)
+        batch_x, seq_len, batch_y = next_batch(train_feeder)
         indxs, values, shape = batch_y
+        net = nets[batch_x.shape[1]]
         feed_dict = {net.x: batch_x, net.seq_length: seq_len / net.ratio, net.y_indexs: indxs,
                      net.y_values: values, net.y_shape: shape,
                      net.training: True}
         loss_val, _ = sess.run([net.ctc_loss, net.step], feed_dict=feed_dict)
         if i % 10 == 0:
             global_step_val = tf.train.global_step(sess, net.global_step)
-            valid_x, valid_len, valid_y = valid_ds.next_batch(FLAGS.batch_size)
+            valid_x, valid_len, valid_y = next_batch(valid_feeder)
             indxs, values, shape = valid_y
+            net = nets[valid_x.shape[1]]
             feed_dict = {net.x: valid_x, net.seq_length: valid_len / net.ratio,
                          net.y_indexs: indxs, net.y_values: values, net.y_shape: shape,
                          net.training: True}
@@ -120,23 +228,177 @@ def train():
 #            true_seq,_ = sparse2dense([[y],0])
             end = time.time()
             print(
-            "Step %d/%d Epoch %d, batch number %d, train_loss: %5.3f validate_edit_distance: %5.3f Elapsed Time/step: %5.3f" \
-            % (i, FLAGS.max_steps, train_ds.epochs_completed,
-               train_ds.index_in_epoch, loss_val, error_val,
-               (end - start) / (i + 1)))
+            "Step %d/%d Epoch %d, batch number %d, train_loss: %5.3f validate_edit_distance: %5.3f Elapsed Time/step: %5.3f Input stall: %5.3f" \
+            % (i, FLAGS.max_steps, train_feeder.epochs_completed,
+               train_feeder.index_in_epoch, loss_val, error_val,
+               (end - start) / (i + 1), stall_time(train_feeder,valid_feeder)))
             net.saver.save(sess, FLAGS.log_dir + FLAGS.model_name + '/model.ckpt',
                        global_step=global_step_val)
             summary_str = sess.run(net.summary, feed_dict=feed_dict)
             summary_writer.add_summary(summary_str, global_step=global_step_val)
             summary_writer.flush()
+    close_feeders(train_feeder,valid_feeder)
     global_step_val = tf.train.global_step(sess, net.global_step)
     print("Model %s saved." % (FLAGS.log_dir + FLAGS.model_name))
     print("Reads number %d" % (train_ds.reads_n))
+    print("Training waited %5.3f seconds for the input batches." % (stall_time(train_feeder,valid_feeder)))
     net.saver.save(sess, FLAGS.log_dir + FLAGS.model_name + '/final.ckpt',
                global_step=global_step_val)
     
+def cache_pipelines():
+    """
+    Build the tf.data pipelines over the training and validation hdf5 cache.
+    """
+    train_data = cache_dataset_pipeline(FLAGS.train_cache,
+                                        FLAGS.batch_size,
+                                        shuffle = True,
+                                        prefetch = max(1,FLAGS.prefetch))
+    if FLAGS.validation is not None:
+        valid_cache = FLAGS.valid_cache
+    else:
+        valid_cache = FLAGS.train_cache
+    valid_data = cache_dataset_pipeline(valid_cache,
+                                        FLAGS.batch_size,
+                                        shuffle = True,
+                                        prefetch = 1)
+    return train_data,valid_data
+
+def train_on_pipeline(sess,net,summary_writer,train_data,valid_data,reads_n):
+    """
+    Training loop with the input given by the tf.data pipelines.
+    """
+    train_handle = sess.run(train_data.make_one_shot_iterator().string_handle())
+    valid_handle = sess.run(valid_data.make_one_shot_iterator().string_handle())
+    start = time.time()
+    for i in range(FLAGS.max_steps):
+        feed_dict = {net.handle: train_handle, net.training: True}
+        loss_val, _ = sess.run([net.ctc_loss, net.step], feed_dict=feed_dict)
+        if i % 10 == 0:
+            global_step_val = tf.train.global_step(sess, net.global_step)
+            feed_dict = {net.handle: valid_handle, net.training: True}
+            # One run so the summary is of the batch the error is given on.
+            error_val, summary_str = sess.run([net.error, net.summary], feed_dict=feed_dict)
+            end = time.time()
+            print(
+            "Step %d/%d Epoch %d, batch number %d, train_loss: %5.3f validate_edit_distance: %5.3f Elapsed Time/step: %5.3f" \
+            % (i, FLAGS.max_steps, (i+1)*FLAGS.batch_size//reads_n,
+               ((i+1)*FLAGS.batch_size)%reads_n, loss_val, error_val,
+               (end - start) / (i + 1)))
+            net.saver.save(sess, FLAGS.log_dir + FLAGS.model_name + '/model.ckpt',
+                       global_step=global_step_val)
+            summary_writer.add_summary(summary_str, global_step=global_step_val)
+            summary_writer.flush()
+    global_step_val = tf.train.global_step(sess, net.global_step)
+    print("Model %s saved." % (FLAGS.log_dir + FLAGS.model_name))
+    print("Reads number %d" % (reads_n))
+    net.saver.save(sess, FLAGS.log_dir + FLAGS.model_name + '/final.ckpt',
+               global_step=global_step_val)
+
+def bucket_boundaries():
+    """Parse the --bucket_boundaries, the full sequence_len is always the last bucket."""
+    boundaries = sorted(set([int(x) for x in FLAGS.bucket_boundaries.split(',')]))
+    if boundaries[-1] > FLAGS.sequence_len:
+        raise ValueError("Bucket boundary %d is longer than the sequence length %d."%(boundaries[-1],FLAGS.sequence_len))
+    if boundaries[-1] < FLAGS.sequence_len:
+        boundaries.append(FLAGS.sequence_len)
+    return boundaries
+
+def bucket_datasets(train_ds,valid_ds):
+    """
+    Wrap the datasets with BucketDataSet if the --bucket_boundaries is set.
+    """
+    if FLAGS.bucket_boundaries is None:
+        return train_ds,valid_ds
+    boundaries = bucket_boundaries()
+    train_bucket = BucketDataSet(train_ds,
+                                 boundaries,
+                                 FLAGS.batch_size,
+                                 label_buckets = FLAGS.label_buckets)
+    print("Training batches are bucketed by %s"%(sorted(train_bucket.bucket_sizes.items())))
+    if valid_ds is train_ds:
+        return train_bucket,train_bucket
+    valid_bucket = BucketDataSet(valid_ds,
+                                 boundaries,
+                                 FLAGS.batch_size,
+                                 label_buckets = FLAGS.label_buckets)
+    return train_bucket,valid_bucket
+
+def prefetch_datasets(train_ds,valid_ds):
+    """
+    Wrap the datasets with a BatchPrefetcher if FLAGS.prefetch > 0, the 
+    validation dataset share the prefetcher with the training dataset if they
+    are the same dataset.
+    """
+    if FLAGS.prefetch == 0:
+        return train_ds,valid_ds
+    train_feeder = BatchPrefetcher(train_ds,
+                                   FLAGS.batch_size,
+                                   capacity = FLAGS.prefetch)
+    if valid_ds is train_ds:
+        valid_feeder = train_feeder
+    else:
+        valid_feeder = BatchPrefetcher(valid_ds,
+                                       FLAGS.batch_size,
+                                       capacity = max(1,FLAGS.prefetch//10))
+    return train_feeder,valid_feeder
+
+def next_batch(feeder):
+    if isinstance(feeder,BatchPrefetcher):
+        return feeder.next_batch()
+    return feeder.next_batch(FLAGS.batch_size)
+
+def close_feeders(*feeders):
+    for feeder in set(feeders):
+        if isinstance(feeder,BatchPrefetcher):
+            feeder.close()
+
+def stall_time(*feeders):
+    """Total time in seconds the training loop waited for the prefetchers."""
+    return sum([feeder.stall_time for feeder in set(feeders) if isinstance(feeder,BatchPrefetcher)])
+
+def read_store_path():
+    """The read store kept next to the training cache for resampling."""
+    return os.path.splitext(FLAGS.train_cache)[0] + '_reads.hdf5'
+
+def resample_dataset(resample_n):
+    """
+    Segment the training reads with the initial offset of the resample_n th
+    resampling in a background thread, the cache files are used alternately
+    so the current dataset is never overwritten.
+    Return:
+        A BackgroundTask whose result is the resampled training DataSet.
+    """
+    if resample_n % 2 == 0:
+        cache_path = FLAGS.train_cache
+    else:
+        cache_path = os.path.splitext(FLAGS.train_cache)[0] + '_resample.hdf5'
+    return BackgroundTask(read_store_data_sets,
+                          read_store_path(),
+                          cache_path,
+                          FLAGS.sequence_len,
+                          k_mer = FLAGS.k_mer,
+                          max_segments_num = FLAGS.segments_num,
+                          skip_start = resample_n*FLAGS.offset_increment + DEFAULT_OFFSET,
+                          compressor = FLAGS.cache_compressor)
+
+def check_cache(h5py_file_path, skip_start):
+    """Make sure a cache file was built with the current training parameters."""
+    fingerprint, complete, _ = cache_info(h5py_file_path)
+    if fingerprint is None:
+        return
+    if not complete:
+        raise ValueError("The cached dataset %s is incomplete, rebuild it without --read_cache."%(h5py_file_path))
+    if fingerprint != cache_fingerprint(FLAGS.sequence_len,
+                                        FLAGS.k_mer,
+                                        skip_start,
+                                        FLAGS.segments_num):
+        raise ValueError("The cached dataset %s is built with different parameters, rebuild it without --read_cache."%(h5py_file_path))
+
 def generate_train_valid_datasets(initial_offset = 10):
     if FLAGS.read_cache:
+        check_cache(FLAGS.train_cache, initial_offset)
+        if FLAGS.validation is not None:
+            check_cache(FLAGS.valid_cache, 10)
         train_ds = read_cache_dataset(FLAGS.train_cache)
         if FLAGS.validation is not None:
             valid_ds = read_cache_dataset(FLAGS.valid_cache)
@@ -146,23 +408,41 @@ def generate_train_valid_datasets(initial_offset = 10):
             raise ValueError("The event length of training cached dataset %d is inconsistent with given sequene_len %d"%(train_ds.event.shape()[1],FLAGS.sequence_len))
         if valid_ds.event.shape[1]!=FLAGS.sequence_len:
             raise ValueError("The event length of training cached dataset %d is inconsistent with given sequene_len %d"%(valid_ds.event.shape()[1],FLAGS.sequence_len))
+        if FLAGS.resample_after_epoch != 0:
+            # The resampling reads from the read store, which is reused if
+            # it's complete and the data_dir is unchanged.
+            build_read_store(FLAGS.data_dir,read_store_path())
         return train_ds,valid_ds
     sys.stdout.write("Begin reading training dataset.\n")
-    train_ds = read_raw_data_sets(FLAGS.data_dir,
-                                  FLAGS.train_cache,
-                                  FLAGS.sequence_len, 
-                                  k_mer=FLAGS.k_mer,
-                                  max_segments_num=FLAGS.segments_num,
-                                  skip_start = initial_offset)
+    if FLAGS.resample_after_epoch != 0:
+        build_read_store(FLAGS.data_dir,read_store_path())
+        train_ds = read_store_data_sets(read_store_path(),
+                                        FLAGS.train_cache,
+                                        FLAGS.sequence_len,
+                                        k_mer=FLAGS.k_mer,
+                                        max_segments_num=FLAGS.segments_num,
+                                        skip_start = initial_offset,
+                                        compressor = FLAGS.cache_compressor)
+    else:
+        train_ds = read_raw_data_sets(FLAGS.data_dir,
+                                      FLAGS.train_cache,
+                                      FLAGS.sequence_len, 
+                                      k_mer=FLAGS.k_mer,
+                                      max_segments_num=FLAGS.segments_num,
+                                      skip_start = initial_offset,
+                                      compressor = FLAGS.cache_compressor)
     sys.stdout.write("Begin reading validation dataset.\n")
     if FLAGS.validation is not None:
         valid_ds = read_raw_data_sets(FLAGS.validation,
                                       FLAGS.valid_cache,
                                       FLAGS.sequence_len, 
                                       k_mer=FLAGS.k_mer,
-                                      max_segments_num=FLAGS.segments_num)
+                                      max_segments_num=FLAGS.segments_num,
+                                      compressor=FLAGS.cache_compressor)
     else:
         valid_ds = train_ds
+    # The datasets are read from the caches from now on.
+    close_archives()
     return train_ds,valid_ds
 def run(args):
     global FLAGS
@@ -206,6 +486,17 @@ if __name__ == "__main__":
                         type = int,
                         default = 0, 
                         help='Resample the reads data every n epoches, with an increasing initial offset.')
+    parser.add_argument('--bucket_boundaries',
+                        default = None,
+                        help='Comma separated segment lengths, e.g. 200,300,400. Batches are drawn from a single length bucket and trimmed to its boundary, one graph is compiled per boundary, the boundaries should be multiples of the CNN stride.')
+    parser.add_argument('--label_buckets',
+                        type = int,
+                        default = 1,
+                        help='Number of label length buckets inside each signal length bucket.')
+    parser.add_argument('--prefetch',
+                        type = int,
+                        default = 5,
+                        help='Number of batches prepared ahead in background, 0 to disable prefetching.')
     parser.add_argument('--threads',
                         type = int,
                         default = 0, 
@@ -220,6 +511,12 @@ if __name__ == "__main__":
                         help = 'Clip the gradient by the gradient_clip x normalization, a good estimate is 5.')
     parser.add_argument('--retrain', dest='retrain', action='store_true',
                         help='Set retrain to true')
+    parser.add_argument('--cache_compressor',
+                        default = None,
+                        choices = ['zlib','lzma'],
+                        help='Store the signal in a new training cache losslessly compressed by zlib or lzma, default is uncompressed.')
+    parser.add_argument('--tf_data',dest='tf_data',action='store_true',
+                        help="Feed the training data through a tf.data pipeline over the hdf5 cache.")
     parser.add_argument('--read_cache',dest='read_cache',action='store_true',
                         help="Read from cached hdf5 file.")
     parser.set_defaults(retrain=False)
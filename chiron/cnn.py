@@ -160,7 +160,9 @@ def batchnorm(inp, scope, training, decay=0.99, epsilon=1e-5):
         def population_statistics():
             return tf.nn.batch_normalization(inp, pop_mean, pop_var, offset, scale, epsilon)
 
-        return tf.cond(training, batch_statistics, population_statistics)
+        # smart_cond builds only the population branch when training is a
+        # constant, so a frozen inference graph has no statistics update ops.
+        return tf.contrib.framework.smart_cond(training, batch_statistics, population_statistics)
 
 
 def simple_global_bn(inp, name):
@@ -345,7 +347,9 @@ def getcnnfeature(signal, training, cnn_config):
     # TODO: Read the structure hyper parameters from Json file.
     signal_shape = signal.get_shape().as_list()
     batch_n = tf.shape(signal)[0]
-    net = tf.reshape(signal, [batch_n, 1, signal_shape[1], 1])
+    # The segment length can be left unknown (None) for a variable length input.
+    signal_len = -1 if signal_shape[1] is None else signal_shape[1]
+    net = tf.reshape(signal, [batch_n, 1, signal_len, 1])
     net_name = cnn_config['model']
     model_dict = {'dna_model1': DNA_model1, 
                   'rna_model1': RNA_model1,
@@ -365,8 +369,9 @@ def getcnnfeature(signal, training, cnn_config):
     else:
         net = model_dict[net_name](net,training)
     feashape = net.get_shape().as_list()
-    print("CNN output has the segment length %d, and %d channels"%(feashape[2],feashape[3]))
-    net = tf.reshape(net, [batch_n, feashape[2],
+    print("CNN output has the segment length %s, and %d channels"%(feashape[2],feashape[3]))
+    fea_len = -1 if feashape[2] is None else feashape[2]
+    net = tf.reshape(net, [batch_n, fea_len,
                             feashape[3]], name='fea_rs')
     return net
 
@@ -635,11 +640,12 @@ def getcnnlogit(fea, outnum=5):
 
     feashape = fea.get_shape().as_list()
     print(feashape)
+    out_shape = [tf.shape(fea)[i] if feashape[i] is None else feashape[i] for i in range(2)]
     fea_len = feashape[-1]
     fea = tf.reshape(fea, [-1, fea_len])
     W = tf.get_variable("logit_weights", shape=[
                         fea_len, outnum], initializer=tf.contrib.layers.xavier_initializer())
     b = tf.get_variable("logit_bias", shape=[
                         outnum], initializer=tf.contrib.layers.xavier_initializer())
-    return tf.reshape(tf.nn.bias_add(tf.matmul(fea, W), b, name='cnn_logits'), [feashape[0], feashape[1], outnum],
+    return tf.reshape(tf.nn.bias_add(tf.matmul(fea, W), b, name='cnn_logits'), [out_shape[0], out_shape[1], outnum],
                       name='cnnlogits_rs')
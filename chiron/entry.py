@@ -38,6 +38,9 @@ def evaluation(args):
     FLAGS.polya = None
     FLAGS.idname = False
     FLAGS.delimiter="\n"
+    FLAGS.read_chunk = 200
+    FLAGS.archive = False
+    FLAGS.archive_compressor = 'zlib'
     if args.mode=='rna':
         args.reverse_fast5 = True
     else:
@@ -50,6 +53,9 @@ def evaluation(args):
 def export(args):
     raw.run(args)
 
+def freeze(args):
+    chiron_eval.freeze(args)
+
 def set_paras(args,p):
     args.start = p['start'] if args.start is None else args.start
     args.batch_size=p['batch_size'] if args.batch_size is None else args.batch_size
@@ -69,7 +75,7 @@ def main(arguments=sys.argv[1:]):
     parser_call = subparsers.add_parser('call', description='Perform basecalling', help='Perform basecalling.')
     parser_call.add_argument('-i', '--input', required=True, help="File path or Folder path to the fast5 file.")
     parser_call.add_argument('-o', '--output', required=True, help="Output folder path")
-    parser_call.add_argument('-m', '--model',type = str, default=model_default_path, help="model folder path")
+    parser_call.add_argument('-m', '--model',type = str, default=model_default_path, help="model folder path, or a frozen graph .pb file given by chiron freeze")
     parser_call.add_argument('-s', '--start', type=int, default=None, help="Start index of the signal file.")
     parser_call.add_argument('-b', '--batch_size', type=int, default=None,
                              help="Batch size for run, bigger batch_size will increase the processing speed but require larger RAM load")
@@ -77,6 +83,8 @@ def main(arguments=sys.argv[1:]):
     parser_call.add_argument('-j', '--jump', type=int, default=None, help="Step size for segment")
     parser_call.add_argument('-t', '--threads', type=int, default=None,
                              help="Threads number, default is 0, which use all the available threads.")
+    parser_call.add_argument('--workers', type=int, default=1,
+                             help="Number of basecalling pipelines, the pipelines run as threads sharing one model session, so the weights are loaded once.")
     parser_call.add_argument('-e', '--extension', default='fastq', help="Output file type.")
     parser_call.add_argument('--beam', type=int, default=None,
                              help="Beam width used in beam search decoder, default is 50, set to 0 to use a greedy decoder. Large beam width give better decoding result but require longer decoding time.")
@@ -101,8 +109,33 @@ def main(arguments=sys.argv[1:]):
                         help='Basecall group Nanoraw resquiggle into. Default is Basecall_1D_000')
     parser_export.add_argument('--basecall_subgroup', default='BaseCalled_template',
                         help='Basecall subgroup Nanoraw resquiggle into. Default is BaseCalled_template')
+    parser_export.add_argument('-b', '--batch', type = int, default=4000,
+                        help="Number of files per batches.")
+    parser_export.add_argument('--unit',dest='unit',action='store_true',help='Use the pA unit instead of the original digital signal.')
+    parser_export.add_argument('--mode',default = 'dna',
+                        help='Type of data to basecall, default is dna, can be chosen from dna, rna and methylation(under construction)')
+    parser_export.add_argument('--min_bps',default = 0, type =int, help="The minimum number of labels that has to be in each read.")
+    parser_export.add_argument('--n_errors',default = 5, type = int, help="The number of errors that are going to be recorded.")
+    parser_export.add_argument('--threads',default = 0, type = int, help="Number of processes, default 0 use all the cpus.")
+    parser_export.add_argument('--format',default = 'text', choices = ['text','binary','archive'],
+                        help="Output format, text write .signal and .label files, binary write .signal.npy and .label.npy files, archive write all the reads into a single read archive reads.h5.")
+    parser_export.add_argument('--archive_compressor',default = 'zlib', choices = ['zlib','lzma'],
+                        help="Compressor of the signal codec used by the archive format.")
+    parser_export.add_argument('--retry_failed',action='store_true',help="Retry the files recorded as failed in the manifest.")
     parser_export.set_defaults(func=export)
 
+    # parser for 'freeze' command
+    parser_freeze = subparsers.add_parser('freeze', description='Freeze a model into an inference graph.',
+                                          help='Freeze a model into an inference graph for chiron call.')
+    parser_freeze.add_argument('-m', '--model', type = str, default=model_default_path, help="model folder path")
+    parser_freeze.add_argument('-o', '--output', default=None,
+                               help="Output graph file, default is frozen_graph.pb in the model folder.")
+    parser_freeze.add_argument('-b', '--batch_size', type=int, default=None,
+                               help="Batch size the graph is frozen with, default is None, the graph takes any batch size.")
+    parser_freeze.add_argument('-l', '--segment_len', type=int, default=500,
+                               help="Segment length the ratio of the model is computed on, the graph takes segments of any length.")
+    parser_freeze.set_defaults(func=freeze)
+
     # parser for 'train' command
     parser_train = subparsers.add_parser('train', description='Model training', help='Train a model.')
     parser_train.add_argument('-i', '--data_dir', required = True,
@@ -134,6 +167,17 @@ def main(arguments=sys.argv[1:]):
                         type = int,
                         default = 0, 
                         help='Resample the reads data every n epoches, with an increasing initial offset.')
+    parser_train.add_argument('--bucket_boundaries',
+                        default = None,
+                        help='Comma separated segment lengths, e.g. 200,300,400. Batches are drawn from a single length bucket and trimmed to its boundary, one graph is compiled per boundary, the boundaries should be multiples of the CNN stride.')
+    parser_train.add_argument('--label_buckets',
+                        type = int,
+                        default = 1,
+                        help='Number of label length buckets inside each signal length bucket.')
+    parser_train.add_argument('--prefetch',
+                        type = int,
+                        default = 5,
+                        help='Number of batches prepared ahead in background, 0 to disable prefetching.')
     parser_train.add_argument('--threads',
                         type = int,
                         default = 0, 
@@ -144,6 +188,12 @@ def main(arguments=sys.argv[1:]):
                         help='The increament of initial offset if the resample_after_epoch has been set.')
     parser_train.add_argument('--retrain', dest='retrain', action='store_true',
                         help='Set retrain to true')
+    parser_train.add_argument('--cache_compressor',
+                        default = None,
+                        choices = ['zlib','lzma'],
+                        help='Store the signal in a new training cache losslessly compressed by zlib or lzma, default is uncompressed.')
+    parser_train.add_argument('--tf_data',dest='tf_data',action='store_true',
+                        help="Feed the training data through a tf.data pipeline over the hdf5 cache.")
     parser_train.add_argument('--read_cache',dest='read_cache',action='store_true',
                         help="Read from cached hdf5 file.")
     parser_train.set_defaults(func=chiron_rcnn_train.run)
@@ -69,6 +69,8 @@ def rnn_layers(x,
     # https://stackoverflow.com/questions/49242266/difference-between-multirnncell-and-stack-bidirectional-dynamic-rnn-in-tensorflo
     batch_size = tf.shape(lasth)[0]
     max_time = lasth.get_shape().as_list()[1]
+    if max_time is None:
+        max_time = tf.shape(lasth)[1]
     with tf.variable_scope('rnn_fnn_layer'):
         weight_out = _variable_on_cpu(name='weights',
                                       shape = [2, hidden_num],
@@ -146,6 +148,8 @@ def rnn_layers_rna(x,
     # shape of lasth [batch_size,max_time,hidden_num*2]
     batch_size = tf.shape(lasth)[0]
     max_time = lasth.get_shape().as_list()[1]
+    if max_time is None:
+        max_time = tf.shape(lasth)[1]
     with tf.variable_scope('rnn_fnn_layer'):
         weight_out = _variable_on_cpu(name='weights',
                                       shape = [2, hidden_num],
@@ -0,0 +1,237 @@
+# Copyright 2017 The Chiron Authors. All Rights Reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Packed read archive, a single hdf5 file hold the signal, label and reference
+of a collection of reads with a read id index.
+
+Layout:
+    /signal                 concatenated signal of all reads, or if the archive
+                            is compressed, the signal of each read encoded by
+                            the signal codec (see codec.py).
+    /label/start            concatenated label start of all reads.
+    /label/end              concatenated label end of all reads.
+    /label/base             concatenated label base of all reads.
+    /reference              reference (fastq/fasta string) of each read.
+    /index/read_id          read id of each read.
+    /index/signal_offset    signal of read i is signal[offset[i]:offset[i+1]].
+    /index/label_offset     label of read i is label[offset[i]:offset[i+1]].
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import h5py
+import numpy as np
+from chiron.utils import codec
+from chiron.utils.codec import to_str
+
+ARCHIVE_SUFFIX = '.h5'
+ARCHIVE_SEP = '::'
+LABEL_FORMAT = np.dtype([('start', '<i8'),
+                         ('end', '<i8'),
+                         ('base', 'S1')])
+
+
+def is_archive(file_path):
+    """If the file_path is a read archive."""
+    if not os.path.isfile(file_path):
+        return False
+    try:
+        with h5py.File(file_path, 'r') as root:
+            return 'index/read_id' in root
+    except (IOError, OSError):
+        return False
+
+
+def entry_path(archive_path, read_id):
+    """The path of a read inside an archive, can be used where a signal or
+    label file path is expected by chiron_input."""
+    return archive_path + ARCHIVE_SEP + read_id
+
+
+def split_entry_path(file_path):
+    """Split a path given by entry_path, return (archive_path, read_id), the
+    read_id is None if the path is not a path into an archive."""
+    if ARCHIVE_SEP not in file_path:
+        return file_path, None
+    archive_path, read_id = file_path.rsplit(ARCHIVE_SEP, 1)
+    return archive_path, read_id
+
+
+class ReadArchive(object):
+    """
+    Read and write a packed read archive.
+    Args:
+        file_path: The archive file.
+        mode: 'r' to read, 'w' to create a new archive, 'a' to append reads
+            to an existing archive.
+        buffer_size: Number of signal bytes buffered before writing into
+            the archive.
+        compressor: The compressor used by the signal codec for a new
+            archive, can be zlib, lzma or None for an uncompressed archive.
+            An existing archive keeps its own format.
+    """
+
+    def __init__(self, file_path, mode='r', buffer_size=2**26, compressor='zlib'):
+        self.file_path = file_path
+        self.mode = mode
+        self.buffer_size = buffer_size
+        self.root = h5py.File(file_path, mode)
+        if mode != 'r' and 'index/read_id' not in self.root:
+            self._create(compressor)
+        if 'compressor' in self.root['signal'].attrs:
+            self.compressor = to_str(self.root['signal'].attrs['compressor'])
+        else:
+            self.compressor = None
+        self._index = None
+        self._buffer = {'signal': [], 'start': [], 'end': [], 'base': [],
+                        'reference': [], 'read_id': [],
+                        'signal_offset': [], 'label_offset': []}
+        self._signal_n = int(self.root['index/signal_offset'][-1])
+        self._label_n = int(self.root['index/label_offset'][-1])
+        self._buffer_n = 0
+
+    def _create(self, compressor):
+        str_dtype = h5py.special_dtype(vlen=str)
+        if compressor is None:
+            self.root.create_dataset('signal', dtype='float32', shape=(0,), maxshape=(None,), chunks=True)
+        else:
+            signal_h = self.root.create_dataset('signal',
+                                                dtype=h5py.special_dtype(vlen=np.dtype('uint8')),
+                                                shape=(0,), maxshape=(None,), chunks=True)
+            signal_h.attrs['compressor'] = compressor
+        self.root.create_dataset('label/start', dtype='int64', shape=(0,), maxshape=(None,), chunks=True)
+        self.root.create_dataset('label/end', dtype='int64', shape=(0,), maxshape=(None,), chunks=True)
+        self.root.create_dataset('label/base', dtype='S1', shape=(0,), maxshape=(None,), chunks=True)
+        self.root.create_dataset('reference', dtype=str_dtype, shape=(0,), maxshape=(None,), chunks=True)
+        self.root.create_dataset('index/read_id', dtype=str_dtype, shape=(0,), maxshape=(None,), chunks=True)
+        self.root.create_dataset('index/signal_offset', dtype='int64', data=[0], maxshape=(None,), chunks=True)
+        self.root.create_dataset('index/label_offset', dtype='int64', data=[0], maxshape=(None,), chunks=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.root['index/read_id']) + len(self._buffer['read_id'])
+
+    def __contains__(self, read_id):
+        return read_id in self.index
+
+    def __iter__(self):
+        return iter(self.read_ids)
+
+    @property
+    def read_ids(self):
+        return [to_str(x) for x in self.root['index/read_id'][:]]
+
+    @property
+    def index(self):
+        """A dict map the read id to its position in the archive."""
+        if self._index is None:
+            self._index = dict((read_id, i) for i, read_id in enumerate(self.read_ids))
+        return self._index
+
+    def _position(self, read):
+        if isinstance(read, (int, np.integer)):
+            return read
+        return self.index[read]
+
+    def signal(self, read):
+        """The signal of a read given by the read id or the position."""
+        i = self._position(read)
+        if self.compressor is not None:
+            return codec.decode(self.root['signal'][i]).astype(np.float32)
+        offset = self.root['index/signal_offset'][i:i + 2]
+        return self.root['signal'][offset[0]:offset[1]]
+
+    def label(self, read):
+        """The label of a read as a LABEL_FORMAT array."""
+        i = self._position(read)
+        offset = self.root['index/label_offset'][i:i + 2]
+        label = np.empty(offset[1] - offset[0], dtype=LABEL_FORMAT)
+        for field in LABEL_FORMAT.names:
+            label[field] = self.root['label/' + field][offset[0]:offset[1]]
+        return label
+
+    def reference(self, read):
+        return to_str(self.root['reference'][self._position(read)])
+
+    def add(self, read_id, signal, label=None, reference=''):
+        """
+        Add a read into the archive.
+        Args:
+            read_id: The read id, should be unique in the archive.
+            signal: 1D signal array.
+            label: A list of (start, end, base) or a LABEL_FORMAT array.
+            reference: The reference string of the read.
+        """
+        buffer = self._buffer
+        signal = np.asarray(signal, dtype=np.float32)
+        reference = to_str(reference)
+        if label is None:
+            label = np.empty(0, dtype=LABEL_FORMAT)
+        elif not isinstance(label, np.ndarray) or label.dtype != LABEL_FORMAT:
+            label = np.asarray([tuple(x) for x in label], dtype=LABEL_FORMAT)
+        if self.compressor is None:
+            buffer['signal'].append(signal)
+        else:
+            buffer['signal'].append(np.frombuffer(codec.encode(signal, self.compressor), dtype=np.uint8))
+        buffer['start'].append(label['start'])
+        buffer['end'].append(label['end'])
+        buffer['base'].append(label['base'])
+        buffer['reference'].append(reference)
+        buffer['read_id'].append(read_id)
+        self._signal_n += len(signal)
+        self._label_n += len(label)
+        buffer['signal_offset'].append(self._signal_n)
+        buffer['label_offset'].append(self._label_n)
+        self._buffer_n += signal.nbytes
+        self._index = None
+        if self._buffer_n > self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered reads into the archive."""
+        buffer = self._buffer
+        if len(buffer['read_id']) == 0:
+            return
+        if self.compressor is None:
+            _append(self.root['signal'], np.concatenate(buffer['signal']))
+        else:
+            signal_h = self.root['signal']
+            length = len(signal_h)
+            signal_h.resize(length + len(buffer['signal']), axis=0)
+            # Written one by one, h5py can't assign a slice of equal length
+            # variable length arrays.
+            for i, signal in enumerate(buffer['signal']):
+                signal_h[length + i] = signal
+        for entry, key in [('label/start', 'start'),
+                           ('label/end', 'end'),
+                           ('label/base', 'base')]:
+            _append(self.root[entry], np.concatenate(buffer[key]))
+        for entry, key in [('reference', 'reference'),
+                           ('index/read_id', 'read_id'),
+                           ('index/signal_offset', 'signal_offset'),
+                           ('index/label_offset', 'label_offset')]:
+            _append(self.root[entry], buffer[key])
+        for key in buffer:
+            del buffer[key][:]
+        self._buffer_n = 0
+        self.root.flush()
+
+    def close(self):
+        if self.mode != 'r':
+            self.flush()
+        self.root.close()
+
+
+def _append(handle, values):
+    if len(values) == 0:
+        return
+    length = len(handle)
+    handle.resize(length + len(values), axis=0)
+    handle[length:] = values
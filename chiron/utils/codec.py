@@ -0,0 +1,256 @@
+# Copyright 2017 The Chiron Authors. All Rights Reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Lossless codec for the signal.
+
+A signal is encoded by:
+    1. Delta encoding, the raw signal is strongly correlated between the
+       neighbour samples so the differences are small. Integer valued signals
+       are delta encoded on their values, float signals on their bit patterns.
+    2. Zigzag encoding, map the signed differences to unsigned integers so
+       small negative differences are also small numbers.
+    3. Byte-packing, the differences are packed into the smallest unsigned
+       integer type that holds them and the bytes are shuffled so the bytes
+       of the same significance are stored together.
+    4. Compression by zlib or lzma.
+"""
+from __future__ import absolute_import
+import struct
+import zlib
+import h5py
+import numpy as np
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+HEADER = struct.Struct('<4sBBBBQ')
+MAGIC = b'CSG1'
+COMPRESSORS = ['none', 'zlib', 'lzma']
+DTYPES = [np.dtype(x) for x in ['int8', 'int16', 'int32', 'int64', 'uint8', 'uint16',
+                                'uint32', 'uint64', 'float32', 'float64']]
+INT_KIND = 0
+FLOAT_KIND = 1
+
+
+def _compress(data, compressor, level):
+    if compressor == 'zlib':
+        return zlib.compress(data, level)
+    elif compressor == 'lzma':
+        if lzma is None:
+            raise ImportError("lzma compressor requires Python 3.")
+        return lzma.compress(data, preset=level)
+    return data
+
+
+def _decompress(data, compressor):
+    if compressor == 'zlib':
+        return zlib.decompress(data)
+    elif compressor == 'lzma':
+        return lzma.decompress(data)
+    return data
+
+
+def encode(signal, compressor='zlib', level=6):
+    """
+    Encode a 1D signal array.
+    Args:
+        signal: 1D integer or float array.
+        compressor: Can be one of the COMPRESSORS.
+        level: Compression level.
+    Return:
+        The encoded bytes.
+    """
+    if compressor not in COMPRESSORS:
+        raise ValueError("Unknown compressor %s, should be one of %s." % (compressor, COMPRESSORS))
+    signal = np.ascontiguousarray(signal).reshape(-1)
+    dtype = signal.dtype
+    if dtype not in DTYPES:
+        raise TypeError("Can't encode a signal of type %s." % (dtype))
+    kind = INT_KIND
+    if dtype.kind == 'f':
+        if _is_integral(signal):
+            # Signal in the digital unit saved as float, encode it as integer.
+            values = signal.astype(np.int64).view(np.uint64)
+        else:
+            kind = FLOAT_KIND
+            values = signal.view('u%d' % (dtype.itemsize)).astype(np.uint64)
+    else:
+        values = signal.astype(np.int64).view(np.uint64)
+    delta = np.diff(np.concatenate([np.zeros(1, dtype=np.uint64), values])).view(np.int64)
+    zigzag = ((delta << 1) ^ (delta >> 63)).view(np.uint64)
+    max_value = int(zigzag.max()) if len(zigzag) else 0
+    width = 1
+    while width < 8 and max_value >= 2**(8 * width):
+        width *= 2
+    packed = zigzag.astype('<u%d' % (width)).view(np.uint8).reshape(-1, width)
+    payload = np.ascontiguousarray(packed.T).tobytes()
+    header = HEADER.pack(MAGIC,
+                         COMPRESSORS.index(compressor),
+                         kind,
+                         width,
+                         DTYPES.index(dtype),
+                         len(signal))
+    return header + _compress(payload, compressor, level)
+
+
+def _is_integral(signal):
+    """If a float signal is held exactly by the integer encoding, NaN, inf
+    and -0.0 are only kept by the bit pattern encoding."""
+    if len(signal) == 0:
+        return True
+    if not np.isfinite(signal).all() or np.abs(signal).max() >= 2**24:
+        return False
+    if np.signbit(signal[signal == 0]).any():
+        return False
+    return np.array_equal(np.trunc(signal), signal)
+
+
+def _unpack(zigzag, kind, dtype):
+    """Undo the zigzag and delta encoding along the last axis."""
+    delta = (zigzag >> np.uint64(1)) ^ (np.uint64(0) - (zigzag & np.uint64(1)))
+    values = np.cumsum(delta, axis=-1, dtype=np.uint64)
+    if kind == FLOAT_KIND:
+        return values.astype('u%d' % (dtype.itemsize)).view(dtype)
+    return values.view(np.int64).astype(dtype)
+
+
+def decode(data):
+    """
+    Decode the bytes given by encode.
+    Return:
+        The signal array with the original dtype.
+    """
+    data = bytes(data)
+    magic, compressor, kind, width, dtype, length = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a signal encoded by the codec.")
+    dtype = DTYPES[dtype]
+    payload = _decompress(data[HEADER.size:], COMPRESSORS[compressor])
+    packed = np.frombuffer(payload, dtype=np.uint8).reshape(width, length)
+    zigzag = np.ascontiguousarray(packed.T).view('<u%d' % (width)).reshape(-1).astype(np.uint64)
+    return _unpack(zigzag, kind, dtype)
+
+
+def decode_rows(rows, length, dtype):
+    """
+    Decode a batch of encoded signals of the same length into a 2D array.
+    Each row is decompressed on its own, the rows with the same header are
+    then unpacked together by one vectorised delta decoding.
+    Args:
+        rows: A sequence of the bytes given by encode.
+        length: The length of every signal.
+        dtype: The dtype of the output array.
+    Return:
+        An array of shape (len(rows), length).
+    """
+    out = np.empty((len(rows), length), dtype=dtype)
+    groups = {}
+    for i, data in enumerate(rows):
+        data = bytes(data)
+        magic, compressor, kind, width, row_dtype, row_length = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("Not a signal encoded by the codec.")
+        if row_length != length:
+            raise ValueError("Row %d has length %d, expect %d." % (i, row_length, length))
+        payload = _decompress(data[HEADER.size:], COMPRESSORS[compressor])
+        groups.setdefault((kind, width, row_dtype), ([], []))
+        groups[(kind, width, row_dtype)][0].append(i)
+        groups[(kind, width, row_dtype)][1].append(payload)
+    for (kind, width, row_dtype), (index, payloads) in groups.items():
+        packed = np.frombuffer(b''.join(payloads), dtype=np.uint8).reshape(len(index), width, length)
+        zigzag = np.ascontiguousarray(packed.transpose(0, 2, 1)).view('<u%d' % (width))
+        zigzag = zigzag.reshape(len(index), length).astype(np.uint64)
+        out[index] = _unpack(zigzag, kind, DTYPES[row_dtype])
+    return out
+
+
+class EncodedRecords(object):
+    """
+    A 2D float32 array of shape (N, width) stored row by row as encoded signals
+    in a 1D variable length uint8 hdf5 dataset, supports the part of the
+    h5py dataset interface used by the training cache.
+    Args:
+        handle: The hdf5 dataset created by create_encoded_records.
+    """
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.width = int(handle.attrs['width'])
+        self.dtype = np.dtype(to_str(handle.attrs['dtype']))
+
+    @property
+    def shape(self):
+        return (len(self.handle), self.width)
+
+    def __len__(self):
+        return len(self.handle)
+
+    def resize(self, size, axis=0):
+        if axis == 0:
+            self.handle.resize(size, axis=0)
+        elif size > self.width:
+            raise ValueError("Can't widen the encoded records from %d to %d." % (self.width, size))
+
+    def _decode_rows(self, rows):
+        return decode_rows(rows, self.width, self.dtype)
+
+    def __getitem__(self, val):
+        if isinstance(val, (int, np.integer)):
+            return decode(self.handle[val]).astype(self.dtype)
+        if isinstance(val, slice):
+            return self._decode_rows(self.handle[val])
+        val = np.asarray(val)
+        if val.dtype == bool:
+            val = np.where(val)[0]
+        order = np.argsort(val)
+        rows = np.empty(len(val), dtype=object)
+        # h5py requires increasing indexes.
+        unique, inverse = np.unique(val[order], return_inverse=True)
+        fetched = self.handle[unique.tolist()] if len(unique) else []
+        rows[order] = [fetched[i] for i in inverse]
+        return self._decode_rows(rows)
+
+    def __setitem__(self, val, rows):
+        compressor = to_str(self.handle.attrs['compressor'])
+        if isinstance(val, (int, np.integer)):
+            self.handle[val] = _as_row(encode(np.asarray(rows, dtype=self.dtype), compressor))
+            return
+        # Written row by row, h5py can't assign a slice of equal length
+        # variable length rows.
+        for i, row in zip(range(len(self.handle))[val], rows):
+            self.handle[i] = _as_row(encode(np.asarray(row, dtype=self.dtype), compressor))
+
+
+def _as_row(data):
+    return np.frombuffer(data, dtype=np.uint8)
+
+
+def to_str(value):
+    """Decode a bytes value read from hdf5 into str."""
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def create_encoded_records(group, name, width, compressor='zlib', dtype='float32'):
+    """Create an empty dataset for EncodedRecords in the hdf5 group."""
+    handle = group.create_dataset(name,
+                                  dtype=h5py.special_dtype(vlen=np.dtype('uint8')),
+                                  shape=(0,),
+                                  maxshape=(None,),
+                                  chunks=True)
+    handle.attrs['codec'] = 'signal'
+    handle.attrs['compressor'] = compressor
+    handle.attrs['width'] = width
+    handle.attrs['dtype'] = dtype
+    return EncodedRecords(handle)
+
+
+def records(handle):
+    """Wrap the dataset with EncodedRecords if it is encoded by this codec."""
+    if 'codec' in handle.attrs:
+        return EncodedRecords(handle)
+    return handle
@@ -0,0 +1,38 @@
+# Copyright 2017 The Chiron Authors. All Rights Reserved.
+#
+#This Source Code Form is subject to the terms of the Mozilla Public
+#License, v. 2.0. If a copy of the MPL was not distributed with this
+#file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#Signal codec round-trip test
+from __future__ import absolute_import
+import numpy as np
+
+from chiron.utils import codec
+
+
+def _same_bits(a, b):
+    return a.dtype == b.dtype and a.tobytes() == b.tobytes()
+
+
+def test_round_trip():
+    rng = np.random.RandomState(0)
+    signals = [np.cumsum(rng.randint(-20, 20, 1000)).astype(np.int16),
+               np.cumsum(rng.randint(-20, 20, 1000)).astype(np.float32),
+               rng.randn(1000).astype(np.float32),
+               rng.randn(1000),
+               np.array([0.0, -0.0, np.nan, np.inf, -np.inf, 1.0], dtype=np.float32),
+               np.array([-0.0, 1.0, 2.0], dtype=np.float64),
+               np.array([], dtype=np.float32)]
+    for compressor in codec.COMPRESSORS:
+        for signal in signals:
+            assert _same_bits(codec.decode(codec.encode(signal, compressor)), signal)
+
+
+def test_decode_rows():
+    rng = np.random.RandomState(1)
+    rows = [np.cumsum(rng.randint(-5, 5, 64)).astype(np.float32) for _ in range(5)]
+    rows.append(rng.randn(64).astype(np.float32))
+    rows.append(np.full(64, -0.0, dtype=np.float32))
+    decoded = codec.decode_rows([codec.encode(row) for row in rows], 64, np.float32)
+    assert _same_bits(decoded, np.stack(rows))
@@ -0,0 +1,157 @@
+# Copyright 2017 The Chiron Authors. All Rights Reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Banded dynamic time warping between the raw signal and the expected current
+of the reference sequence given by a k-mer pore model.
+
+Every signal sample is assigned to one reference base and every base gets at
+least one sample, so the cost of assigning samples k..i to base j is
+    D[i,j] = C_j(i) + min_{k<=i} (D[k-1,j-1] - C_j(k-1))
+where C_j is the cumulative distance between the signal and the expected
+current of base j. The inner minimum is a running minimum, so each base is
+solved by a few vectorised NumPy operations over the band of samples around
+the diagonal.
+"""
+from __future__ import absolute_import
+import numpy as np
+from chiron.utils.norm import median_mad
+
+# Maximum default half width of the band in samples.
+MAX_BAND = 500
+BASE_CODE = dict((base, i) for i, base in enumerate('ACGT'))
+BASE_CODE['U'] = BASE_CODE['T']
+
+
+def read_kmer_model(model_f):
+    """
+    Read a k-mer pore model, a text file with the k-mer in the first column
+    and its mean current level in the second column, lines that can't be
+    parsed (e.g. the header) are skipped.
+    Return:
+        levels: A 4**k array of the level of each k-mer indexed by the k-mer
+            code, the k-mers missing in the model get the mean level.
+        k: The k-mer size.
+    """
+    model = {}
+    with open(model_f, 'r') as f:
+        for line in f:
+            split_line = line.split()
+            if len(split_line) < 2:
+                continue
+            try:
+                model[split_line[0].upper()] = float(split_line[1])
+            except ValueError:
+                continue
+    if len(model) == 0:
+        raise ValueError("No k-mer found in the model file %s" % (model_f))
+    k = len(next(iter(model)))
+    levels = np.full(4**k, np.nan)
+    for kmer, level in model.items():
+        if len(kmer) != k or any(base not in BASE_CODE for base in kmer):
+            continue
+        levels[kmer_code(kmer, k)[0]] = level
+    levels[np.isnan(levels)] = np.nanmean(levels)
+    return levels, k
+
+
+def kmer_code(seq, k):
+    """
+    The code of the k-mer centred on every base of the sequence, the k-mers
+    are clipped at the two ends of the sequence.
+    """
+    if isinstance(seq, bytes):
+        seq = seq.decode('utf-8')
+    code = np.asarray([BASE_CODE.get(base, 0) for base in seq.upper()], dtype=np.int64)
+    if len(code) < k:
+        code = np.concatenate([code, np.repeat(code[-1:], k - len(code))])
+    kmers = np.zeros(len(code) - k + 1, dtype=np.int64)
+    for offset in range(k):
+        kmers = kmers * 4 + code[offset:len(code) - k + 1 + offset]
+    position = np.clip(np.arange(len(seq)) - k // 2, 0, len(kmers) - 1)
+    return kmers[position]
+
+
+def expected_signal(seq, levels, k):
+    """The normalized expected current of every base of the sequence."""
+    expected = levels[kmer_code(seq, k)]
+    median, mad = median_mad(expected)
+    return (expected - median) / (mad if mad > 0 else 1.0)
+
+
+def banded_dtw(signal, expected, band=None):
+    """
+    Align the signal to the expected current.
+    Args:
+        signal: 1D array of N normalized signal.
+        expected: 1D array of M normalized expected current, M <= N.
+        band: Half width of the band in samples around the diagonal, default
+            is N/M*20 capped at MAX_BAND. The back pointers take
+            4*M*(2*band+N/M) bytes.
+    Return:
+        start: 1D int array of the first sample of each base.
+        length: 1D int array of the number of samples of each base.
+    """
+    signal = np.asarray(signal, dtype=np.float64)
+    expected = np.asarray(expected, dtype=np.float64)
+    n, m = len(signal), len(expected)
+    if m == 0 or n < m:
+        raise ValueError("Can't align %d samples to %d bases." % (n, m))
+    if band is None:
+        band = min(int(20 * n / m), MAX_BAND)
+    width = min(n, int(np.ceil(float(n) / m)) + 2 * band)
+    lows = np.clip(np.arange(m) * n // m - band, 0, n - width)
+    rows = np.arange(width)
+    args = np.empty((m, width), dtype=np.int32)
+    prev_cost = None
+    prev_low = 0
+    for j in range(m):
+        low = lows[j]
+        cumsum = np.cumsum(np.abs(signal[low:low + width] - expected[j]))
+        # The cost of the previous base ending at sample k-1, for k in the band.
+        shifted = np.full(width, np.inf)
+        if j == 0:
+            shifted[0] = 0 if low == 0 else np.inf
+        else:
+            prev_idx = low - 1 + rows - prev_low
+            valid = (prev_idx >= 0) & (prev_idx < width)
+            shifted[valid] = prev_cost[prev_idx[valid]]
+        candidates = shifted - np.concatenate([[0], cumsum[:-1]])
+        running_min = np.minimum.accumulate(candidates)
+        args[j] = np.maximum.accumulate(np.where(candidates == running_min, rows, 0)) + low
+        prev_cost = cumsum + running_min
+        prev_low = low
+    if not np.isfinite(prev_cost[n - 1 - prev_low]):
+        raise ValueError("No alignment found in the band, try a wider band.")
+    start = np.empty(m, dtype=np.int64)
+    end = n - 1
+    for j in range(m - 1, -1, -1):
+        start[j] = args[j, end - lows[j]]
+        end = start[j] - 1
+    length = np.diff(np.concatenate([start, [n]]))
+    return start, length
+
+
+def resquiggle(raw_signal, ref_seq, levels, k, band=None):
+    """
+    Resquiggle the raw signal to the reference sequence.
+    Args:
+        raw_signal: 1D int16 raw signal.
+        ref_seq: The reference sequence.
+        levels, k: The k-mer model given by read_kmer_model.
+        band: Half width of the DTW band, see banded_dtw.
+    Return:
+        A list of (raw, norm_raw, norm_trans, start, length, base) of every
+        base, where raw is the first raw sample of the base, norm_raw is the
+        mean normalized signal and norm_trans is the expected current.
+    """
+    if isinstance(ref_seq, bytes):
+        ref_seq = ref_seq.decode('utf-8')
+    raw_signal = np.asarray(raw_signal)
+    median, mad = median_mad(raw_signal)
+    signal = (raw_signal - median) / (mad if mad > 0 else 1.0)
+    expected = expected_signal(ref_seq, levels, k)
+    start, length = banded_dtw(signal, expected, band)
+    norm_raw = np.add.reduceat(signal, start) / length
+    return list(zip(raw_signal[start], norm_raw, expected, start, length, ref_seq))
@@ -0,0 +1,30 @@
+# Copyright 2017 The Chiron Authors. All Rights Reserved.
+#
+#This Source Code Form is subject to the terms of the Mozilla Public
+#License, v. 2.0. If a copy of the MPL was not distributed with this
+#file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#Banded DTW test
+from __future__ import absolute_import
+import numpy as np
+
+from chiron.utils.dtw import banded_dtw
+
+
+def test_banded_dtw():
+    rng = np.random.RandomState(0)
+    expected = np.tile([-1.5, 0.5, 1.5, -0.5], 25)
+    length = rng.randint(3, 12, len(expected))
+    signal = np.repeat(expected, length) + rng.randn(length.sum()) * 0.05
+    for band in [None, 40]:
+        start, aln_length = banded_dtw(signal, expected, band)
+        assert np.array_equal(aln_length, length)
+        assert np.array_equal(start, np.cumsum(length) - length)
+
+
+def test_banded_dtw_too_short():
+    try:
+        banded_dtw(np.zeros(3), np.zeros(5))
+    except ValueError:
+        return
+    raise AssertionError("Expect a ValueError.")
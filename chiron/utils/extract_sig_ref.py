@@ -7,15 +7,26 @@
 #Created on Thu May  4 10:57:35 2017
 
 import argparse
+import collections
+import hashlib
 import os
+import time
 import sys
 import h5py
 import logging
 import numpy as np
 from tqdm import tqdm
+from collections import Counter
+from chiron.utils.archive import ReadArchive
 from multiprocessing import Pool
 from multiprocessing import cpu_count
 logger = logging.getLogger(name = 'chiron_call')
+ARCHIVE_FILE = 'raw.h5'
+MANIFEST_FILE = 'extract_manifest.tsv'
+FILE_DONE = '*'
+SINGLE_READ = '-'
+FLUSH_INTERVAL = 5
+FILES_PER_TASK = 16
 def set_logger(log_file):
     global logger
     log_hd = logging.FileHandler(log_file)
@@ -57,7 +68,6 @@ def extract(FLAGS):
     tqdm.monitor_interval = 0
     if FLAGS.threads == 0:
         FLAGS.threads = cpu_count()
-    pool = Pool(FLAGS.threads)
     if FLAGS.polya is not None:
         FLAGS.polya_pair = {}
         with open(FLAGS.polya,'r') as f:
@@ -66,85 +76,344 @@ def extract(FLAGS):
                 FLAGS.polya_pair[(os.path.basename(split_line[0]),split_line[1])] = int(split_line[2])
     else:
         FLAGS.polya_pair = None
-    if FLAGS.recursive:
-        dir_list = os.walk(root_folder)
+    archive_file = os.path.join(out_folder,ARCHIVE_FILE)
+    manifest_file = os.path.join(out_folder,MANIFEST_FILE)
+    params = extract_params(FLAGS)
+    if FLAGS.archive and not os.path.isfile(archive_file):
+        done = {}
     else:
-        dir_list = [root_folder]
-    for dir_tuple in tqdm(dir_list,desc = "Subdirectory processing:",position = 0):
-        if FLAGS.recursive:
-            directory = dir_tuple[0]
-            file_list = dir_tuple[2]
-        else:
-            file_list = os.listdir(dir_tuple)
-            directory = dir_tuple
-        file_list = [(os.path.join(directory,f),FLAGS) for f in file_list]
-        for _ in tqdm(pool.imap_unordered(extract_file_wrapper,file_list),total = len(file_list)):
-            pass
-#            Uncomment to enable debug
-#            if FLAGS.test_number is not None:
-#                if FLAGS.count >= FLAGS.test_number:
-#                    pool.close()
-#                    pool.join()
-#                    return
+        done = read_manifest(manifest_file,params)
+    if len(done):
+        print("Skip the %d files already extracted."%(len([x for x in done.values() if FILE_DONE in x])))
+    file_stats = {}
+    scheduler = TaskScheduler(iter_files(list_files(root_folder,FLAGS.recursive),done,file_stats),
+                              FLAGS.read_chunk,
+                              FLAGS.test_number)
+    running = collections.deque()
+    pool = Pool(FLAGS.threads,initializer = init_worker,initargs = (FLAGS,))
+    errors = Counter()
+    succeed_n = 0
+    if FLAGS.archive:
+        read_archive = ReadArchive(archive_file,
+                                   mode = 'a' if len(done) else 'w',
+                                   compressor = FLAGS.archive_compressor)
+    manifest_lines = []
+    last_flush = time.time()
+    with open(manifest_file,'w' if len(done) == 0 else 'a') as manifest_f, \
+         tqdm(total = FLAGS.test_number,desc = "Extracting reads",position = 0) as pbar:
+        if len(done) == 0:
+            manifest_f.write("#params\t%s\n"%(params))
+        while True:
+            # At most 2*threads tasks are in flight, the chunks left by the
+            # listing chunks are scheduled as their results come back.
+            while len(running) < 2*FLAGS.threads:
+                task = scheduler.next_task()
+                if task is None:
+                    break
+                running.append(pool.apply_async(extract_task,(task,)))
+            if len(running) == 0:
+                break
+            for chunk,succeed,failed,records,rest in running.popleft().get():
+                full_file_n = chunk[0]
+                for read_name,raw_signal,reference in records:
+                    read_archive.add(read_name,raw_signal,reference = reference)
+                size,mtime = file_stats[full_file_n]
+                file_done = scheduler.finish(chunk,len(succeed) + sum(failed.values()),rest)
+                read_ids = succeed + [FILE_DONE] if file_done else succeed
+                for read_id in read_ids:
+                    manifest_lines.append("%s\t%d\t%d\t%s\n"%(full_file_n,size,mtime,read_id))
+                succeed_n += len(succeed)
+                errors.update(failed)
+                pbar.update(len(succeed) + sum(failed.values()))
+            pbar.set_postfix(failed = sum(errors.values()))
+            if time.time() - last_flush > FLUSH_INTERVAL:
+                flush_manifest(manifest_f,manifest_lines,read_archive if FLAGS.archive else None)
+                last_flush = time.time()
+        if FLAGS.archive:
+            read_archive.close()
+        flush_manifest(manifest_f,manifest_lines,None)
     pool.close()
-    pool.join()        
-            
-def extract_file_wrapper(args):
-    global logger
-    full_file_n, FLAGS = args
-    file_n = os.path.basename(full_file_n)
-    if full_file_n.endswith('fast5'):
+    pool.join()
+    report = "Extracted %d reads from %d fast5 files, %d reads failed."%(succeed_n,len(scheduler.chunks_done),sum(errors.values()))
+    logger.info(report)
+    print(report)
+    for error,count in errors.most_common():
+        logger.info("%s: %d reads"%(error,count))
+        print("    %s: %d reads"%(error,count))
+    return errors
+
+def list_files(root_folder,recursive = False):
+    """List the fast5 files under the root_folder."""
+    if recursive:
+        dir_list = os.walk(root_folder)
+    else:
+        dir_list = [(root_folder,[],os.listdir(root_folder))]
+    for directory,_,file_list in dir_list:
+        for f in file_list:
+            if f.endswith('fast5'):
+                yield os.path.join(directory,f)
+
+def extract_params(FLAGS):
+    """Fingerprint of the parameters that change the extraction output."""
+    if FLAGS.polya is not None:
+        polya = (os.path.abspath(FLAGS.polya),os.path.getmtime(FLAGS.polya))
+    else:
+        polya = None
+    params = (FLAGS.mode,FLAGS.unit,polya,FLAGS.idname,FLAGS.delimiter,FLAGS.archive,FLAGS.archive_compressor)
+    return hashlib.sha1(repr(params).encode('utf-8')).hexdigest()
+
+def read_manifest(manifest_file,params):
+    """
+    Read the extraction manifest, which records the reads extracted from every
+    fast5 file, keyed by the path, size and modification time of the file.
+    The manifest is ignored if it's generated with different parameters.
+    Return:
+        A dict map (path, size, mtime) of a fast5 file to the set of the read
+        ids that have been extracted, FILE_DONE in the set means all the reads
+        of the file have been processed, SINGLE_READ is the read id of a
+        single-read fast5 file.
+    """
+    done = {}
+    if not os.path.isfile(manifest_file):
+        return done
+    with open(manifest_file,'r') as f:
+        header = f.readline().rstrip('\n').split('\t')
+        if header != ['#params',params]:
+            return done
+        for line in f:
+            split_line = line.rstrip('\n').split('\t')
+            if len(split_line) != 4:
+                continue
+            full_file_n,size,mtime,read_id = split_line
+            done.setdefault((full_file_n,int(size),int(mtime)),set()).add(read_id)
+    return done
+
+def flush_manifest(manifest_f,manifest_lines,read_archive = None):
+    """Write the manifest lines, the archive is flushed first so a read is
+    never recorded before it's saved."""
+    if read_archive is not None:
+        read_archive.flush()
+    manifest_f.write(''.join(manifest_lines))
+    manifest_f.flush()
+    del manifest_lines[:]
+
+def file_stat(full_file_n):
+    stat = os.stat(full_file_n)
+    return stat.st_size,int(stat.st_mtime*1e6)
+
+def iter_files(file_list,done = None,file_stats = None):
+    """
+    Lazily yield the fast5 files not finished yet. The files are only stat
+    here, they are opened and listed by the workers.
+    Args:
+        file_list: An iterable of the fast5 files.
+        done: The extracted reads given by read_manifest.
+        file_stats: If given, the (size, mtime) of the fast5 files are
+            stored into this dict.
+    Yield:
+        (fast5 file, the set of the read ids already extracted from it)
+    """
+    if done is None:
+        done = {}
+    if file_stats is None:
+        file_stats = {}
+    for full_file_n in file_list:
         try:
-            input_data = h5py.File(full_file_n, 'r')
-        except IOError as e:
-            logger.error(e)
-            raise IOError(e)
-        except Exception as e:
-            logger.error(e)
-            raise Exception(e)
-#        file_version = float(input_data.attrs['file_version'])
-        entries = list(input_data)
-        if 'Raw' in entries:
-            try:
-                raw_signal, reference,readid = extract_file(input_data,full_file_n,FLAGS.mode,FLAGS.unit,FLAGS.polya_pair)
-                if raw_signal is None:
-                    raise ValueError("Fail in extracting raw signal.")
-                if len(raw_signal) == 0:
-                    raise ValueError("Got empty raw signal")
-                    #FLAGS.count += 1
-            except Exception as e:
-                logger.error("Cannot extract file %s. %s"%(full_file_n,e))
-                return
-            if FLAGS.idname:
-                sig_file_name = os.path.join(FLAGS.raw_folder, readid + '.signal')
+            file_stats[full_file_n] = file_stat(full_file_n)
+        except OSError as e:
+            logger.error("Cannot open file %s. %s"%(full_file_n,e))
+            continue
+        done_reads = done.get((full_file_n,) + file_stats[full_file_n],set())
+        if FILE_DONE not in done_reads:
+            yield full_file_n,done_reads
+
+class TaskScheduler(object):
+    """
+    Schedule the extraction chunks. A fast5 file is first handed to a worker
+    as a whole in a listing chunk, the worker lists the reads of the file,
+    extracts at most limit of them and returns the rest, which are split into
+    chunks of at most read_chunk reads and scheduled before the next files.
+    So the reads of a large multi-read fast5 file are extracted in parallel
+    while the main process never opens a fast5 file.
+    Args:
+        files: An iterable of (fast5 file, done read ids) given by iter_files.
+        read_chunk: The maximum number of reads in one chunk.
+        test_number: Stop after test_number reads, None to extract all reads.
+    """
+    def __init__(self,files,read_chunk = 200,test_number = None):
+        self.files = iter(files)
+        self.read_chunk = read_chunk
+        self.test_number = test_number
+        self.pending = collections.deque()
+        # Number of the reads processed or scheduled, a listing chunk
+        # reserves its limit until it's finished.
+        self.reserved = 0
+        self.chunks_n = {}
+        self.chunks_done = Counter()
+
+    def _limit(self):
+        if self.test_number is None:
+            return self.read_chunk
+        return min(self.read_chunk,self.test_number - self.reserved)
+
+    def next_task(self):
+        """
+        The next task, a list of chunks (fast5 file, read ids, done read ids,
+        limit), the read ids is None for a listing chunk. Return None if no
+        task can be scheduled until a running chunk is finished.
+        """
+        if self.pending:
+            return [self.pending.popleft()]
+        task = []
+        while len(task) < FILES_PER_TASK:
+            limit = self._limit()
+            if limit <= 0:
+                break
+            item = next(self.files,None)
+            if item is None:
+                break
+            full_file_n,done_reads = item
+            task.append((full_file_n,None,done_reads,limit))
+            self.reserved += limit
+        return task if len(task) else None
+
+    def finish(self,chunk,processed_n,rest):
+        """
+        Record a finished chunk.
+        Args:
+            chunk: The (fast5 file, read ids, limit) returned by extract_chunk.
+            processed_n: Number of the reads extracted or failed in the chunk.
+            rest: The read ids left by a listing chunk, None if the file
+                can't be opened.
+        Return:
+            True if all the reads of the fast5 file have been processed.
+        """
+        full_file_n,read_ids,limit = chunk
+        self.reserved += processed_n - limit
+        if read_ids is None:
+            complete = rest is not None
+            rest = rest or []
+            if self.test_number is not None and len(rest) > self.test_number - self.reserved:
+                rest = rest[:max(0,self.test_number - self.reserved)]
+                complete = False
+            self.reserved += len(rest)
+            for i in range(0,len(rest),self.read_chunk):
+                read_ids = rest[i:i+self.read_chunk]
+                self.pending.append((full_file_n,read_ids,None,len(read_ids)))
+            if complete:
+                self.chunks_n[full_file_n] = 1 + (len(rest) + self.read_chunk - 1)//self.read_chunk
             else:
-                sig_file_name = os.path.join(FLAGS.raw_folder, os.path.splitext(file_n)[0] + '.signal')
-            with open(sig_file_name, 'w+') as signal_file:
-                signal_file.write(FLAGS.delimiter.join([str(val) for val in raw_signal]))
-            if len(reference) > 0:
-                with open(os.path.join(FLAGS.ref_folder, os.path.splitext(file_n)[0] + '_ref.fastq'), 'w+') as ref_file:
-                    ref_file.write(reference)
-        else:
-         for read_id in tqdm(input_data):
+                self.chunks_n[full_file_n] = None
+        self.chunks_done[full_file_n] += 1
+        return self.chunks_n[full_file_n] == self.chunks_done[full_file_n]
+
+def init_worker(flags):
+    global FLAGS
+    FLAGS = flags
+
+def extract_task(task):
+    """Extract a task given by TaskScheduler.next_task, return the results of
+    extract_chunk of all the chunks in the task."""
+    return [extract_chunk(chunk) for chunk in task]
+
+def extract_chunk(chunk):
+    """
+    Extract a chunk in a worker, the fast5 file is opened once, and listed if
+    it's a listing chunk.
+    Return:
+        chunk: The (fast5 file, read ids, limit) of the chunk.
+        succeed: The read ids extracted, SINGLE_READ for a single-read fast5.
+        failed: A Counter of the failed reads by the error type.
+        records: The extracted (read name, signal, reference) if FLAGS.archive
+            is set, the records are written into the archive by the main
+            process, otherwise the signal and reference files are written
+            directly and records is empty.
+        rest: The read ids left by a listing chunk, None if the file can't
+            be opened.
+    """
+    full_file_n,read_ids,done_reads,limit = chunk
+    chunk = (full_file_n,read_ids,limit)
+    try:
+        input_data = h5py.File(full_file_n, 'r')
+    except Exception as e:
+        logger.error("Cannot open file %s. %s"%(full_file_n,e))
+        failed = Counter()
+        failed[type(e).__name__] += 1 if read_ids is None else len(read_ids)
+        return chunk,[],failed,[],None if read_ids is None else []
+    rest = []
+    with input_data:
+        if read_ids is None:
+            entries = list(input_data)
+            if 'Raw' in entries:
+                if SINGLE_READ in done_reads:
+                    return chunk,[],Counter(),[],rest
+                succeed,failed,records = extract_single(input_data,full_file_n)
+                return chunk,succeed,failed,records,rest
+            entries = [x for x in entries if x not in done_reads]
+            read_ids,rest = entries[:limit],entries[limit:]
+        succeed,failed,records = extract_reads(input_data,full_file_n,read_ids)
+    return chunk,succeed,failed,records,rest
+
+def extract_single(input_data,full_file_n):
+    """Extract a single-read fast5 file, return (succeed, failed, records)
+    as extract_chunk."""
+    file_n = os.path.basename(full_file_n)
+    failed = Counter()
+    records = []
+    try:
+        raw_signal, reference,readid = extract_file(input_data,full_file_n,FLAGS.mode,FLAGS.unit,FLAGS.polya_pair)
+        if raw_signal is None:
+            raise ValueError("Fail in extracting raw signal.")
+        if len(raw_signal) == 0:
+            raise ValueError("Got empty raw signal")
+    except Exception as e:
+        logger.error("Cannot extract file %s. %s"%(full_file_n,e))
+        failed[type(e).__name__] += 1
+        return [],failed,records
+    if FLAGS.idname:
+        read_name = readid
+    else:
+        read_name = os.path.splitext(file_n)[0]
+    if FLAGS.archive:
+        records.append((read_name,raw_signal,reference))
+        return [SINGLE_READ],failed,records
+    sig_file_name = os.path.join(FLAGS.raw_folder, read_name + '.signal')
+    with open(sig_file_name, 'w+') as signal_file:
+        signal_file.write(FLAGS.delimiter.join([str(val) for val in raw_signal]))
+    if len(reference) > 0:
+        with open(os.path.join(FLAGS.ref_folder, os.path.splitext(file_n)[0] + '_ref.fastq'), 'w+') as ref_file:
+            ref_file.write(reference)
+    return [SINGLE_READ],failed,records
+
+def extract_reads(input_data,full_file_n,read_ids):
+    """Extract the reads of a multi-read fast5 file, return (succeed, failed,
+    records) as extract_chunk."""
+    file_n = os.path.basename(full_file_n)
+    failed = Counter()
+    records = []
+    succeed = []
+    for read_id in read_ids:
+        try:
             read_h = input_data[read_id]
-            try:
-                raw_signal, reference,readid = extract_file_v2(read_h,FLAGS.mode)
-                if raw_signal is None:
-                    raise ValueError("Fail in extracting raw signal.")
-                if len(raw_signal) == 0:
-                    raise ValueError("Got empty raw signal")
-                    #FLAGS.count += 1
-            except Exception as e:
-                logger.error("Cannot extract file %s. %s"%(full_file_n,e))
-                return
-            with open(os.path.join(FLAGS.raw_folder, os.path.splitext(file_n)[0] + read_id + '.signal'), 'w+') as signal_file:
-                signal_file.write(" ".join([str(val) for val in raw_signal]))
-            if len(reference) > 0:
-                with open(os.path.join(FLAGS.ref_folder, os.path.splitext(file_n)[0] + '_ref.fastq'), 'w+') as ref_file:
-                    ref_file.write(reference)
-        input_data.close()
-                
-    return
+            raw_signal, reference,readid = extract_file_v2(read_h,FLAGS.mode)
+            if raw_signal is None:
+                raise ValueError("Fail in extracting raw signal.")
+            if len(raw_signal) == 0:
+                raise ValueError("Got empty raw signal")
+        except Exception as e:
+            logger.error("Cannot extract read %s in file %s. %s"%(read_id,full_file_n,e))
+            failed[type(e).__name__] += 1
+            continue
+        succeed.append(read_id)
+        if FLAGS.archive:
+            records.append((os.path.splitext(file_n)[0] + read_id,raw_signal,reference))
+            continue
+        with open(os.path.join(FLAGS.raw_folder, os.path.splitext(file_n)[0] + read_id + '.signal'), 'w+') as signal_file:
+            signal_file.write(" ".join([str(val) for val in raw_signal]))
+        if len(reference) > 0:
+            with open(os.path.join(FLAGS.ref_folder, os.path.splitext(file_n)[0] + read_id + '_ref.fastq'), 'w+') as ref_file:
+                ref_file.write(reference)
+    return succeed,failed,records
 
 def extract_file(input_data,input_file,mode = 'dna',unit=False,polya = None):
     read_h = list(input_data['/Raw/Reads'].values())[0]
@@ -222,6 +491,17 @@ if __name__ == '__main__':
     parser.add_argument('--polya',
                         default = None,
                         help="Polya cliping file generated by Nanopre.")
+    parser.add_argument('--read_chunk',
+                        default = 200,
+                        type = int,
+                        help = "Number of reads of a multi-read fast5 file extracted in one task.")
+    parser.add_argument('--archive',
+                        action="store_true",
+                        help = "Write the signal and reference of all the reads into a single read archive raw.h5 in the output directory.")
+    parser.add_argument('--archive_compressor',
+                        default = 'zlib',
+                        choices = ['zlib','lzma'],
+                        help = "Compressor of the signal codec used by the archive.")
     parser.add_argument('--threads',
                         default = 1,
                         type = int,
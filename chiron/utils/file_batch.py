@@ -9,19 +9,120 @@
 #Need Python>3
 import argparse
 import os
-import struct
 import sys
+from multiprocessing import Pool
+from multiprocessing import cpu_count
 
 import numpy as np
-from statsmodels import robust
 
 import labelop
+from chiron.utils.norm import median_mad
 
 DNA_BASE = {'A': 0, 'C': 1, 'G': 2, 'T': 3, }
 DNA_IDX = ['A', 'C', 'G', 'T']
 MINIMUM_LABEL_LEN_PER_100 = 1
 
+def record_dtype(length):
+    """
+    The NumPy dtype of a record, matches the layout read by
+    chiron_queue_input.read_data: uint16 signal length, float32[length] signal,
+    uint16 label length, int8[length] label padded with -1.
+    """
+    return np.dtype([('signal_len', '<u2'),
+                     ('signal', '<f4', (length,)),
+                     ('label_len', '<u2'),
+                     ('label', 'i1', (length,))])
+
+
+def extract_fast5(input_file_path, mode='dna'):
+    """
+    Extract the signal and label segments from a single fast5 file
+    Args:
+        input_file_path: path of a fast5 file.
+        mode: The signal type dealed with. Default to 'dna'.
+    Return:
+        A record_dtype array of the segments, None if the extraction failed.
+    """
+    try:
+        (raw_data, raw_label, raw_start, raw_length),_ = labelop.get_label_raw(input_file_path, FLAGS.basecall_group,
+                                                                             FLAGS.basecall_subgroup)
+    except:
+        return None
+    if mode=='rna':
+        raw_data = raw_data[::-1]
+    if FLAGS.normalization == 'mean':
+        raw_data = (raw_data - np.median(raw_data)) / float(np.std(raw_data))
+    elif FLAGS.normalization == 'median':
+        median, mad = median_mad(raw_data)
+        raw_data = (raw_data - median) / float(mad)
+    bases = np.asarray([DNA_BASE[x.decode('UTF-8')] for x in raw_label['base']], dtype=np.int8)
+    segments = list()
+    pre_start = raw_start[0]
+    pre_index = 0
+    for index, start in enumerate(raw_start):
+        while (start - pre_start > FLAGS.length):
+            current_len = int(raw_start[index - 1] - pre_start)
+            if (index - 1 - MINIMUM_LABEL_LEN <= pre_index) or (current_len < MINIMUM_SIGNAL_LEN):
+                # If a single segment is longer than the maximum singal length, skip it.
+                pre_index +=1
+                pre_start = raw_start[pre_index]
+                continue
+            segments.append((pre_start, raw_start[index - 1], pre_index, index - 1))
+            pre_index = index - 1
+            pre_start = raw_start[index - 1]
+        if raw_start[index] - pre_start > FLAGS.length:
+            # Skip a single event segment longer than the required signal length
+            pre_index = index
+            pre_start = raw_start[index]
+    records = np.zeros(len(segments), dtype=record_dtype(FLAGS.length))
+    records['label'] = -1
+    for i, (signal_start, signal_end, label_start, label_end) in enumerate(segments):
+        records['signal_len'][i] = signal_end - signal_start
+        records['signal'][i, :signal_end - signal_start] = raw_data[signal_start:signal_end]
+        records['label_len'][i] = label_end - label_start
+        records['label'][i, :label_end - label_start] = bases[label_start:label_end]
+    return records
+
+
+def extract_shard(args):
+    """
+    Extract a shard of the fast5 files into its own batch files, named
+    data_batch_<shard>_<batch>.bin, every batch file hold FLAGS.batch records
+    and is written by a single tofile call, the incomplete last batch is
+    dropped.
+    Args:
+        args: A tuple (shard index, list of fast5 files, maximum batch files).
+    Return:
+        Number of batch files written, succeed files and failed files.
+    """
+    shard_idx, file_list, max_batch = args
+    batch_n = 0
+    success_n = 0
+    fail_n = 0
+    records = list()
+    records_n = 0
+    for file_path in file_list:
+        if max_batch is not None and batch_n >= max_batch:
+            break
+        file_records = extract_fast5(file_path, mode=FLAGS.mode)
+        if file_records is None:
+            fail_n += 1
+            continue
+        success_n += 1
+        records.append(file_records)
+        records_n += len(file_records)
+        if records_n > FLAGS.batch:
+            records = np.concatenate(records)
+            batch_n += 1
+            with open(os.path.join(FLAGS.output, "data_batch_%d_%d.bin" % (shard_idx, batch_n)), 'wb+') as bin_h:
+                records[:FLAGS.batch].tofile(bin_h)
+            records = [records[FLAGS.batch:]]
+            records_n = len(records[0])
+    return batch_n, success_n, fail_n
+
+
 def extract():
+    global MINIMUM_LABEL_LEN, MINIMUM_SIGNAL_LEN
     if FLAGS.mode == 'rna':
         MINIMUM_LABEL_LEN = int(MINIMUM_LABEL_LEN_PER_100 * FLAGS.length /100 * 2)
         MINIMUM_SIGNAL_LEN = int(MINIMUM_LABEL_LEN*3)
@@ -34,99 +135,38 @@ def extract():
     output_folder = FLAGS.output + os.path.sep
     if not os.path.isdir(root_folder):
         raise IOError('Input directory does not found.')
-    if output_folder is None:
-        output_folder = os.path.abspath(os.path.join(root_folder, os.pardir)) + '/batch_/' + str(FLAGS.length)
     if not os.path.isdir(output_folder):
         os.mkdir(output_folder)
-    batch_idx = 1
-    output_file = None
-    event = list()
-    event_length = list()
-    label = list()
-    label_length = list()
-    success_list = list()
-    fail_list = list()
-    format_string = '<1H' + str(FLAGS.length) + 'f1H' + str(FLAGS.length) + 'b'
-
-    def extract_fast5(input_file_path, bin_h, mode='DNA'):
-        """
-        Extract the signal and label from a single fast5 file
-        Args:
-            input_file_path: path of a fast5 file.
-            bin_h: handle of the binary file.
-            mode: The signal type dealed with. Default to 'DNA'.
-        """
-        try:
-            (raw_data, raw_label, raw_start, raw_length) = labelop.get_label_raw(input_file_path, FLAGS.basecall_group,
-                                                                                 FLAGS.basecall_subgroup)
-        except IOError:
-            fail_list.append(input_file_path)
-            return False
-        except:
-            fail_list.append(input_file_path)
-            return False
-        if mode=='rna':
-            raw_data = raw_data[::-1]
-        if FLAGS.normalization == 'mean':
-            raw_data = (raw_data - np.median(raw_data)) / np.float(np.std(raw_data))
-        elif FLAGS.normalization == 'median':
-            raw_data = (raw_data - np.median(raw_data)) / np.float(robust.mad(raw_data))
-        pre_start = raw_start[0]
-        pre_index = 0
-        for index, start in enumerate(raw_start):
-            while (start - pre_start > FLAGS.length):
-                current_len = int(raw_start[index - 1] - pre_start)
-                if (index - 1 - MINIMUM_LABEL_LEN <= pre_index) or (current_len < MINIMUM_SIGNAL_LEN):
-                    # If a single segment is longer than the maximum singal length, skip it.
-                    pre_index +=1
-                    pre_start = raw_start[pre_index]
-                    continue
-                event.append(np.pad(raw_data[pre_start:raw_start[index - 1]],
-                                    (0, FLAGS.length + pre_start - raw_start[index - 1]), mode='constant'))
-                event_length.append(current_len)
-                label_ind = raw_label['base'][pre_index:(index - 1)]
-                temp_label = [DNA_BASE[x.decode('UTF-8')] for x in label_ind]
-                label.append(
-                    np.pad(temp_label, (0, FLAGS.length - index + 1 + pre_index), mode='constant', constant_values=-1))
-                label_length.append(index - 1 - pre_index)
-                pre_index = index - 1
-                pre_start = raw_start[index - 1]
-            if raw_start[index] - pre_start > FLAGS.length:
-                # Skip a single event segment longer than the required signal length
-                pre_index = index
-                pre_start = raw_start[index]
-        success_list.append(input_file_path)
-        while len(event) > FLAGS.batch:
-            for index in range(0, FLAGS.batch):
-                bin_h.write(struct.pack(format_string,
-                                        *[event_length[index]] + event[index].tolist() + [label_length[index]] + label[
-                                            index].tolist()))
-            del event[:FLAGS.batch]
-            del event_length[:FLAGS.batch]
-            del label[:FLAGS.batch]
-            del label_length[:FLAGS.batch]
-            return True
-        return False
-
-    for base_dir, _ ,file_list in os.walk(root_folder):
-     for file_n in file_list:
-        if file_n.endswith('fast5'):
-            if output_file is None:
-                output_file = open(os.path.join(output_folder,"data_batch_" + str(batch_idx) + '.bin'), 'wb+')
-            output_state = extract_fast5(os.path.join(base_dir,file_n), output_file)
-            if output_state:
-                batch_idx += 1
-                output_file.close()
-                if (FLAGS.max is not None) and (batch_idx > FLAGS.max):
-                    sys.stdout.write("Reach the maximum %d batch number, finish read." % (FLAGS.max))
-                    break
-                output_file = open(output_folder + os.path.sep + "data_batch_" + str(batch_idx) + '.bin', 'wb+')
-                sys.stdout.write("%d batch transferred completed.\n" % (batch_idx - 1))
-    sys.stdout.write("File batch transfer completed, %d batches have been processed\n" % (batch_idx - 1))
-    sys.stdout.write("%d files scussesfully read, %d files failed.\n" % (len(success_list), len(fail_list)))
-    if not output_state:
-        output_file.close()
-        os.remove(output_folder + os.path.sep + "data_batch_" + str(batch_idx) + '.bin')
+    file_list = list()
+    for base_dir, _ ,files in os.walk(root_folder):
+        for file_n in files:
+            if file_n.endswith('fast5'):
+                file_list.append(os.path.join(base_dir,file_n))
+    file_list.sort()
+    threads = FLAGS.threads if FLAGS.threads > 0 else cpu_count()
+    threads = max(1, min(threads, len(file_list)))
+    shards = list()
+    for shard_idx in range(threads):
+        if FLAGS.max is None:
+            max_batch = None
+        else:
+            max_batch = FLAGS.max // threads + (1 if shard_idx < FLAGS.max % threads else 0)
+        shards.append((shard_idx + 1, file_list[shard_idx::threads], max_batch))
+    pool = Pool(threads, initializer=init_worker, initargs=(FLAGS, MINIMUM_LABEL_LEN, MINIMUM_SIGNAL_LEN))
+    batch_n = 0
+    success_n = 0
+    fail_n = 0
+    for shard_batch, shard_success, shard_fail in pool.imap_unordered(extract_shard, shards):
+        batch_n += shard_batch
+        success_n += shard_success
+        fail_n += shard_fail
+        sys.stdout.write("%d batch transferred completed.\n" % (batch_n))
+    pool.close()
+    pool.join()
+    if (FLAGS.max is not None) and (batch_n >= FLAGS.max):
+        sys.stdout.write("Reach the maximum %d batch number, finish read.\n" % (FLAGS.max))
+    sys.stdout.write("File batch transfer completed, %d batches have been processed\n" % (batch_n))
+    sys.stdout.write("%d files scussesfully read, %d files failed.\n" % (success_n, fail_n))
     with open(output_folder + os.path.sep + "data.meta", 'w+') as meta_file:
         meta_file.write("signal_length " + str(FLAGS.length) + "\n")
         meta_file.write("file_batch_size " + str(FLAGS.batch) + "\n")
@@ -135,10 +175,17 @@ def extract():
         meta_file.write("basecall_subgroup" + FLAGS.basecall_subgroup + "\n")
         meta_file.write("DNA_base A-0 C-1 G-2 T-3" + "\n")
         meta_file.write("data_type " + FLAGS.mode + "\n")
-        meta_file.write("format " + format_string + "\n")
+        meta_file.write("format " + '<1H' + str(FLAGS.length) + 'f1H' + str(FLAGS.length) + 'b' + "\n")
     return
 
 
+def init_worker(flags, minimum_label_len, minimum_signal_len):
+    global FLAGS, MINIMUM_LABEL_LEN, MINIMUM_SIGNAL_LEN
+    FLAGS = flags
+    MINIMUM_LABEL_LEN = minimum_label_len
+    MINIMUM_SIGNAL_LEN = minimum_signal_len
+
+
 def run(args):
     global FLAGS
     FLAGS = args
@@ -161,5 +208,6 @@ if __name__ == "__main__":
                         help="The method of normalization applied to signal, Median(default):robust median normalization, 'mean': mean normalization, 'None': no normalizaion")
     parser.add_argument('-m', '--max',type=int, default=10, help="Maximum number of batch files generated.")
     parser.add_argument('--mode', default='dna', help="Sequecing data type. Default is DNA.Can be rna or dna")
+    parser.add_argument('-t', '--threads',type=int, default=0, help="Number of worker processes, each write its own shard of batch files, default 0 use all the cpus.")
     args = parser.parse_args(sys.argv[1:])
     run(args)
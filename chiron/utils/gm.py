@@ -1,15 +1,24 @@
 import numpy as np
 import json
+import collections
 import os
 import sys
 import argparse
 from tqdm import tqdm
+from multiprocessing import Pool
+from chiron.utils.seqio import read_fasta, read_fastq
+# Length of the sequence chunk counted by a worker.
+CHUNK_SIZE = 2**22
+META_SUFFIX = '.meta'
 class gm:
     """
     Genome Model Class:
         k: the length of the longest kmer counted in the model, The genome model
         P(x|K) give the probability of observe Nucleotide x given a kmer K that has
         a length <= k.
+    The model can be saved in json or in a binary format: the kmer_count as a
+    .npy array, which is memory-mapped on loading, and a .meta json sidecar
+    holding k and the bases.
     """
     def __init__(self,k = 5,mode = 0):
         self.k = k
@@ -18,15 +27,18 @@ class gm:
             self.base = ['A','C','G','T']
         elif mode == 1:
             self.base = ['A','C','G','U']
-        self.kmer_dict = {}
+        self._kmer_dict = None
         self.kmer_count = np.zeros([self.n,4],dtype = int)
-        for i in range(self.n):
-            kmer = self._idx2kmer(i)
-            self.kmer_dict[kmer] = i
+    @property
+    def kmer_dict(self):
+        """A dict map the kmer to its index, built on the first access."""
+        if self._kmer_dict is None:
+            self._kmer_dict = dict((self._idx2kmer(i),i) for i in range(self.n))
+        return self._kmer_dict
     def _kmer2idx(self,kmer):
         idx = 0
-        for b_idx,b in enumerate(kmer):
-            idx += (self.base.index(b)+1)*len(self.base)**b_idx
+        for b in kmer:
+            idx = idx*len(self.base) + self.base.index(b) + 1
         idx = idx - 1
         return idx
     def _idx2kmer(self,idx):
@@ -37,34 +49,60 @@ class gm:
             idx = int((idx-1) / len(self.base))
         return kmer
     def count_kmer(self,seq):
-        for i in tqdm(range(len(seq)),desc = 'Counting kmer',position = 1):
-            if i==0:
-                pass
-            for k in range(min(self.k,i)):
-                kmer = seq[i-k-1:i]
-                if self._base_check(kmer):
-                    self.kmer_count[self.kmer_dict[kmer]][self.base.index(seq[i])] +=1
+        """Count the next base of every kmer (length <= k) in the sequence."""
+        self.kmer_count += count_kmer_codes(encode_seq(seq,self.base),self.k)
     def save(self,sav_path):
-        gm_dict = self.__dict__
-        gm_dict['kmer_count'] = gm_dict['kmer_count'].tolist()
-        with open(sav_path, 'w+') as f:
-            json.dump(gm_dict,f)
-    def load(self,model_path):
-        with open(model_path,'r') as f:
-            gm_dict = json.load(f)
-        self.k = gm_dict['k']
-        self.n = gm_dict['n']
-        assert self.n == int(4*(4**self.k-1)/3)
-        self.base = gm_dict['base']
-        self.kmer_dict = gm_dict['kmer_dict']
-        self.kmer_count = np.asarray(gm_dict['kmer_count'])
+        """
+        Save the model, in json if sav_path ends with .json, otherwise the
+        kmer_count is saved as a .npy array into sav_path and k and the bases
+        are saved into sav_path.meta.
+        """
+        if sav_path.endswith('.json'):
+            gm_dict = {'k':self.k,
+                       'n':self.n,
+                       'base':self.base,
+                       'kmer_dict':self.kmer_dict,
+                       'kmer_count':np.asarray(self.kmer_count).tolist()}
+            with open(sav_path, 'w+') as f:
+                json.dump(gm_dict,f)
+            return
+        with open(sav_path,'wb') as f:
+            np.save(f,np.asarray(self.kmer_count))
+        with open(sav_path + META_SUFFIX,'w+') as f:
+            json.dump({'k':self.k,'n':self.n,'base':self.base},f)
+    def load(self,model_path,mmap = True):
+        """
+        Load a model saved by save.
+        Args:
+            model_path: The json model or the .npy kmer_count of a binary model.
+            mmap: Memory-map the kmer_count of a binary model read-only, so
+                the model is loaded instantly and shared by the processes.
+        """
+        if model_path.endswith('.json'):
+            with open(model_path,'r') as f:
+                gm_dict = json.load(f)
+            self.k = gm_dict['k']
+            self.n = gm_dict['n']
+            assert self.n == int(4*(4**self.k-1)/3)
+            self.base = gm_dict['base']
+            self._kmer_dict = gm_dict['kmer_dict']
+            self.kmer_count = np.asarray(gm_dict['kmer_count'])
+            return
+        with open(model_path + META_SUFFIX,'r') as f:
+            meta = json.load(f)
+        self.k = meta['k']
+        self.n = meta['n']
+        self.base = meta['base']
+        self._kmer_dict = None
+        self.kmer_count = np.load(model_path,mmap_mode = 'r' if mmap else None)
+        assert self.kmer_count.shape == (int(4*(4**self.k-1)/3),4)
     def _base_check(self,kmer):
         for base in kmer:
             if base not in self.base:
                 return False
         return True
     def get_count(self,kmer):
-        return self.kmer_count[self.kmer_dict[kmer]]
+        return self.kmer_count[self._kmer2idx(kmer)]
     def __getitem__(self, key):
         if type(key) is str:
             return self.get_count(key)
@@ -79,35 +117,105 @@ class gm:
         min_index = self._kmer2idx(self.base[0]*min_k)
         max_index = self._kmer2idx(self.base[-1]*max_k)
         return(min_index,max_index,self.kmer_count[min_index:max_index+1])
+def encode_seq(seq,base):
+    """
+    Encode the sequence into the index of each nucleotide in base, -1 for the
+    nucleotides not in base.
+    """
+    lookup = -np.ones(256,dtype = np.int64)
+    for idx,b in enumerate(base):
+        lookup[ord(b)] = idx
+    if not isinstance(seq,bytes):
+        seq = seq.encode('ascii')
+    return lookup[np.frombuffer(seq,dtype = np.uint8)]
+
+def count_kmer_codes(codes,k,skip = 0):
+    """
+    Count the next nucleotide of every kmer with length <= k.
+    Args:
+        codes: Encoded sequence given by encode_seq.
+        k: Length of the longest kmer.
+        skip: Only count the next nucleotides at position >= skip, used to
+            count an overlapped chunk of a longer sequence.
+    Return:
+        A kmer_count array with shape [4*(4**k-1)/3,4], indexed as gm.kmer_dict.
+    """
+    n = int(4*(4**k-1)/3)
+    counts = np.zeros(n*4,dtype = np.int64)
+    seq_len = len(codes)
+    valid = codes >= 0
+    # kmer_idx[j] is gm.kmer_dict[seq[j:j+l]] + 1 of the current length l.
+    kmer_idx = np.zeros(seq_len,dtype = np.int64)
+    kmer_valid = np.ones(seq_len,dtype = bool)
+    for l in range(1,k+1):
+        if l >= seq_len:
+            break
+        kmer_idx[:seq_len-l+1] = kmer_idx[:seq_len-l+1]*4 + codes[l-1:] + 1
+        kmer_valid[:seq_len-l+1] &= valid[l-1:]
+        start = max(skip - l,0)
+        end = seq_len - l
+        next_base = codes[start+l:]
+        mask = kmer_valid[start:end] & (next_base >= 0)
+        counts += np.bincount(((kmer_idx[start:end] - 1)*4 + next_base)[mask],
+                              minlength = n*4)
+    return counts.reshape(n,4)
+
+def _count_chunk(args):
+    seq,base,k,skip = args
+    return count_kmer_codes(encode_seq(seq,base),k,skip)
+
+def seq_chunks(seq,k,chunk_size = CHUNK_SIZE):
+    """
+    Split a sequence into chunks overlapped by k nucleotides, so every kmer
+    is counted in exactly one chunk.
+    Yield:
+        (chunk, skip), where skip is the argument of count_kmer_codes.
+    """
+    for start in range(0,max(len(seq),1),chunk_size):
+        overlap = min(start,k)
+        yield seq[start-overlap:start+chunk_size],overlap
+
+def count_parallel(gm1,seqs,threads = 1):
+    """
+    Count the kmers of the sequences into the genome model gm1, the
+    sequences are split into chunks counted by a pool of workers, at most
+    2*threads chunks are in flight so the sequences are streamed.
+    Args:
+        gm1: The genome model.
+        seqs: An iterable of sequences.
+        threads: Number of worker processes.
+    """
+    tasks = ((chunk,gm1.base,gm1.k,skip) for seq in seqs for chunk,skip in seq_chunks(seq,gm1.k))
+    if threads <= 1:
+        for task in tasks:
+            gm1.kmer_count += _count_chunk(task)
+        return
+    pool = Pool(threads)
+    pending = collections.deque()
+    for task in tasks:
+        if len(pending) >= 2*threads:
+            gm1.kmer_count += pending.popleft().get()
+        pending.append(pool.apply_async(_count_chunk,(task,)))
+    while pending:
+        gm1.kmer_count += pending.popleft().get()
+    pool.close()
+    pool.join()
+
 def fasta_reader(file_list,root_folder = None):
+    """Yield (file name, iterator of sequences) of the fasta files, the
+    sequences are streamed by seqio.read_fasta."""
     for name in file_list:
         if root_folder is not None:
             name = os.path.join(root_folder,name)
-        seqs = {}
-        with open(name,'r') as f:
-            for line in f:
-                if line.startswith('>'):    
-                    last_seq =line[1:].strip()
-                    seqs[last_seq] = ''
-                else:
-                    seqs[last_seq]  = seqs[last_seq]+line.strip()
-        yield name,seqs
+        yield name,(seq for _,seq in read_fasta(name))
 
 def fastq_reader(file_list,root_folder = None):
+    """Yield (file name, iterator of sequences) of the fastq files, the
+    sequences are streamed by seqio.read_fastq."""
     for name in file_list:
         if root_folder is not None:
             name = os.path.join(root_folder,name)
-        seqs = {}
-        with open(name,'r') as f:
-            for line in f:
-                if line.startswith('@'):    
-                    last_seq =line[1:].strip()
-                    seqs[last_seq] = ''
-                    seq_line = next(f)
-                    while not seq_line.startswith('+'):
-                        seqs[last_seq]  = seqs[last_seq]+seq_line.strip()
-                        seq_line = next(f)
-        yield name,seqs
+        yield name,(seq for _,seq,_ in read_fastq(name))
 def run(args):
     root_folder = args.input
     f_L = os.listdir(root_folder)
@@ -121,12 +229,10 @@ def run(args):
     gm1 = gm(k=args.k,mode = args.mode)
     if 'a' in args.suffixs:
         for genome,seqs in fasta_reader(fasta_list,root_folder):
-            for name in tqdm(seqs.keys(),desc = "Reading genome "+genome,position = 0):
-                gm1.count_kmer(seqs[name])
+            count_parallel(gm1,tqdm(seqs,desc = "Reading genome "+genome,position = 0),args.threads)
     if 'q' in args.suffixs:
         for genome,seqs in fastq_reader(fastq_list,root_folder):
-            for name in tqdm(seqs.keys(),desc = "Reading genome "+genome,position = 0):
-                gm1.count_kmer(seqs[name])        
+            count_parallel(gm1,tqdm(seqs,desc = "Reading genome "+genome,position = 0),args.threads)
     out_path = os.path.join(args.output,args.name)
     gm1.save(out_path)
     print("Genome model saved to %s"%(out_path))
@@ -147,8 +253,8 @@ if __name__ == "__main__":
                         help="The suffix of the genome file, default is qa, a for only fasta, q for only fastq.")
     parser.add_argument('-n',
                         '--name',
-                        default = "gm.json",
-                        help="Output file name.")
+                        default = "gm.npy",
+                        help="Output file name, the model is saved in json if the name ends with .json, otherwise in the binary format.")
     parser.add_argument('-k',
                         default = 6, 
                         type = int, 
@@ -157,6 +263,11 @@ if __name__ == "__main__":
                         type = int,
                         default = 0,
                         help = "Mode, if input is 0 (dna) or 1 (rna).")
+    parser.add_argument('-t',
+                        '--threads',
+                        type = int,
+                        default = 1,
+                        help = "Number of processes used to count the kmers.")
     args = parser.parse_args(sys.argv[1:])
     run(args)
     
@@ -0,0 +1,35 @@
+# Copyright 2017 The Chiron Authors. All Rights Reserved.
+#
+#This Source Code Form is subject to the terms of the Mozilla Public
+#License, v. 2.0. If a copy of the MPL was not distributed with this
+#file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#Genome model kmer counting test
+from __future__ import absolute_import
+import numpy as np
+
+from chiron.utils.gm import gm, encode_seq, count_kmer_codes, seq_chunks
+
+
+def _brute_force(gm1, seq):
+    counts = np.zeros([gm1.n, 4], dtype=np.int64)
+    for l in range(1, gm1.k + 1):
+        for i in range(len(seq) - l):
+            kmer, next_base = seq[i:i + l], seq[i + l]
+            if next_base not in gm1.base or any(b not in gm1.base for b in kmer):
+                continue
+            counts[gm1.kmer_dict[kmer], gm1.base.index(next_base)] += 1
+    return counts
+
+
+def test_count_kmer_codes():
+    rng = np.random.RandomState(0)
+    gm1 = gm(k=3)
+    seq = ''.join(rng.choice(list('ACGTN'), 500, p=[0.24, 0.24, 0.24, 0.24, 0.04]))
+    expect = _brute_force(gm1, seq)
+    assert np.array_equal(count_kmer_codes(encode_seq(seq, gm1.base), gm1.k), expect)
+    for chunk_size in [1, 7, 64]:
+        counts = np.zeros_like(expect)
+        for chunk, skip in seq_chunks(seq, gm1.k, chunk_size):
+            counts += count_kmer_codes(encode_seq(chunk, gm1.base), gm1.k, skip)
+        assert np.array_equal(counts, expect)
@@ -130,24 +130,42 @@ def get_label_segment(fast5_fn, basecall_group, basecall_subgroup):
     return (segment_data, first_segment_index, segment_index, total)
 
 
-def get_label_raw(fast5_fn, basecall_group, basecall_subgroup,reverse = False):
+def get_label_raw(fast5_fn, basecall_group, basecall_subgroup,reverse = False,read_group = None):
+    """
+    Read the raw signal and the resquiggled label of a read.
+    Args:
+        fast5_fn: The fast5 file.
+        read_group: The group of the read in a multi-read fast5 file, e.g.
+            read_<read_id>, None for a single-read fast5 file.
+    """
     ##Open file
     try:
         fast5_data = h5py.File(fast5_fn, 'r')
     except IOError:
         raise IOError('Error opening file. Likely a corrupted file.')
+    if read_group is None:
+        read_root = fast5_data
+        raw_entry = '/Raw/Reads/'
+        channel_entry = '/UniqueGlobalKey/channel_id/'
+    else:
+        read_root = fast5_data[read_group]
+        raw_entry = 'Raw'
+        channel_entry = 'channel_id'
 
     # Get raw data
     try:
-        raw_dat = list(fast5_data['/Raw/Reads/'].values())[0]
+        if read_group is None:
+            raw_dat = list(read_root[raw_entry].values())[0]
+        else:
+            raw_dat = read_root[raw_entry]
         # raw_attrs = raw_dat.attrs
-        raw_dat = raw_dat['Signal'].value
+        raw_dat = raw_dat['Signal'][()]
     except:
         raise RuntimeError(
             'Raw data is not stored in Raw/Reads/Read_[read#] so ' +
             'new segments cannot be identified.')
     try:
-        global_attrs = fast5_data['/UniqueGlobalKey/channel_id/'].attrs
+        global_attrs = read_root[channel_entry].attrs
         offset = float(global_attrs['offset'])
         digitisation=float(global_attrs['digitisation'])
         range=float(global_attrs['range'])
@@ -157,10 +175,10 @@ def get_label_raw(fast5_fn, basecall_group, basecall_subgroup,reverse = False):
         )
     # Read corrected data
     try:
-        corr_data = fast5_data[
-            '/Analyses/'+basecall_group +'/' + basecall_subgroup + '/Events']
+        corr_data = read_root[
+            'Analyses/'+basecall_group +'/' + basecall_subgroup + '/Events']
         corr_attrs = dict(list(corr_data.attrs.items()))
-        corr_data = corr_data.value
+        corr_data = corr_data[()]
     except:
         raise RuntimeError((
             'Corrected data not found.'))
@@ -148,4 +148,6 @@ def batch_norm(x, name_scope, training, epsilon=1e-3, decay=0.99):
         def population_statistics():
             return tf.nn.batch_normalization(x, pop_mean, pop_var, offset, scale, epsilon)
 
-        return tf.cond(training, batch_statistics, population_statistics)
+        # smart_cond builds only the population branch when training is a
+        # constant, so a frozen inference graph has no statistics update ops.
+        return tf.contrib.framework.smart_cond(training, batch_statistics, population_statistics)
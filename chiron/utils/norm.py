@@ -0,0 +1,88 @@
+# Copyright 2017 The Chiron Authors. All Rights Reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Robust normalization of the signal.
+
+The raw signal is digitised into int16, so the median and the median absolute
+deviation (MAD) can be read from a histogram of the signal given by
+np.bincount in O(n) instead of sorting the signal.
+"""
+from __future__ import absolute_import
+import numpy as np
+
+# The scale of MAD that makes it a consistent estimator of the standard
+# deviation of a normal distribution, same as statsmodels.robust.mad.
+MAD_SCALE = 0.6744897501960817
+# Maximum value range of a signal that is counted by the histogram.
+MAX_HIST_RANGE = 2**20
+
+
+def _median2(counts):
+    """Twice the median of a histogram, counts[i] is the count of value i."""
+    cumsum = np.cumsum(counts)
+    n = int(cumsum[-1])
+    if n % 2:
+        return 2 * int(np.searchsorted(cumsum, (n - 1) // 2, side='right'))
+    return int(np.searchsorted(cumsum, n // 2 - 1, side='right')) + \
+        int(np.searchsorted(cumsum, n // 2, side='right'))
+
+
+def _integer_signal(signal):
+    """Return the signal as an int64 array if it only contains integers in a
+    range small enough for the histogram, otherwise None."""
+    if signal.dtype.kind in 'iu':
+        integral = signal.astype(np.int64)
+    elif signal.dtype.kind == 'f':
+        integral = signal.astype(np.int64)
+        if not np.array_equal(integral, signal):
+            return None
+    else:
+        return None
+    if int(integral.max()) - int(integral.min()) >= MAX_HIST_RANGE:
+        return None
+    return integral
+
+
+def median_mad(signal, unique=False):
+    """
+    The median and the MAD of the signal.
+    Args:
+        signal: 1D signal array, the histogram is used if the signal only
+            contains integers.
+        unique: Calculate the median and MAD of the unique values in the
+            signal, same as applied on np.unique(signal).
+    Return:
+        (median, mad), the mad is scaled by MAD_SCALE.
+    """
+    signal = np.asarray(signal)
+    integral = _integer_signal(signal) if len(signal) else None
+    if integral is None:
+        if unique:
+            signal = np.unique(signal)
+        median = np.median(signal)
+        return median, np.median(np.abs(signal - median)) / MAD_SCALE
+    low = int(integral.min())
+    counts = np.bincount(integral - low)
+    if unique:
+        counts = (counts > 0).astype(np.int64)
+    median2 = _median2(counts)
+    # Twice the absolute deviation of every histogram bin from the median.
+    deviation2 = np.abs(2 * np.arange(len(counts)) - median2)
+    deviation_counts = np.bincount(deviation2, weights=counts).astype(np.int64)
+    # The deviations are doubled, so _median2 gives 4 times the MAD.
+    return low + median2 / 2.0, _median2(deviation_counts) / 4.0 / MAD_SCALE
+
+
+def mean_std(signal, unique=False):
+    """The mean and the standard deviation of the (unique values of) signal."""
+    signal = np.asarray(signal)
+    if unique:
+        integral = _integer_signal(signal) if len(signal) else None
+        if integral is None:
+            signal = np.unique(signal)
+        else:
+            low = int(integral.min())
+            signal = np.nonzero(np.bincount(integral - low))[0] + low
+    return np.mean(signal), np.std(signal)
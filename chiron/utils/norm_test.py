@@ -0,0 +1,34 @@
+# Copyright 2017 The Chiron Authors. All Rights Reserved.
+#
+#This Source Code Form is subject to the terms of the Mozilla Public
+#License, v. 2.0. If a copy of the MPL was not distributed with this
+#file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#Histogram median and MAD test
+from __future__ import absolute_import
+import numpy as np
+
+from chiron.utils.norm import median_mad, mean_std, MAD_SCALE
+
+
+def _reference(signal):
+    median = np.median(signal)
+    return median, np.median(np.abs(signal - median)) / MAD_SCALE
+
+
+def test_median_mad():
+    rng = np.random.RandomState(0)
+    for n in [1, 2, 7, 1000, 1001]:
+        signals = [rng.randint(200, 900, n).astype(np.int16),
+                   rng.randint(200, 900, n).astype(np.float32),
+                   rng.randn(n)]
+        for signal in signals:
+            for unique in [False, True]:
+                expect = _reference(np.unique(signal) if unique else signal)
+                assert np.allclose(median_mad(signal, unique), expect)
+
+
+def test_mean_std_unique():
+    signal = np.random.RandomState(1).randint(-50, 50, 500).astype(np.int16)
+    unique = np.unique(signal)
+    assert np.allclose(mean_std(signal, unique=True), (np.mean(unique), np.std(unique)))
@@ -1,10 +1,11 @@
 import sys
 class multi_pbars:
-    def __init__(self,bar_string,l = 40):
+    def __init__(self,bar_string,l = 40,quiet = False):
         """Maintain multiple progress bars of chiron running
         Args:
             bar_string([string]): List of the names of the bars.
             progress([int/float]): 
+            quiet(bool): Track the progress without drawing the bars.
         """
         if isinstance(bar_string,str):
             bar_string = [bar_string]
@@ -16,6 +17,7 @@ class multi_pbars:
         self.total = [-1]*self.bar_n
         self.max_line = 0
         self.bar_l = l
+        self.quiet = quiet
     def update(self,i,progress=None,total=None,title = None):
         if progress is not None:
             self.progress[i] = progress
@@ -26,6 +28,8 @@ class multi_pbars:
     def update_bar(self):
         self.refresh()
     def refresh(self):
+        if self.quiet:
+            return
         text = '\r'
         for i in range(self.bar_n):
             p = float(self.progress[i])/(self.total[i]+1e-6)
@@ -41,6 +45,8 @@ class multi_pbars:
         sys.stdout.write(text)
         sys.stdout.flush()
     def end(self):
+        if self.quiet:
+            return
         text = '\n'*self.bar_n
         sys.stdout.write(text)
         sys.stdout.flush()
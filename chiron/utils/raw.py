@@ -14,10 +14,20 @@ import h5py
 import logging
 from chiron.utils import labelop
 from chiron.utils.progress import multi_pbars
+from chiron.utils.archive import ReadArchive, entry_path, split_entry_path
 import tensorflow as tf
 import numpy as np
+import time
 from collections import Counter
+from multiprocessing import Pool
+from multiprocessing import cpu_count
 SUCCEED_TAG = "succeed"
+MANIFEST_FILE = "manifest.tsv"
+ARCHIVE_FILE = "reads.h5"
+REFRESH_INTERVAL = 1
+LABEL_FORMAT = np.dtype([('start','<i8'),
+                         ('end','<i8'),
+                         ('base','S1')])
 logger = logging.getLogger(name = 'chiron_train')
 def set_logger(log_file):
     global logger        
@@ -42,45 +52,193 @@ def make_batch_folder(root_f,batch_i):
     if not os.path.isdir(batch_folder):
         os.mkdir(batch_folder)
     return batch_folder
+def list_fast5(root_folder):
+    """List the fast5 files under root_folder in a deterministic order."""
+    file_list = []
+    for dir_n,_,files in tf.gfile.Walk(root_folder):
+        for file_n in files:
+            if file_n.endswith('fast5'):
+                file_list.append(os.path.join(dir_n,file_n))
+    return sorted(file_list)
+
+def list_file_reads(file_n):
+    """
+    List the reads in a fast5 file, a single-read fast5 file is listed by
+    its path and a read of a multi-read fast5 file is listed by the
+    archive.entry_path of its read group.
+    """
+    try:
+        with h5py.File(file_n,'r') as root:
+            if 'Raw' in root:
+                return [file_n]
+            groups = sorted([x for x in root if x.startswith('read_')])
+    except (IOError,OSError):
+        return [file_n]
+    return [entry_path(file_n,group) for group in groups]
+
+def list_reads(file_list,pool = None):
+    """
+    List the reads in the fast5 files by list_file_reads, the files are
+    listed by the workers of the pool if given. The reads are in the order of
+    file_list.
+    """
+    if pool is None:
+        listed = (list_file_reads(file_n) for file_n in file_list)
+    else:
+        listed = pool.imap(list_file_reads,file_list,chunksize = 16)
+    return [read for reads in listed for read in reads]
+
+def read_manifest(manifest_file):
+    """
+    Read the manifest written by extract.
+    Return:
+        A dict map the fast5 file path to the (state, batch_i) of the last run.
+    """
+    manifest = {}
+    if not os.path.isfile(manifest_file):
+        return manifest
+    with open(manifest_file,'r') as f:
+        for line in f:
+            split_line = line.rstrip('\n').split('\t')
+            if len(split_line) != 3:
+                continue
+            manifest[split_line[0]] = (split_line[2],int(split_line[1]))
+    return manifest
+
+def init_worker(flags):
+    global FLAGS
+    FLAGS = flags
+
+def write_file(args):
+    """
+    Extract a read and write the signal and label into the batch folder.
+    Args:
+        args: A (file_n, batch_folder) tuple, file_n is a read given by
+            list_reads.
+    Return:
+        file_n, the extraction state and the (read name, signal, label) record
+        if the output format is archive, the record is written into the
+        archive by the main process.
+    """
+    file_n,batch_folder = args
+    fast5_n,read_group = split_entry_path(file_n)
+    if read_group is None:
+        file_prefix = os.path.basename(file_n).split('.')[0]
+    else:
+        file_prefix = read_group
+    record = None
+    try:
+        state, (raw_data, raw_data_array),(offset,digitisation,range_s) = extract_file(fast5_n,read_group)
+        if state == SUCCEED_TAG:
+            if FLAGS.unit:
+                raw_data=reunit(raw_data,offset,digitisation,range_s)
+            if FLAGS.format == 'archive':
+                record = (file_prefix,raw_data,raw_data_array)
+            elif FLAGS.format == 'binary':
+                write_binary(os.path.join(batch_folder,file_prefix),raw_data,raw_data_array)
+            else:
+                with open(os.path.join(batch_folder,file_prefix+'.signal'),'w+') as f:
+                    f.write('\n'.join([str(x) for x in raw_data]))
+                with open(os.path.join(batch_folder,file_prefix+'.label'),'w+') as f:
+                    for label in raw_data_array:
+                        f.write(' '.join([str(x) for x in label]))
+                        f.write('\n')
+    except Exception as e:
+        state = str(e)
+    return file_n,' '.join(state.split()),record
+
+def write_binary(file_prefix,raw_data,raw_data_array):
+    """
+    Write the signal and label in numpy binary format, the signal is saved
+    into file_prefix.signal.npy and the label is saved as a LABEL_FORMAT
+    structured array into file_prefix.label.npy.
+    """
+    np.save(file_prefix+'.signal.npy',np.asarray(raw_data))
+    np.save(file_prefix+'.label.npy',np.asarray([tuple(x) for x in raw_data_array],dtype = LABEL_FORMAT))
+
 def extract(root_folder,output_folder,raw_folder=None):
+    """
+    Extract the fast5 files in root_folder into the batch folders in
+    output_folder with a process pool. The batch folder of a file is decided
+    by its position in the sorted file list, and the state of every file is
+    appended to the manifest file in output_folder, files that already have
+    a state in the manifest are skipped. With the archive format all the
+    reads are written into a single read archive ARCHIVE_FILE in output_folder
+    instead of the batch folders. The reads of a multi-read fast5 file are
+    extracted separately, as if they were in their own files.
+    """
     global logger
     error_bars = multi_pbars([""]*5)
     run_record = Counter()
-    batch_i = 1
     if not os.path.isdir(root_folder):
         raise IOError('Input directory does not found.')
-    batch_folder = make_batch_folder(output_folder,batch_i)
-    for dir_n,_,file_list in tf.gfile.Walk(root_folder):
-     for file_n in file_list:
-        if file_n.endswith('fast5'):
-            file_prefix = file_n.split('.')[0]
-#            output_file = output_folder + os.path.splitext(file_n)[0]
-            file_n = os.path.join(dir_n,file_n)
-            state, (raw_data, raw_data_array),(offset,digitisation,range_s) = extract_file(file_n)
+    manifest_file = os.path.join(output_folder,MANIFEST_FILE)
+    manifest = read_manifest(manifest_file)
+    threads = FLAGS.threads if FLAGS.threads > 0 else cpu_count()
+    pool = Pool(threads,initializer = init_worker,initargs = (FLAGS,))
+    file_list = list_reads(list_fast5(root_folder),pool)
+    tasks = []
+    batch_of = {}
+    for file_i,file_n in enumerate(file_list):
+        batch_i = file_i//FLAGS.batch + 1
+        batch_of[file_n] = batch_i
+        if file_n in manifest:
+            state,_ = manifest[file_n]
+            if state == SUCCEED_TAG or not FLAGS.retry_failed:
+                run_record[state] += 1
+                continue
+        if FLAGS.format == 'archive':
+            tasks.append((file_n,None))
+        else:
+            tasks.append((file_n,make_batch_folder(output_folder,batch_i)))
+    if len(tasks) < len(file_list):
+        logger.info("%d files are skipped as they are recorded in the manifest %s.\n"%(len(file_list)-len(tasks),manifest_file))
+    last_refresh = 0
+    if FLAGS.format == 'archive':
+        read_archive = ReadArchive(os.path.join(output_folder,ARCHIVE_FILE),
+                                   mode = 'a',
+                                   compressor = FLAGS.archive_compressor)
+    else:
+        read_archive = None
+    manifest_lines = []
+    with open(manifest_file,'a+') as manifest_f:
+        for file_n,state,record in pool.imap_unordered(write_file,tasks,chunksize = 16):
             run_record[state] +=1
-            if run_record[SUCCEED_TAG]>batch_i*FLAGS.batch:
-                batch_i+=1
-                batch_folder = make_batch_folder(output_folder,batch_i)
-            common_errors = run_record.most_common(FLAGS.n_errors)
-            total_errors = sum(run_record.values())
-            for i in np.arange(min(FLAGS.n_errors,len(common_errors))):
-                error_bars.update(i,
-                                  title = common_errors[i][0],
-                                  progress = common_errors[i][1],
-                                  total = total_errors)
-            error_bars.refresh()
+            manifest_lines.append("%s\t%s\t%s\n"%(file_n,batch_of[file_n],state))
+            if record is not None:
+                read_name,raw_data,raw_data_array = record
+                read_archive.add(read_name,raw_data,label = raw_data_array)
             if state == SUCCEED_TAG:
-                if FLAGS.unit:
-                    raw_data=reunit(raw_data,offset,digitisation,range_s)
-                with open(os.path.join(batch_folder,file_prefix+'.signal'),'w+') as f:
-                    f.write('\n'.join([str(x) for x in raw_data]))
-                with open(os.path.join(batch_folder,file_prefix+'.label'),'w+') as f:
-                    for label in raw_data_array:
-                        f.write(' '.join([str(x) for x in label]))
-                        f.write('\n')
                 logger.info("%s file transfered.   \n" % (file_n))
             else:
                 logger.error("FAIL on %s file, because of error %s.   \n" % (file_n,state))
+            if time.time() - last_refresh > REFRESH_INTERVAL:
+                # The archive is flushed before the manifest, so a file is
+                # never recorded as succeed before its read is saved.
+                if read_archive is not None:
+                    read_archive.flush()
+                manifest_f.write(''.join(manifest_lines))
+                manifest_f.flush()
+                manifest_lines = []
+                update_error_bars(error_bars,run_record)
+                last_refresh = time.time()
+        if read_archive is not None:
+            read_archive.close()
+        manifest_f.write(''.join(manifest_lines))
+    pool.close()
+    pool.join()
+    update_error_bars(error_bars,run_record)
+    error_bars.end()
+
+def update_error_bars(error_bars,run_record):
+    common_errors = run_record.most_common(FLAGS.n_errors)
+    total_errors = sum(run_record.values())
+    for i in np.arange(min(FLAGS.n_errors,len(common_errors))):
+        error_bars.update(i,
+                          title = common_errors[i][0],
+                          progress = common_errors[i][1],
+                          total = total_errors)
+    error_bars.refresh()
 
 def reunit(signal,offset,digitisation,range_s):
     """
@@ -110,11 +268,12 @@ def run_list(dirs,output_folder):
         root_folder = directory + os.path.sep
         extract(root_folder,output_folder)
 
-def extract_file(input_file):
+def extract_file(input_file,read_group = None):
     try:
         raw_info,channel_info = labelop.get_label_raw(
             input_file, FLAGS.basecall_group,
-            FLAGS.basecall_subgroup)
+            FLAGS.basecall_subgroup,
+            read_group = read_group)
         raw_data, raw_label, raw_start, raw_length = raw_info
         offset,range_s,digitisation = channel_info
     except Exception as e:
@@ -165,6 +324,12 @@ if __name__ == "__main__":
                         help='Type of data to basecall, default is dna, can be chosen from dna, rna and methylation(under construction)')
     parser.add_argument('--min_bps',default = 0, type =int, help="The minimum number of labels that has to be in each read.")
     parser.add_argument('--n_errors',default = 5, type = int, help="The number of errors that are going to be recorded.")
+    parser.add_argument('--threads',default = 0, type = int, help="Number of processes, default 0 use all the cpus.")
+    parser.add_argument('--format',default = 'text', choices = ['text','binary','archive'],
+                        help="Output format, text write .signal and .label files, binary write .signal.npy and .label.npy files, archive write all the reads into a single read archive reads.h5.")
+    parser.add_argument('--archive_compressor',default = 'zlib', choices = ['zlib','lzma'],
+                        help="Compressor of the signal codec used by the archive format.")
+    parser.add_argument('--retry_failed',action='store_true',help="Retry the files recorded as failed in the manifest.")
     args = parser.parse_args(sys.argv[1:])
     run(args)
 
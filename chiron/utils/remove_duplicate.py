@@ -9,7 +9,10 @@ import argparse
 import sys
 import collections
 from tqdm import tqdm
+from chiron.utils.seqio import read_fastx, format_record, name_hashes, HashIndex
 MAX_CHUNK_SIZE = 5e8
+# Number of records checked against the hash index at once.
+BATCH_SIZE = 100000
 def fast_reader(in_file,out_file):
     seqs = collections.OrderedDict()
     with open(in_file,'r') as f:
@@ -23,11 +26,55 @@ def fast_reader(in_file,out_file):
         for k,v in seqs.items():
             out_f.write(k+'\n'+v)
 
+def dedup_out_of_core(in_file,out_file,tmp_folder = None,run_size = 2**24):
+    """
+    Remove the records with duplicated read names with a flat memory, the
+    records are streamed and the hashes of the seen read names are kept in
+    a HashIndex which spills to the disk. Different from fast_reader, the
+    first occurrence of a read is kept.
+    Args:
+        in_file: Input fasta(q) file.
+        out_file: Output fasta(q) file.
+        tmp_folder: Folder for the spilled hash index, default is a temporary
+            folder.
+        run_size: Number of read name hashes held in memory.
+    Return:
+        (kept, duplicated) number of records.
+    """
+    kept = 0
+    duplicated = 0
+    batch = []
+    with HashIndex(tmp_folder,run_size) as index, open(out_file,'wb') as out_f:
+        def write_batch():
+            new = index.add(name_hashes([record[0] for record in batch]))
+            out_f.write(b''.join([format_record(*record) for record,is_new in zip(batch,new) if is_new]))
+            return int(new.sum())
+        for record in tqdm(read_fastx(in_file),desc = 'Read records in fast file:'):
+            batch.append(record)
+            if len(batch) >= BATCH_SIZE:
+                n = write_batch()
+                kept += n
+                duplicated += len(batch) - n
+                batch = []
+        if len(batch):
+            n = write_batch()
+            kept += n
+            duplicated += len(batch) - n
+    return kept,duplicated
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description='Transfer fast5 to raw_pair file.')
     parser.add_argument('-i', '--input', required = True,
                         help="Input fasta(q) file.")
     parser.add_argument('-o', '--output', required = True, help="Output fasta(q) file")
+    parser.add_argument('--out_of_core', action = 'store_true',
+                        help="Stream the records and keep the read name index on the disk, the memory stays flat for any input size, the first occurrence of a read is kept.")
+    parser.add_argument('--tmp', default = None,
+                        help="Folder of the on-disk read name index, default is a temporary folder.")
     args = parser.parse_args(sys.argv[1:])
-    fast_reader(args.input,args.output)
+    if args.out_of_core:
+        kept,duplicated = dedup_out_of_core(args.input,args.output,args.tmp)
+        print("Kept %d records, removed %d duplicated records."%(kept,duplicated))
+    else:
+        fast_reader(args.input,args.output)
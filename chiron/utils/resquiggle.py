@@ -12,7 +12,6 @@ import os
 import numpy as np
 import difflib
 import bisect
-from scipy.interpolate import interp1d
 import itertools
 import mappy
 from tqdm import tqdm
@@ -21,42 +20,52 @@ from Bio.pairwise2 import format_alignment
 from multiprocessing import Pool
 OVERMOVE_ERROR = "Encounter a movement bigger than 4!"
 NEGTIVE_ERROR = "Negative movement detected."
+# Map the ascii code of a base to its index in the consensus, -1 for others.
+BASE_CODE = -np.ones(256,dtype = int)
+for _code,_bases in enumerate(['Aa','Cc','Gg','TtUu']):
+    for _base in _bases:
+        BASE_CODE[ord(_base)] = _code
 
 def LIS(sequence):
     """
     This function finding the longest increasing subsequence for a given sequence.
-    An implemention of the binary search method in Wiki:
+    An implemention of the binary search (patience sorting) method in Wiki:
         https://en.wikipedia.org/wiki/Longest_increasing_subsequence
+    The first and the last element of the sequence are always included.
     """
     sequence = np.asarray(sequence)
+    values = sequence.tolist()
+    n = len(values)
     l = 1
-    M = np.array([0])
-    P = np.array([-1]*len(sequence))
-    for i,item in enumerate(sequence[1:]):
-        idx = i+1
-        if item > sequence[M[-1]]:
-            P[idx] = M[-1]
-            M = np.append(M,idx)
+    # tails[i] is the smallest tail value of an increasing subsequence of
+    # length i+1 and M[i] is its index, P[k] is the predecessor of k.
+    tails = [None] * n
+    M = [0] * n
+    P = [-1] * n
+    tails[0] = values[0]
+    for idx in range(1,n):
+        item = values[idx]
+        if item > tails[l-1]:
+            P[idx] = M[l-1]
+            tails[l] = item
+            M[l] = idx
             l += 1
         else:
-            loc = bisect.bisect_left(sequence[M],sequence[idx])
-            P[idx] = M[loc-1]
+            loc = bisect.bisect_left(tails,item,0,l-1)
+            if loc > 0:
+                P[idx] = M[loc-1]
+            tails[loc] = item
             M[loc] = idx
-    out = [-1] * l
+    idxs = np.empty(l,dtype = int)
     index = M[l-1]
-    idxs = [index]
     for i in range(l-1,-1,-1):
-        out[i] = sequence[index]
+        idxs[i] = index
         index = P[index]
-        idxs = [index] + idxs
-    idxs = idxs[1:]
-    if idxs[0]!=0:
-        out = [sequence[0]]+out
-        idxs = [0] + idxs
-    if idxs[-1]!=len(sequence)-1:
-        idxs = idxs + [len(sequence)-1]
-        out = out + [sequence[-1]]
-    return np.asarray(out),np.asarray(idxs)
+    if idxs[0] != 0:
+        idxs = np.concatenate([[0],idxs])
+    if idxs[-1] != n-1:
+        idxs = np.concatenate([idxs,[n-1]])
+    return sequence[idxs],idxs
 
 def get_squiggle_pos(bound):
     """
@@ -68,11 +77,10 @@ def get_squiggle_pos(bound):
     """
     bot_val, bot_idx = LIS(bound[:,0])
     up_val, up_idx = LIS(bound[:,1])
-    bot_f = interp1d(bot_idx,bot_val)
-    up_f = interp1d(up_idx,up_val)
-    up_bound = up_f(range(len(bound)))
-    bot_bound = bot_f(range(len(bound)))
-    return np.asarray(list(zip(bot_bound,up_bound)))
+    positions = np.arange(len(bound))
+    bot_bound = np.interp(positions,bot_idx,bot_val)
+    up_bound = np.interp(positions,up_idx,up_val)
+    return np.stack([bot_bound,up_bound],axis = 1)
 
 def match_blocks(alignment):
     tmp_start = -1 
@@ -214,18 +222,18 @@ def simple_assembly_pos(bpreads,jump_step_ratio, error_rate = 0.2):
 
 
 def add_bound(concensus,concensus_bound, start_indx, segment,segment_idx):
-    base_dict = {'A': 0, 'C': 1, 'G': 2, 'T': 3, 'U':3, 
-                 'a': 0, 'c': 1, 'g': 2, 't': 3, 'u':3}
     if start_indx < 0:
         segment = segment[-start_indx:]
         start_indx = 0
-    for i, base in enumerate(segment):
-        if base == 'X':
-            print(concensus)
-            print(segment)
-        concensus[base_dict[base]][start_indx + i] += 1
-        concensus_bound[base_dict[base]][start_indx + i][0] = min(concensus_bound[base_dict[base]][start_indx + i][0],segment_idx)
-        concensus_bound[base_dict[base]][start_indx + i][1] = max(concensus_bound[base_dict[base]][start_indx + i][1],segment_idx)
+    codes = BASE_CODE[np.frombuffer(segment.encode('ascii'),dtype = np.uint8)]
+    if np.any(codes < 0):
+        print(concensus)
+        print(segment)
+        raise KeyError(segment[np.where(codes < 0)[0][0]])
+    pos = start_indx + np.arange(len(codes))
+    np.add.at(concensus,(codes,pos),1)
+    np.minimum.at(concensus_bound[:,:,0],(codes,pos),segment_idx)
+    np.maximum.at(concensus_bound[:,:,1],(codes,pos),segment_idx)
 
 def read_chunks(filepath):
     chunks = list()
@@ -282,6 +290,95 @@ def revise(concensus, ref_file):
     pass
 ### Test Script ###
     
+def _slice_bounds(begin,end,total_len):
+    """Vectorised bounds of raw_signal[begin:end] given by the Python slice."""
+    begin = np.where(begin < 0,begin + total_len,begin).clip(0,total_len)
+    end = np.where(end < 0,end + total_len,end).clip(0,total_len)
+    return begin,np.maximum(begin,end)
+
+def _chunk_mean_std(signal,begin,end):
+    """
+    Mean and std of every chunk signal[begin[i]:end[i]], NaN for the empty
+    chunks. An integer signal is read from its exact cumulative sums, a float
+    signal is gathered and reduced in two passes like np.std, as the
+    cumulative sums of squares lose the precision by cancellation.
+    """
+    n = end - begin
+    with np.errstate(divide = 'ignore',invalid = 'ignore'):
+        if signal.dtype.kind in 'iu':
+            signal = signal.astype(np.int64)
+            cumsum = np.concatenate([[0],np.cumsum(signal)])
+            cumsum_sq = np.concatenate([[0],np.cumsum(signal*signal)])
+            sums = (cumsum[end] - cumsum[begin]).astype(np.float64)
+            means = sums/n
+            variance = ((cumsum_sq[end] - cumsum_sq[begin]) - sums*means)/n
+        else:
+            owner = np.repeat(np.arange(len(n)),n)
+            index = np.arange(len(owner)) - np.repeat(np.cumsum(n) - n,n) + np.repeat(begin,n)
+            values = signal[index].astype(np.float64)
+            means = np.bincount(owner,weights = values,minlength = len(n))/n
+            deviation = values - means[owner]
+            variance = np.bincount(owner,weights = deviation*deviation,minlength = len(n))/n
+        stds = np.sqrt(np.maximum(variance,0))
+    stds[n == 0] = np.nan
+    return means,stds
+
+def expand_hmm_events(events,raw_signal,start_time,sample_rate,data_format):
+    """
+    Expand the events of the HMM alignment into the bases, the signal between
+    two events whose seq_pos moves by n is split evenly into n bases.
+    Args:
+        events: The CurrentSpaceMapped events.
+        raw_signal: The raw signal.
+        start_time: start_time of the read.
+        sample_rate: Sampling frequency.
+        data_format: The dtype of the output matrix.
+    Return:
+        A matrix of (mean, std, start, length, base) of each base, in the
+        reversed order of the raw signal.
+    """
+    start_int = np.round(events['start'] *sample_rate).astype(int) - start_time
+    total_len = len(raw_signal)
+    seq_pos = np.asarray(events['seq_pos'])
+    moves = np.diff(seq_pos)
+    invalid = np.where((moves > 4) | (moves < 0))[0]
+    if len(invalid):
+        if moves[invalid[0]] < 0:
+            raise ValueError(NEGTIVE_ERROR)
+        raise ValueError(OVERMOVE_ERROR)
+    # Events where seq_pos moves, and the previous event where it moved.
+    curr = np.where(moves > 0)[0] + 1
+    prev = np.concatenate([[0],curr])[:-1].astype(int)
+    move = moves[curr - 1]
+    prev_start = start_int[prev]
+    curr_start = start_int[curr]
+    avg_len = np.round((curr_start - prev_start)/move.astype(np.float64)).astype(int)
+    # Expand every move into its bases.
+    group = np.repeat(np.arange(len(curr)),move)
+    offset = np.arange(len(group)) - np.repeat(np.cumsum(move) - move,move)
+    start = prev_start[group] + offset*avg_len[group]
+    chunk_len = avg_len[group]
+    length = chunk_len.copy()
+    last = np.cumsum(move) - 1
+    length[last] = curr_start - start[last]
+    kmers = np.ascontiguousarray(events['kmer'])
+    kmer_len = kmers.dtype.itemsize
+    kmers = kmers.view(np.uint8).reshape(-1,kmer_len)
+    base_pos = offset + 2
+    from_prev = base_pos < kmer_len
+    base = np.where(from_prev,
+                    kmers[prev[group],np.minimum(base_pos,kmer_len - 1)],
+                    kmers[curr[group],np.clip(base_pos - move[group],0,kmer_len - 1)])
+    chunk_begin,chunk_end = _slice_bounds(start,start + chunk_len,total_len)
+    means,stds = _chunk_mean_std(np.asarray(raw_signal),chunk_begin,chunk_end)
+    matrix = np.empty(len(start),dtype = data_format)
+    matrix['mean'] = means[::-1]
+    matrix['std'] = stds[::-1]
+    matrix['start'] = (total_len - start - length)[::-1]
+    matrix['length'] = length[::-1]
+    matrix['base'] = np.ascontiguousarray(base[::-1]).view('S1')
+    return matrix
+
 def reformat_hmm(fast5_f):
     DATA_FORMAT = np.dtype([('mean','<f4'),
                             ('std','<f4'),
@@ -295,49 +392,7 @@ def reformat_hmm(fast5_f):
         start_time = raw_entry.attrs['start_time']
         raw_signal = raw_entry['Signal'].value
         sample_rate = int(root["/UniqueGlobalKey/context_tags"].attrs['sample_frequency'])
-        start_int = np.round(events['start'] *sample_rate).astype(int) - start_time
-        total_len = len(raw_signal)
-        start = list()
-        rev_start = list()
-        length = list()
-        base = list()
-        means = list()
-        stds = list()
-        for idx,pos in enumerate(events['seq_pos']):
-            if idx == 0:
-                prev_start = start_int[idx]
-                prev_kmer = events['kmer'][idx].decode("utf-8")
-                prev_pos = pos
-            elif pos > prev_pos:
-                curr_start = start_int[idx]
-                move = pos - prev_pos
-                if move > 4:
-                    raise ValueError(OVERMOVE_ERROR)
-                prev_kmer = prev_kmer + events['kmer'][idx].decode("utf-8")[-move:]
-                avg_len = int(round((curr_start - prev_start)/move))
-                for i in range(move):
-                    start.append(prev_start)
-                    length.append(avg_len)
-                    prev_start = prev_start + avg_len
-                    base.append(prev_kmer[2+i])
-                    chunk = raw_signal[start[-1]:(start[-1] + length[-1])]
-                    means.append(np.mean(chunk))
-                    stds.append(np.std(chunk))
-                length[-1] = curr_start - start[-1]
-                prev_pos = pos
-                prev_start = curr_start
-                prev_kmer = events['kmer'][idx].decode("utf-8")
-            elif pos < prev_pos:
-                raise ValueError(NEGTIVE_ERROR)
-        for idx,s in enumerate(start):
-            rev_start.append(total_len - s - length[idx])
-        matrix = list()
-        rev_start = rev_start[::-1]
-        length = length[::-1]
-        base = base[::-1]
-        means = means[::-1]
-        stds = stds[::-1]
-        matrix = np.asarray(list(zip(means,stds,rev_start,length,base)),dtype = DATA_FORMAT)
+        matrix = expand_hmm_events(events,raw_signal,start_time,sample_rate,DATA_FORMAT)
         if '/Analyses/RawGenomeCorrected_000' in root:
             del root['/Analyses/RawGenomeCorrected_000']
         event_h = root.create_dataset('/Analyses/RawGenomeCorrected_000/BaseCalled_template/Events', shape = (len(matrix),),maxshape=(None,),dtype = DATA_FORMAT)
@@ -387,32 +442,33 @@ def run(args):
 #    run(args)   chunks
     
     ### Test Code ###
-LIS([1,8,3,4,5,2])
-ROOT_FOLDER = "/home/heavens/UQ/Chiron_project/RNA_Analysis/RNA_GN131/test/"
-FAST5_FOLDER = "/home/heavens/UQ/Chiron_project/RNA_Analysis/RNA_GN131/test/"
-FILE_PRE = "imb17_013486_20171113_FAB45360_MN17279_sequencing_run_20171113_RNAseq_GN131_17776_read_1002_ch_242_strand"
-FILE_PRE = "imb17_013486_20171113_FAB45360_MN17279_sequencing_run_20171113_RNAseq_GN131_17776_read_11842_ch_59_strand"
-REF_FILE = "/home/heavens/UQ/Chiron_project/RNA_Analysis/Reference/S00000028.fasta"
+if __name__ == "__main__":
+    LIS([1,8,3,4,5,2])
+    ROOT_FOLDER = "/home/heavens/UQ/Chiron_project/RNA_Analysis/RNA_GN131/test/"
+    FAST5_FOLDER = "/home/heavens/UQ/Chiron_project/RNA_Analysis/RNA_GN131/test/"
+    FILE_PRE = "imb17_013486_20171113_FAB45360_MN17279_sequencing_run_20171113_RNAseq_GN131_17776_read_1002_ch_242_strand"
+    FILE_PRE = "imb17_013486_20171113_FAB45360_MN17279_sequencing_run_20171113_RNAseq_GN131_17776_read_11842_ch_59_strand"
+    REF_FILE = "/home/heavens/UQ/Chiron_project/RNA_Analysis/Reference/S00000028.fasta"
 
-chunks,bounds,locs,concensus,coors = resquiggle(ROOT_FOLDER, FAST5_FOLDER, FILE_PRE)
-from matplotlib import pyplot as plt
-chunk_size = len(chunks)
-for idx,_ in enumerate(bounds):
-    plt.axvline(x = idx, ymin = bounds[idx,0]/chunk_size, ymax = bounds[idx,1]/chunk_size)
-plt.plot(np.arange(len(locs)),locs)
-plt.yticks(np.arange(0,chunk_size,chunk_size/10))
-gap_open = -5
-gap_extend = -2
-mismatch = -3
-match = 1
-global_alignment = pairwise2.align.globalms(chunks[0],chunks[1],match,mismatch,gap_open,gap_extend)
-print(format_alignment(*global_alignment[0]))
-match_blocks(global_alignment[0])
+    chunks,bounds,locs,concensus,coors = resquiggle(ROOT_FOLDER, FAST5_FOLDER, FILE_PRE)
+    from matplotlib import pyplot as plt
+    chunk_size = len(chunks)
+    for idx,_ in enumerate(bounds):
+        plt.axvline(x = idx, ymin = bounds[idx,0]/chunk_size, ymax = bounds[idx,1]/chunk_size)
+    plt.plot(np.arange(len(locs)),locs)
+    plt.yticks(np.arange(0,chunk_size,chunk_size/10))
+    gap_open = -5
+    gap_extend = -2
+    mismatch = -3
+    match = 1
+    global_alignment = pairwise2.align.globalms(chunks[0],chunks[1],match,mismatch,gap_open,gap_extend)
+    print(format_alignment(*global_alignment[0]))
+    match_blocks(global_alignment[0])
     
-print("#################################")
-#coors = np.asarray(coors)
-#con_len = len(concensus[0])
-#for idx,_ in enumerate(coors):
-#    plt.axhline(y = idx, xmin = coors[idx,0]/float(con_len), xmax = coors[idx,1]/float(con_len))
-    ###
+    print("#################################")
+    #coors = np.asarray(coors)
+    #con_len = len(concensus[0])
+    #for idx,_ in enumerate(coors):
+    #    plt.axhline(y = idx, xmin = coors[idx,0]/float(con_len), xmax = coors[idx,1]/float(con_len))
+        ###
 
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Regression test of the vectorised functions of resquiggle against the
+original loops.
+"""
+import bisect
+import warnings
+import numpy as np
+
+from chiron.utils import resquiggle
+
+DATA_FORMAT = np.dtype([('mean','<f4'),
+                        ('std','<f4'),
+                        ('start','<i4'),
+                        ('length','<i4'),
+                        ('base','S1')])
+EVENT_FORMAT = np.dtype([('start','<f8'),
+                         ('seq_pos','<i8'),
+                         ('kmer','S5')])
+
+def _reference_expand(events,raw_signal,start_time,sample_rate):
+    """The per-event loop of reformat_hmm before vectorisation."""
+    start_int = np.round(events['start'] *sample_rate).astype(int) - start_time
+    total_len = len(raw_signal)
+    start = list()
+    rev_start = list()
+    length = list()
+    base = list()
+    means = list()
+    stds = list()
+    for idx,pos in enumerate(events['seq_pos']):
+        if idx == 0:
+            prev_start = start_int[idx]
+            prev_kmer = events['kmer'][idx].decode("utf-8")
+            prev_pos = pos
+        elif pos > prev_pos:
+            curr_start = start_int[idx]
+            move = pos - prev_pos
+            if move > 4:
+                raise ValueError(resquiggle.OVERMOVE_ERROR)
+            prev_kmer = prev_kmer + events['kmer'][idx].decode("utf-8")[-move:]
+            avg_len = int(round((curr_start - prev_start)/move))
+            for i in range(move):
+                start.append(prev_start)
+                length.append(avg_len)
+                prev_start = prev_start + avg_len
+                base.append(prev_kmer[2+i])
+                chunk = raw_signal[start[-1]:(start[-1] + length[-1])]
+                means.append(np.mean(chunk))
+                stds.append(np.std(chunk))
+            length[-1] = curr_start - start[-1]
+            prev_pos = pos
+            prev_start = curr_start
+            prev_kmer = events['kmer'][idx].decode("utf-8")
+        elif pos < prev_pos:
+            raise ValueError(resquiggle.NEGTIVE_ERROR)
+    for idx,s in enumerate(start):
+        rev_start.append(total_len - s - length[idx])
+    return np.asarray(list(zip(means[::-1],stds[::-1],rev_start[::-1],length[::-1],base[::-1])),dtype = DATA_FORMAT)
+
+def _random_events(rng,event_n,max_move = 4,negative = False):
+    moves = rng.randint(0,max_move + 1,event_n)
+    moves[0] = 0
+    if negative:
+        moves[rng.randint(1,event_n)] = -1
+    events = np.empty(event_n,dtype = EVENT_FORMAT)
+    events['seq_pos'] = np.cumsum(moves)
+    events['start'] = np.cumsum(rng.randint(1,12,event_n))/4000.0
+    events['kmer'] = [''.join(rng.choice(list('ACGT'),5)).encode() for _ in range(event_n)]
+    return events
+
+def _expand_or_error(expand,*args):
+    try:
+        return expand(*args)
+    except ValueError as e:
+        return str(e)
+
+def test_expand_hmm_events():
+    rng = np.random.RandomState(0)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for case in range(300):
+            events = _random_events(rng,rng.randint(2,60),
+                                    max_move = 5 if case % 5 == 0 else 4,
+                                    negative = case % 7 == 0)
+            start_time = rng.randint(0,20)
+            raw_n = int(events['start'][-1]*4000) - start_time + rng.randint(-20,20)
+            raw_n = max(raw_n,1)
+            if case % 2:
+                raw_signal = rng.randint(200,900,raw_n).astype(np.int16)
+            else:
+                raw_signal = (rng.randn(raw_n)*30 + 500).astype(np.float32)
+            expect = _expand_or_error(_reference_expand,events,raw_signal,start_time,4000)
+            result = _expand_or_error(resquiggle.expand_hmm_events,events,raw_signal,start_time,4000,DATA_FORMAT)
+            if isinstance(expect,str):
+                assert result == expect
+                continue
+            for field in ['start','length','base']:
+                assert np.array_equal(result[field],expect[field])
+            if raw_signal.dtype.kind == 'i':
+                for field in ['mean','std']:
+                    assert np.array_equal(result[field],expect[field],equal_nan = True)
+            else:
+                for field in ['mean','std']:
+                    assert np.allclose(result[field],expect[field],rtol = 1e-6,atol = 1e-4,equal_nan = True)
+                # A single sample chunk has a std of exactly 0.
+                single = result['length'] == 1
+                assert np.all(result['std'][single & (expect['std'] == 0)] == 0)
+
+def _reference_lis(sequence):
+    """LIS before the patience sorting rewrite."""
+    sequence = np.asarray(sequence)
+    l = 1
+    M = np.array([0])
+    P = np.array([-1]*len(sequence))
+    for i,item in enumerate(sequence[1:]):
+        idx = i+1
+        if item > sequence[M[-1]]:
+            P[idx] = M[-1]
+            M = np.append(M,idx)
+            l += 1
+        else:
+            loc = bisect.bisect_left(sequence[M],sequence[idx])
+            P[idx] = M[loc-1]
+            M[loc] = idx
+    out = [-1] * l
+    index = M[l-1]
+    idxs = [index]
+    for i in range(l-1,-1,-1):
+        out[i] = sequence[index]
+        index = P[index]
+        idxs = [index] + idxs
+    idxs = idxs[1:]
+    if idxs[0]!=0:
+        out = [sequence[0]]+out
+        idxs = [0] + idxs
+    if idxs[-1]!=len(sequence)-1:
+        idxs = idxs + [len(sequence)-1]
+        out = out + [sequence[-1]]
+    return np.asarray(out),np.asarray(idxs)
+
+def test_lis():
+    rng = np.random.RandomState(1)
+    for _ in range(300):
+        sequence = rng.randint(0,30,rng.randint(1,80))
+        expect_val,expect_idx = _reference_lis(sequence)
+        val,idx = resquiggle.LIS(sequence)
+        assert np.array_equal(val,expect_val)
+        assert np.array_equal(idx,expect_idx)
+
+def _reference_add_bound(concensus,concensus_bound,start_indx,segment,segment_idx):
+    """add_bound before vectorisation."""
+    base_dict = {'A': 0, 'C': 1, 'G': 2, 'T': 3, 'U':3,
+                 'a': 0, 'c': 1, 'g': 2, 't': 3, 'u':3}
+    if start_indx < 0:
+        segment = segment[-start_indx:]
+        start_indx = 0
+    for i, base in enumerate(segment):
+        concensus[base_dict[base]][start_indx + i] += 1
+        concensus_bound[base_dict[base]][start_indx + i][0] = min(concensus_bound[base_dict[base]][start_indx + i][0],segment_idx)
+        concensus_bound[base_dict[base]][start_indx + i][1] = max(concensus_bound[base_dict[base]][start_indx + i][1],segment_idx)
+
+def test_add_bound():
+    rng = np.random.RandomState(2)
+    length = 200
+    concensus = np.zeros([4,length])
+    concensus_bound = np.stack([np.full([4,length],np.inf),np.full([4,length],-np.inf)],axis = 2)
+    expect = concensus.copy()
+    expect_bound = concensus_bound.copy()
+    for segment_idx in rng.permutation(100):
+        segment = ''.join(rng.choice(list('ACGTUacgtu'),rng.randint(1,30)))
+        start_indx = rng.randint(-10,length - len(segment))
+        resquiggle.add_bound(concensus,concensus_bound,start_indx,segment,segment_idx)
+        _reference_add_bound(expect,expect_bound,start_indx,segment,segment_idx)
+    assert np.array_equal(concensus,expect)
+    assert np.array_equal(concensus_bound,expect_bound)
@@ -0,0 +1,159 @@
+# Copyright 2017 The Chiron Authors. All Rights Reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Streaming FASTA/FASTQ readers.
+
+The files are read through a buffered binary stream and the records are
+yielded one by one as bytes, so the memory is bounded by the longest record
+instead of the size of the file.
+"""
+from __future__ import absolute_import
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+
+BUFFER_SIZE = 2**22
+
+
+def read_fasta(file_path, buffer_size=BUFFER_SIZE):
+    """
+    Iterate over a FASTA file.
+    Yield:
+        (name, seq), the name is the header line without '>', both are bytes.
+    """
+    with open(file_path, 'rb', buffer_size) as f:
+        name = None
+        seq = []
+        for line in f:
+            if line.startswith(b'>'):
+                if name is not None:
+                    yield name, b''.join(seq)
+                name = line[1:].strip()
+                seq = []
+            elif name is not None:
+                seq.append(line.strip())
+        if name is not None:
+            yield name, b''.join(seq)
+
+
+def read_fastq(file_path, buffer_size=BUFFER_SIZE):
+    """
+    Iterate over a FASTQ file, the sequence and the quality can span several
+    lines, the quality is read until it has the length of the sequence so a
+    quality line starting with '@' is handled.
+    Yield:
+        (name, seq, qual), the name is the header line without '@', all are
+        bytes.
+    """
+    with open(file_path, 'rb', buffer_size) as f:
+        lines = iter(f)
+        for line in lines:
+            if not line.startswith(b'@'):
+                continue
+            name = line[1:].strip()
+            seq = []
+            for line in lines:
+                if line.startswith(b'+'):
+                    break
+                seq.append(line.strip())
+            seq = b''.join(seq)
+            qual = []
+            qual_len = 0
+            while qual_len < len(seq):
+                line = next(lines, None)
+                if line is None:
+                    raise ValueError("Truncated FASTQ record %s in %s" % (name, file_path))
+                qual.append(line.strip())
+                qual_len += len(qual[-1])
+            yield name, seq, b''.join(qual)
+
+
+def read_fastx(file_path, buffer_size=BUFFER_SIZE):
+    """
+    Iterate over a FASTA or FASTQ file, the format is given by the first
+    character of the file.
+    Yield:
+        (name, seq, qual), qual is None for a FASTA file.
+    """
+    with open(file_path, 'rb') as f:
+        first = f.read(1)
+    if first == b'@':
+        for record in read_fastq(file_path, buffer_size):
+            yield record
+    else:
+        for name, seq in read_fasta(file_path, buffer_size):
+            yield name, seq, None
+
+
+def format_record(name, seq, qual=None):
+    """The bytes of a record in FASTA, or in FASTQ if qual is given."""
+    if qual is None:
+        return b'>' + name + b'\n' + seq + b'\n'
+    return b'@' + name + b'\n' + seq + b'\n+\n' + qual + b'\n'
+
+
+def name_hashes(names):
+    """64-bit hashes of the names."""
+    digests = b''.join([hashlib.sha1(name).digest()[:8] for name in names])
+    return np.frombuffer(digests, dtype='<u8')
+
+
+class HashIndex(object):
+    """
+    An out-of-core set of 64-bit hashes. The hashes are kept in memory up to
+    run_size, then spilled into a sorted run on the disk, the runs are
+    memory-mapped and searched by binary search.
+    Args:
+        folder: Folder to spill the runs, a temporary folder if None.
+        run_size: Maximum number of the hashes held in memory.
+    """
+
+    def __init__(self, folder=None, run_size=2**24):
+        self.run_size = run_size
+        self._own_folder = folder is None
+        self.folder = tempfile.mkdtemp(prefix='hash_index') if folder is None else folder
+        self.memory = set()
+        self.runs = []
+
+    def add(self, hashes):
+        """
+        Add a batch of hashes.
+        Return:
+            A boolean mask of the hashes not seen before, only the first
+            occurrence of a hash repeated in the batch is True.
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        new = np.zeros(len(hashes), dtype=bool)
+        new[np.unique(hashes, return_index=True)[1]] = True
+        for run in self.runs:
+            pos = np.searchsorted(run, hashes).clip(0, len(run) - 1)
+            new &= run[pos] != hashes
+        hash_list = hashes.tolist()
+        memory = self.memory
+        new &= np.fromiter((h not in memory for h in hash_list), dtype=bool, count=len(hash_list))
+        memory.update(hashes[new].tolist())
+        if len(memory) >= self.run_size:
+            self._spill()
+        return new
+
+    def _spill(self):
+        run_file = os.path.join(self.folder, 'run_%d.npy' % (len(self.runs)))
+        np.save(run_file, np.sort(np.fromiter(self.memory, dtype=np.uint64, count=len(self.memory))))
+        self.runs.append(np.load(run_file, mmap_mode='r'))
+        self.memory = set()
+
+    def close(self):
+        self.runs = []
+        self.memory = set()
+        if self._own_folder:
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
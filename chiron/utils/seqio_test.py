@@ -0,0 +1,39 @@
+# Copyright 2017 The Chiron Authors. All Rights Reserved.
+#
+#This Source Code Form is subject to the terms of the Mozilla Public
+#License, v. 2.0. If a copy of the MPL was not distributed with this
+#file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#FASTQ reader and hash index test
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from chiron.utils.seqio import read_fastq, name_hashes, HashIndex
+
+
+def test_read_fastq():
+    folder = tempfile.mkdtemp()
+    try:
+        fastq = os.path.join(folder, 'reads.fastq')
+        with open(fastq, 'wb') as f:
+            f.write(b'@read1\nACGT\n+\n@@II\n'
+                    b'@read2\nAC\nGT\n+read2\n@I\nI@\n'
+                    b'@read3\nA\n+\n@\n')
+        records = list(read_fastq(fastq))
+        assert records == [(b'read1', b'ACGT', b'@@II'),
+                           (b'read2', b'ACGT', b'@II@'),
+                           (b'read3', b'A', b'@')]
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_hash_index():
+    names = [b'read%d' % (i % 50) for i in range(200)]
+    hashes = name_hashes(names)
+    with HashIndex(run_size=16) as index:
+        new = np.concatenate([index.add(hashes[i:i + 30]) for i in range(0, len(hashes), 30)])
+        assert len(index.runs) > 0
+    assert np.array_equal(np.nonzero(new)[0], np.arange(50))